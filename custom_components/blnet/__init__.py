@@ -1,18 +1,41 @@
 """
 Connect to a BL-NET via it's web interface and read and write data
 """
+import asyncio
 import logging
+from collections import namedtuple
 from datetime import datetime, timedelta
+from types import MappingProxyType
+from urllib.parse import urlparse
 
 import voluptuous as vol
 from homeassistant.const import (
-    CONF_RESOURCE, CONF_PASSWORD, CONF_SCAN_INTERVAL, UnitOfTemperature,
+    CONF_NAME, CONF_RESOURCE, CONF_PASSWORD, CONF_USERNAME, CONF_SCAN_INTERVAL, CONF_TIMEOUT,
+    CONF_TYPE, CONF_UNIT_OF_MEASUREMENT, EVENT_HOMEASSISTANT_STOP, UnitOfTemperature,
 )
-from homeassistant.helpers.discovery import load_platform
-from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.core import SupportsResponse, callback
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers.discovery import async_load_platform
+from homeassistant.helpers.event import async_call_later
+from homeassistant.helpers.storage import Store
 import homeassistant.helpers.config_validation as cv
+from homeassistant.util import slugify
 
-REQUIREMENTS = ['pyblnet==0.9.3']
+from .backfill import async_import_logger
+from .breaker import CircuitBreaker
+from .capture import CaptureWriter
+from .channels import Channel, as_number
+from .client import (
+    BLNETClient, DOMAINS, PAGE_DIGITAL, PAGE_DOMAINS, pages_for_domains,
+)
+from .cmi import CMIBackend, DEFAULT_USERNAME
+from .derived import (
+    DERIVED_ICONS, DERIVED_KINDS, SOURCE_PATTERN, Derivation, parse_source,
+)
+from .history import ROLLING_STATS, SampleBuffer
+from .stats import CycleStats
+from .ta_direct import BLNETDirectConnection
+from .web import BLNETWebSession
 
 _LOGGER = logging.getLogger(__name__)
 DOMAIN = 'blnet'
@@ -23,11 +46,89 @@ CONF_TA_PORT = 'ta_port'
 CONF_USE_WEB = 'use_web'
 CONF_USE_TA = 'use_ta'
 CONF_NODE = 'can_node'
+CONF_BACKEND = 'backend'
+CONF_CAPTURE = 'capture'
+CONF_IMPORT_LOGGER = 'import_logger'
+CONF_DEADBAND = 'deadband'
+CONF_CHANNELS = 'channels'
+CONF_MAX_AGE = 'max_age'
+CONF_ROLLING = 'rolling'
+CONF_WINDOW = 'window'
+CONF_SAMPLES = 'samples'
+CONF_SENSORS = 'sensors'
+CONF_DERIVED = 'derived'
+CONF_SOURCES = 'sources'
+CONF_FULL_FETCH_INTERVAL = 'full_fetch_interval'
+CONF_SCAN_INTERVALS = 'scan_intervals'
+CONF_ADAPTIVE = 'adaptive_polling'
+CONF_MIN_INTERVAL = 'min_interval'
+CONF_MAX_INTERVAL = 'max_interval'
+CONF_BURST = 'burst'
+
+# Backends reading the values
+BACKEND_BLNET = 'blnet'
+BACKEND_CMI = 'cmi'
 
 # Defaults
 DEFAULT_WEB_PORT = 80
 DEFAULT_TA_PORT = 40000
 DEFAULT_SCAN_INTERVAL = 360
+DEFAULT_TIMEOUT = 60
+DEFAULT_FULL_FETCH_INTERVAL = 3600
+DEFAULT_MIN_INTERVAL = 10
+DEFAULT_MAX_INTERVAL = 1800
+DEFAULT_BURST = 3
+DEFAULT_MAX_AGE = 900
+DEFAULT_WINDOW = 900
+DEFAULT_SAMPLES = 120
+# Factors applied to the interval of a domain in adaptive polling mode
+ADAPTIVE_SPEEDUP = 0.5
+ADAPTIVE_BACKOFF = 1.5
+# Minimal delay between two scheduled updates in seconds
+MIN_REFRESH_DELAY = 1
+# Delay between the initial updates of several devices in seconds
+START_STAGGER = 2
+# Interval the data logger is imported in if enabled
+IMPORT_LOGGER_INTERVAL = timedelta(hours=1)
+
+# Data handlers of all devices in hass.data, keyed by the device name
+DATA_KEY = f"DATA_{DOMAIN}"
+
+# Discovered entities and their last values, kept across restarts
+STORAGE_VERSION = 1
+STORAGE_KEY = f"{DOMAIN}_cache"
+# Seconds changes are collected before the cache is written
+CACHE_SAVE_DELAY = 60
+
+# Service setting several outputs at once
+SERVICE_SET_OUTPUTS = 'set_outputs'
+ATTR_DEVICE = 'device'
+ATTR_NODE = 'node'
+ATTR_OUTPUTS = 'outputs'
+# Modes of the service and the values the BL-NET expects for them
+OUTPUT_MODES = {'ON': 'EIN', 'OFF': 'AUS', 'AUTO': 'AUTO'}
+# Service returning the timings and counters of a device
+SERVICE_GET_DIAGNOSTICS = 'get_diagnostics'
+# Service importing the data logger into long-term statistics
+SERVICE_IMPORT_LOGGER = 'import_logger'
+
+# Names and units of the diagnostic sensors of the counters
+DIAGNOSTIC_COUNTERS = {
+    'requests': ('BLNET requests', None),
+    'bytes': ('BLNET received bytes', 'B'),
+    'failures': ('BLNET failures', None),
+    'timeouts': ('BLNET timeouts', None),
+}
+
+# Values of all entities after an update and the time it was applied.
+# A new snapshot replaces the previous one at once, so readers never see
+# a partly applied update.
+Snapshot = namedtuple('Snapshot', ('data', 'updated'))
+EMPTY_SNAPSHOT = Snapshot(MappingProxyType({}), None)
+
+# Smallest change of a value that is applied, a share of the current
+# value if relative
+Deadband = namedtuple('Deadband', ('value', 'relative'))
 
 # Unit and icon mappings
 UNIT_MAPPINGS = {
@@ -44,71 +145,280 @@ ICON_MAPPINGS = {
     'energy': 'mdi:power-plug'
 }
 
+SCAN_INTERVALS_SCHEMA = vol.Schema({
+    vol.Optional(domain): cv.positive_int for domain in DOMAINS
+})
+
+ADAPTIVE_SCHEMA = vol.Schema({
+    vol.Optional(CONF_MIN_INTERVAL, default=DEFAULT_MIN_INTERVAL): cv.positive_int,
+    vol.Optional(CONF_MAX_INTERVAL, default=DEFAULT_MAX_INTERVAL): cv.positive_int,
+    vol.Optional(CONF_BURST, default=DEFAULT_BURST): cv.positive_int,
+})
+
+
+def _deadband(value):
+    """Validate an absolute deadband or a relative one ending in %."""
+    relative = isinstance(value, str) and value.strip().endswith('%')
+    if relative:
+        value = value.strip()[:-1]
+    value = vol.All(vol.Coerce(float), vol.Range(min=0))(value)
+    return Deadband(value / 100 if relative else value, relative)
+
+
+DEADBAND_SCHEMA = vol.Schema({
+    **{vol.Optional(domain): _deadband
+       for domain in ('analog', 'speed', 'power', 'energy')},
+    # channels like "analog 3", or "2 analog 3" with several nodes
+    vol.Optional(CONF_CHANNELS, default={}): {cv.string: _deadband},
+    vol.Optional(CONF_MAX_AGE, default=DEFAULT_MAX_AGE): cv.positive_int,
+})
+
+
+ROLLING_SCHEMA = vol.Schema({
+    vol.Optional(CONF_WINDOW, default=DEFAULT_WINDOW): cv.positive_int,
+    vol.Optional(CONF_SAMPLES, default=DEFAULT_SAMPLES):
+        vol.All(vol.Coerce(int), vol.Range(min=2)),
+    # aggregates that get sensors, every channel gets one of each
+    vol.Required(CONF_SENSORS):
+        vol.All(cv.ensure_list, [vol.In(ROLLING_STATS)], vol.Length(min=1)),
+})
+
+
+def _derived_sources(derived):
+    """Validate that a derived channel has as many sources as it takes."""
+    count = DERIVED_KINDS[derived[CONF_TYPE]]
+    if count is not None and len(derived[CONF_SOURCES]) != count:
+        raise vol.Invalid(
+            f"A {derived[CONF_TYPE]} takes {count} sources, "
+            f"got {len(derived[CONF_SOURCES])}")
+    return derived
+
+
+def _unique_derived(derived):
+    """Validate that the derived channels of a device get distinct ids."""
+    ids = [slugify(entry[CONF_NAME]) for entry in derived]
+    if len(set(ids)) < len(ids):
+        raise vol.Invalid("Derived channels need distinct names")
+    return derived
+
+
+DERIVED_SCHEMA = vol.All(vol.Schema({
+    vol.Required(CONF_NAME): cv.string,
+    vol.Required(CONF_TYPE): vol.In(list(DERIVED_KINDS)),
+    # channels like "analog 3", or "2 analog 3" with several nodes
+    vol.Required(CONF_SOURCES): vol.All(
+        cv.ensure_list, [vol.Match(SOURCE_PATTERN)], vol.Length(min=1)),
+    vol.Optional(CONF_UNIT_OF_MEASUREMENT): cv.string,
+}), _derived_sources)
+
+
+def _unique_names(devices):
+    """Validate that several devices can be told apart by their names."""
+    names = [device.get(CONF_NAME) for device in devices]
+    if len(names) > 1 and (None in names or len(set(names)) < len(names)):
+        raise vol.Invalid("Several BL-NET devices need distinct names")
+    return devices
+
+
+DEVICE_SCHEMA = vol.Schema({
+    vol.Optional(CONF_NAME): cv.string,
+    vol.Required(CONF_RESOURCE): cv.url,
+    vol.Optional(CONF_PASSWORD): cv.string,
+    vol.Optional(CONF_BACKEND, default=BACKEND_BLNET):
+        vol.In([BACKEND_BLNET, BACKEND_CMI]),
+    vol.Optional(CONF_USERNAME, default=DEFAULT_USERNAME): cv.string,
+    vol.Optional(CONF_NODE): vol.Any(
+        cv.positive_int,
+        vol.All(cv.ensure_list, [cv.positive_int], vol.Length(min=1),
+                lambda nodes: list(dict.fromkeys(nodes)))),
+    vol.Optional(CONF_SCAN_INTERVAL, default=DEFAULT_SCAN_INTERVAL): cv.positive_int,
+    vol.Optional(CONF_SCAN_INTERVALS, default={}): SCAN_INTERVALS_SCHEMA,
+    vol.Optional(CONF_ADAPTIVE): ADAPTIVE_SCHEMA,
+    vol.Optional(CONF_TIMEOUT, default=DEFAULT_TIMEOUT): cv.positive_int,
+    vol.Optional(CONF_FULL_FETCH_INTERVAL,
+                 default=DEFAULT_FULL_FETCH_INTERVAL): cv.positive_int,
+    vol.Optional(CONF_WEB_PORT, default=DEFAULT_WEB_PORT): cv.positive_int,
+    vol.Optional(CONF_TA_PORT, default=DEFAULT_TA_PORT): cv.positive_int,
+    vol.Optional(CONF_USE_WEB, default=True): cv.boolean,
+    vol.Optional(CONF_USE_TA, default=False): cv.boolean,
+    vol.Optional(CONF_CAPTURE): cv.string,
+    vol.Optional(CONF_IMPORT_LOGGER, default=False): cv.boolean,
+    vol.Optional(CONF_DEADBAND): DEADBAND_SCHEMA,
+    vol.Optional(CONF_ROLLING): ROLLING_SCHEMA,
+    vol.Optional(CONF_DERIVED, default=[]):
+        vol.All(cv.ensure_list, [DERIVED_SCHEMA], _unique_derived),
+})
+
 CONFIG_SCHEMA = vol.Schema({
-    DOMAIN: vol.Schema({
-        vol.Required(CONF_RESOURCE): cv.url,
-        vol.Optional(CONF_PASSWORD): cv.string,
-        vol.Optional(CONF_NODE): cv.positive_int,
-        vol.Optional(CONF_SCAN_INTERVAL, default=DEFAULT_SCAN_INTERVAL): cv.positive_int,
-        vol.Optional(CONF_WEB_PORT, default=DEFAULT_WEB_PORT): cv.positive_int,
-        vol.Optional(CONF_TA_PORT, default=DEFAULT_TA_PORT): cv.positive_int,
-        vol.Optional(CONF_USE_WEB, default=True): cv.boolean,
-        vol.Optional(CONF_USE_TA, default=False): cv.boolean,
-    }),
+    # a single device or a list of named devices
+    DOMAIN: vol.All(cv.ensure_list, [DEVICE_SCHEMA], _unique_names),
 }, extra=vol.ALLOW_EXTRA)
 
+GET_DIAGNOSTICS_SCHEMA = vol.Schema({
+    vol.Optional(ATTR_DEVICE): cv.string,
+})
+
+IMPORT_LOGGER_SCHEMA = vol.Schema({
+    vol.Optional(ATTR_DEVICE): cv.string,
+})
+
+SET_OUTPUTS_SCHEMA = vol.Schema({
+    vol.Optional(ATTR_DEVICE): cv.string,
+    vol.Optional(ATTR_NODE): cv.positive_int,
+    vol.Required(ATTR_OUTPUTS): vol.Schema({
+        vol.All(vol.Coerce(int), vol.Range(min=1, max=15)):
+            vol.All(cv.string, vol.Upper, vol.In(OUTPUT_MODES)),
+    }),
+})
+
 
-def setup(hass, config):
+async def async_setup(hass, config):
     """Set up the BLNET component."""
-    from pyblnet import BLNET
+    hass.data[DATA_KEY] = {}
+    # Connecting probes the devices, do it for all of them at once
+    results = await asyncio.gather(*(
+        async_setup_device(hass, conf) for conf in config[DOMAIN]
+    ))
+    coordinators = [
+        coordinator for coordinator in results if coordinator is not None
+    ]
+    # Stagger the initial polls, the devices are polled independently later
+    for index, coordinator in enumerate(coordinators):
+        coordinator.async_start(index * START_STAGGER)
+
+    async def async_set_outputs(call):
+        """Set several outputs of a device and report the result of each."""
+        device = call.data.get(ATTR_DEVICE)
+        data_handler = hass.data[DATA_KEY].get(device)
+        if data_handler is None:
+            raise HomeAssistantError(f"Unknown BL-NET device {device}")
+        outputs = {
+            switch_id: OUTPUT_MODES[mode]
+            for switch_id, mode in call.data[ATTR_OUTPUTS].items()
+        }
+        results = await data_handler.async_set_outputs(
+            outputs, call.data.get(ATTR_NODE))
+        return {ATTR_OUTPUTS: {
+            str(switch_id): result for switch_id, result in results.items()
+        }}
+
+    async def async_get_diagnostics(call):
+        """Return the timings of the update stages and the counters."""
+        device = call.data.get(ATTR_DEVICE)
+        data_handler = hass.data[DATA_KEY].get(device)
+        if data_handler is None:
+            raise HomeAssistantError(f"Unknown BL-NET device {device}")
+        return data_handler.diagnostics_report()
+
+    async def async_import(call):
+        """Import the data logger into long-term statistics."""
+        device = call.data.get(ATTR_DEVICE)
+        data_handler = hass.data[DATA_KEY].get(device)
+        if data_handler is None:
+            raise HomeAssistantError(f"Unknown BL-NET device {device}")
+        return await data_handler.coordinator.async_import_logger()
+
+    if coordinators:
+        hass.services.async_register(
+            DOMAIN, SERVICE_SET_OUTPUTS, async_set_outputs,
+            schema=SET_OUTPUTS_SCHEMA,
+            supports_response=SupportsResponse.OPTIONAL,
+        )
+        hass.services.async_register(
+            DOMAIN, SERVICE_GET_DIAGNOSTICS, async_get_diagnostics,
+            schema=GET_DIAGNOSTICS_SCHEMA,
+            supports_response=SupportsResponse.ONLY,
+        )
+        hass.services.async_register(
+            DOMAIN, SERVICE_IMPORT_LOGGER, async_import,
+            schema=IMPORT_LOGGER_SCHEMA,
+            supports_response=SupportsResponse.OPTIONAL,
+        )
+    return bool(coordinators)
 
+
+async def async_setup_device(hass, conf):
+    """Set up a single BL-NET and return the coordinator polling it."""
     # Extract configuration
-    conf = config[DOMAIN]
+    name = conf.get(CONF_NAME)
     resource = conf.get(CONF_RESOURCE)
     password = conf.get(CONF_PASSWORD)
     can_node = conf.get(CONF_NODE)
-    scan_interval = conf.get(CONF_SCAN_INTERVAL, DEFAULT_SCAN_INTERVAL)
+    timeout = conf.get(CONF_TIMEOUT, DEFAULT_TIMEOUT)
     web_port = conf.get(CONF_WEB_PORT, DEFAULT_WEB_PORT)
     ta_port = conf.get(CONF_TA_PORT, DEFAULT_TA_PORT)
     use_web = conf.get(CONF_USE_WEB, True)
     use_ta = conf.get(CONF_USE_TA, False)
+    backend = conf.get(CONF_BACKEND, BACKEND_BLNET)
+    capture = conf.get(CONF_CAPTURE)
+    if capture is not None:
+        capture = hass.config.path(capture)
 
     _LOGGER.debug(
-        f"Setting up BLNET with: resource={resource}, web_port={web_port}, "
-        f"ta_port={ta_port}, use_web={use_web}, use_ta={use_ta}"
+        f"Setting up BLNET {name} with: resource={resource}, backend={backend}, "
+        f"web_port={web_port}, ta_port={ta_port}, use_web={use_web}, "
+        f"use_ta={use_ta}"
     )
 
+    store = Store(hass, STORAGE_VERSION,
+                  STORAGE_KEY if name is None else f"{STORAGE_KEY}_{slugify(name)}")
+    cache = await store.async_load()
+
     blnet_connector = BLNETConnector(
         resource=resource,
         password=password,
         web_port=web_port,
         ta_port=ta_port,
         use_web=use_web,
-        use_ta=use_ta
+        use_ta=use_ta,
+        backend=backend,
+        username=conf.get(CONF_USERNAME, DEFAULT_USERNAME),
+        nodes=can_node,
+        capture=capture,
     )
-    
-    try:
-        blnet = blnet_connector.connect()
-    except (ValueError, AssertionError) as ex:
-        _LOGGER.error(f"Could not connect to BLNET at {resource}: {ex}")
-        return False
+
+    if cache is None:
+        try:
+            # Probing the device is blocking I/O, keep it off the event loop
+            blnet = await hass.async_add_executor_job(blnet_connector.connect)
+        except (ValueError, AssertionError, ConnectionError) as ex:
+            _LOGGER.error(f"Could not connect to BLNET at {resource}: {ex}")
+            return None
+    else:
+        # The entities of the last run are created right away, the first
+        # update connects to the device in the background
+        blnet = None
 
     # Initialize the data handler
-    data_handler = BLNETDataHandler(blnet, can_node, hass, conf)
-    hass.data[f"DATA_{DOMAIN}"] = data_handler
+    data_handler = BLNETDataHandler(
+        blnet, can_node, hass, conf, stats=blnet_connector.stats,
+        connect=blnet_connector.connect)
+    data_handler.store = store
+    hass.data[DATA_KEY][name] = data_handler
+    if cache is not None:
+        data_handler.async_restore(cache)
+
+    # Set up periodic updates, started once all devices are connected
+    coordinator = BLNETCoordinator(
+        hass, data_handler, timeout, conf.get(CONF_IMPORT_LOGGER, False))
 
-    # Set up periodic updates
-    update_handler = BLNETUpdateHandler(hass, data_handler, scan_interval)
-    update_handler.schedule_updates()
+    async def async_shutdown(event):
+        """Stop polling and log out of the BL-NET."""
+        coordinator.async_stop()
+        await hass.async_add_executor_job(blnet_connector.close)
 
-    return True
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_shutdown)
+
+    return coordinator
 
 
 class BLNETConnector:
     """Handles connection to BLNET device."""
     
     def __init__(self, resource, password=None, web_port=DEFAULT_WEB_PORT,
-                 ta_port=DEFAULT_TA_PORT, use_web=True, use_ta=False):
+                 ta_port=DEFAULT_TA_PORT, use_web=True, use_ta=False,
+                 backend=BACKEND_BLNET, username=DEFAULT_USERNAME,
+                 nodes=None, capture=None):
         """Initialize the connector with explicit parameters."""
         self.resource = resource
         self.password = password
@@ -116,18 +426,69 @@ class BLNETConnector:
         self.ta_port = ta_port
         self.use_web = use_web
         self.use_ta = use_ta
+        self.backend = backend
+        self.username = username
+        # several CAN nodes read the frames of the direct connection in order
+        self.nodes = nodes if isinstance(nodes, (list, tuple)) else [nodes]
+        self.session = None
+        self.client = None
+        # records the raw answers of the device to this file if set
+        self.capture = None if capture is None else CaptureWriter(capture)
+        # timings and counters of the requests to the device
+        self.stats = CycleStats()
 
     def connect(self):
-        """Create and return BLNET connection."""
-        from pyblnet import BLNET
-        return BLNET(
-            self.resource,
-            password=self.password,
-            web_port=self.web_port,
-            ta_port=self.ta_port,
-            use_web=self.use_web,
-            use_ta=self.use_ta
+        """Create and return the backend reading the configured device."""
+        if self.backend == BACKEND_CMI:
+            self.client = self._connect_cmi()
+            connections = (self.client,)
+        else:
+            self.client = self._connect_blnet()
+            connections = (self.client, self.client.session, self.client.direct)
+        for connection in connections:
+            if connection is not None:
+                connection.capture = self.capture
+                connection.stats = self.stats
+        return self.client
+
+    def _connect_cmi(self):
+        """Create a backend using the JSON API of a C.M.I."""
+        client = CMIBackend(
+            f"{self.resource}:{self.web_port}",
+            username=self.username, password=self.password
         )
+        client.probe()
+        return client
+
+    def _connect_blnet(self):
+        """Create a BL-NET backend sharing one web session."""
+        direct = None
+        if self.use_web:
+            self.session = BLNETWebSession(
+                f"{self.resource}:{self.web_port}", password=self.password
+            )
+            self.session.probe()
+        if self.use_ta:
+            # The address might not have a resulting hostname
+            # especially not if not prefixed with http://
+            host = urlparse(self.resource).hostname or self.resource
+            direct = BLNETDirectConnection(host, self.ta_port)
+            try:
+                direct.probe()
+            except ConnectionError as ex:
+                if self.session is None:
+                    raise
+                # Fetches keep trying it and use the web interface meanwhile
+                _LOGGER.warning(f"{ex}, using the web interface for now")
+        direct_frames = {node: frame for frame, node in enumerate(self.nodes)}
+        return BLNETClient(self.session, direct, direct_frames=direct_frames)
+
+    def close(self):
+        """Log out and close all connections of the backend."""
+        if self.client is not None:
+            self.client.close()
+        if self.capture is not None:
+            self.capture.close()
 
     def get_error_message(self, exception, resource):
         """Generate appropriate error message."""
@@ -139,180 +500,1105 @@ class BLNETConnector:
 class BLNETDataHandler:
     """Handles data operations for BLNET."""
 
-    def __init__(self, blnet, node, hass, config):
-        """Initialize the data handler."""
+    def __init__(self, blnet, node, hass, config, stats=None, connect=None):
+        """Initialize the data handler.
+
+        Without a backend, connect is called to create it on the first fetch.
+        """
         self.blnet = blnet
-        self.node = node
-        self.data = {}
-        self._last_updated = None
+        self._connect = connect
+        # name of the device, None if it is the only one
+        self.name = config.get(CONF_NAME)
+        # all polled CAN nodes, the first one is the default for commands
+        self.nodes = list(node) if isinstance(node, (list, tuple)) else [node]
+        self.node = self.nodes[0]
+        self.snapshot = EMPTY_SNAPSHOT
+        # values of the next snapshot, None until a value changed
+        self._pending_data = None
         self._hass = hass
         self._config = config
+        # records of all channels, keyed by node, domain and id, and by
+        # the blnet_id of their entities
+        self.channels = {}
+        self._channel_ids = {}
+        # keys of the channels that have entities
         self.sensors = set()
+        # callbacks of entities, keyed by their blnet_id, and of the
+        # sensors of rolling aggregates, which also hear of new aggregates
+        self._listeners = {}
+        self._rolling_listeners = {}
+        # entities that are notified on the next update in any case
+        self._force_update = set()
+        # callbacks adding entities to the already loaded platforms
+        self._platform_callbacks = {}
+        # discovered entities waiting for their platform to be loaded
+        self._pending_entities = {}
+        self._full_fetch_interval = timedelta(seconds=config.get(
+            CONF_FULL_FETCH_INTERVAL, DEFAULT_FULL_FETCH_INTERVAL))
+        self._last_full_fetch = None
+        # start of a full fetch that was not applied yet
+        self._full_fetch_started = None
+        scan_interval = config.get(CONF_SCAN_INTERVAL, DEFAULT_SCAN_INTERVAL)
+        scan_intervals = config.get(CONF_SCAN_INTERVALS, {})
+        self.scan_intervals = {
+            domain: timedelta(seconds=scan_intervals.get(domain, scan_interval))
+            for domain in DOMAINS
+        }
+        # time of the last fetch of every domain
+        self._domain_updated = {}
+        # domains requested by the last fetch, even if it returned none of them
+        self._requested_domains = set()
+        # current intervals, they only differ in adaptive polling mode
+        self._intervals = dict(self.scan_intervals)
+        self._adaptive = config.get(CONF_ADAPTIVE)
+        # number of fast polls of the digital outputs left after a command
+        self._burst = 0
+        # changes of values smaller than their deadband are left out until
+        # the applied value is older than max_age
+        self._deadband = config.get(CONF_DEADBAND)
+        # recent samples of the numeric channels for rolling aggregates
+        self._rolling = config.get(CONF_ROLLING)
+        # channels computed from others after every update, keyed by the
+        # blnet_id of their record
+        self._derived = {}
+        for derived in config.get(CONF_DERIVED, []):
+            self._add_derivation(derived)
+        # set by the coordinator scheduling the updates of this handler
+        self.coordinator = None
+        # timings of the update stages, shared with the connections
+        self.stats = stats if stats is not None else CycleStats()
+        # data of the diagnostic sensors, keyed by their blnet_id
+        self.diagnostics = {}
+        # False while the device is not polled after repeated failures
+        self.available = True
+        # discovery infos of all entities, keyed by platform, and the Store
+        # they are persisted to with the last values
+        self._discovered = {}
+        self.store = None
+        # whether a save of the cache is scheduled, rescheduling it would
+        # postpone it for as long as the updates come more often
+        self._save_scheduled = False
+
+    @property
+    def data(self):
+        """Return the read-only values of the last update."""
+        return self.snapshot.data
 
     def last_updated(self):
         """Return the timestamp of the last update."""
-        return self._last_updated
+        return self.snapshot.updated
+
+    def _commit_update(self, updated):
+        """Replace the snapshot by the collected values in one step."""
+        data = self.snapshot.data
+        if self._pending_data is not None:
+            data = MappingProxyType(self._pending_data)
+        self.snapshot = Snapshot(data, updated)
+        self._pending_data = None
+
+    def channel(self, blnet_id):
+        """Return the record of the channel of an entity, None if unknown."""
+        return self._channel_ids.get(blnet_id)
+
+    def _channel(self, node, domain, key):
+        """Return the record of a channel, indexing it when first seen."""
+        channel = self.channels.get((node, domain, key))
+        if channel is None:
+            channel = Channel(node, domain, key, self._blnet_id(node, domain, key),
+                              ICON_MAPPINGS.get(domain))
+            if self._deadband is not None:
+                channel.deadband = self._channel_deadband(node, domain, key)
+            if self._rolling is not None and domain in UNIT_MAPPINGS:
+                channel.samples = SampleBuffer(self._rolling[CONF_SAMPLES])
+            self.channels[channel.key] = channel
+            self._channel_ids[channel.blnet_id] = channel
+        return channel
+
+    def _add_derivation(self, derived):
+        """Index the record of a derived channel of the configuration."""
+        derivation = Derivation(
+            derived[CONF_TYPE], derived[CONF_NAME],
+            [parse_source(source, self.node) for source in derived[CONF_SOURCES]],
+            derived.get(CONF_UNIT_OF_MEASUREMENT))
+        channel = self._channel(None, 'derived', slugify(derived[CONF_NAME]))
+        channel.name = derived[CONF_NAME]
+        channel.friendly_name = self._name(None, derived[CONF_NAME])
+        channel.icon = DERIVED_ICONS[derivation.kind]
+        derivation.channel = channel
+        self._derived[channel.blnet_id] = derivation
+
+    @callback
+    def async_add_listener(self, blnet_id, update_callback, rolling=False):
+        """Listen for changes of the data of a single entity, with rolling
+        also for changes of the rolling aggregates of its channel."""
+        channel = self._channel_ids.get(blnet_id)
+        newly_enabled = channel is not None and (
+            channel.domain not in self.enabled_domains(channel.node))
+        listeners = self._rolling_listeners if rolling else self._listeners
+        listeners.setdefault(blnet_id, []).append(update_callback)
+        if newly_enabled and self.coordinator is not None:
+            # the domain was not considered when scheduling the next update
+            self.coordinator.async_schedule_refresh()
+
+        @callback
+        def remove_listener():
+            listeners[blnet_id].remove(update_callback)
+            if not listeners[blnet_id]:
+                del listeners[blnet_id]
+
+        return remove_listener
+
+    @callback
+    def async_register_platform(self, platform, add_entities):
+        """Register the callback adding discovered entities to a platform."""
+        self._platform_callbacks[platform] = add_entities
+        add_entities(self._pending_entities.pop(platform, []))
 
-    def turn_off(self, switch_id):
+    @callback
+    def async_set_available(self, available):
+        """Mark the values of all entities as (un)available."""
+        if available == self.available:
+            return
+        self.available = available
+        self._notify_listeners(set(self._listeners) | set(self._rolling_listeners))
+
+    def _notify_listeners(self, changed, rolled=()):
+        """Call the listeners of all entities whose data changed, and those
+        of the rolling aggregates that changed."""
+        for blnet_id in changed:
+            for update_callback in self._listeners.get(blnet_id, ()):
+                update_callback()
+            for update_callback in self._rolling_listeners.get(blnet_id, ()):
+                update_callback()
+        for blnet_id in rolled:
+            if blnet_id in changed:
+                continue
+            for update_callback in self._rolling_listeners.get(blnet_id, ()):
+                update_callback()
+        _LOGGER.debug(f"Notified {len(changed)} changed entities")
+
+    def turn_off(self, switch_id, node=None):
         """Turn off a switch."""
         _LOGGER.debug(f"Turning off switch {switch_id}")
         try:
-            self.blnet.turn_off(switch_id, self.node)
+            node = self.node if node is None else node
+            self.blnet.turn_off(switch_id, node)
             return True
         except Exception as ex:
             _LOGGER.error(f"Error turning off switch {switch_id}: {ex}")
             return False
 
-    def turn_on(self, switch_id):
+    def turn_on(self, switch_id, node=None):
         """Turn on a switch."""
         _LOGGER.debug(f"Turning on switch {switch_id}")
         try:
-            self.blnet.turn_on(switch_id, self.node)
+            node = self.node if node is None else node
+            self.blnet.turn_on(switch_id, node)
             return True
         except Exception as ex:
             _LOGGER.error(f"Error turning on switch {switch_id}: {ex}")
             return False
 
-    def turn_auto(self, switch_id):
+    def turn_auto(self, switch_id, node=None):
         """Set switch to auto mode."""
         _LOGGER.debug(f"Setting switch {switch_id} to auto mode")
         try:
-            self.blnet.turn_auto(switch_id, self.node)
+            node = self.node if node is None else node
+            self.blnet.turn_auto(switch_id, node)
             return True
         except Exception as ex:
             _LOGGER.error(f"Error setting switch {switch_id} to auto: {ex}")
             return False
 
+    def set_outputs(self, outputs, node=None):
+        """Set several outputs of a node to EIN, AUS or AUTO at once,
+        return whether setting each of them succeeded."""
+        _LOGGER.debug(f"Setting outputs {outputs}")
+        node = self.node if node is None else node
+        try:
+            return self.blnet.set_outputs(outputs, node)
+        except Exception as ex:
+            _LOGGER.error(f"Error setting outputs {sorted(outputs)}: {ex}")
+            return {switch_id: False for switch_id in outputs}
+
+    async def async_turn_off(self, switch_id, node=None):
+        """Queue turning off a switch and return whether it succeeded."""
+        return (await self.async_set_outputs({switch_id: 'AUS'}, node))[switch_id]
+
+    async def async_turn_on(self, switch_id, node=None):
+        """Queue turning on a switch and return whether it succeeded."""
+        return (await self.async_set_outputs({switch_id: 'EIN'}, node))[switch_id]
+
+    async def async_turn_auto(self, switch_id, node=None):
+        """Queue setting a switch to auto mode and return whether it succeeded."""
+        return (await self.async_set_outputs({switch_id: 'AUTO'}, node))[switch_id]
+
+    async def async_set_outputs(self, outputs, node=None):
+        """Queue setting several outputs of a node, return whether setting
+        each of them succeeded."""
+        node = self.node if node is None else node
+        if self.coordinator is None:
+            results = await self._hass.async_add_executor_job(
+                self.set_outputs, outputs, node)
+            self.async_outputs_written(
+                [switch_id for switch_id, result in results.items() if result],
+                node)
+            return results
+        results = await asyncio.gather(*(
+            self.coordinator.async_write(value, switch_id, node)
+            for switch_id, value in outputs.items()
+        ))
+        return dict(zip(outputs, results))
+
+    @callback
+    def async_outputs_written(self, switch_ids, node=None):
+        """Make sure the next updates pick up switched outputs.
+
+        The commands run in the executor, but the updates clear the forced
+        outputs on the event loop, so they are marked here.
+        """
+        if not switch_ids:
+            return
+        node = self.node if node is None else node
+        self._force_update.update(
+            self._blnet_id(node, 'digital', switch_id) for switch_id in switch_ids)
+        if self._adaptive:
+            self._burst = self._adaptive[CONF_BURST]
+            if self.coordinator is not None:
+                self.coordinator.async_schedule_refresh()
+
     def update(self):
         """Update all data and handle sensor discovery."""
-        self._last_updated = datetime.now()
-        data = self._fetch_data()
-        self._update_sensor_data(data)
-        self._discover_new_devices(data)
+        data = self.fetch()
+        self.process(data)
         return data
 
-    def _fetch_data(self):
-        """Fetch raw data from BLNET device."""
-        return self.blnet.fetch(self.node)
-
-    def _update_sensor_data(self, data):
-        """Update data for existing sensors."""
+    def process(self, data):
+        """Apply completely fetched data, keyed by node, and handle discovery."""
+        now = datetime.now()
+        if self._full_fetch_started is not None:
+            if all(data.get(node) for node in self.nodes):
+                self._last_full_fetch = self._full_fetch_started
+            else:
+                # a node that had no values yet, like one waiting for its
+                # turn at a C.M.I., is asked again by the next update
+                self._last_full_fetch = (self._full_fetch_started
+                                         - self._full_fetch_interval
+                                         + self.update_interval)
+            self._full_fetch_started = None
         _LOGGER.info("Updating sensor data...")
-        self._update_domain_sensors(data)
-        self._update_digital_sensors(data)
+        changed = set()
+        domains = set()
+        with self.stats.timer('sensors'):
+            for node, node_data in data.items():
+                self._update_sensor_data(node, node_data, changed)
+                domains.update(node_data)
+            self._update_derived(changed, now)
+            self._commit_update(now)
+            rolled = self._update_rolling(now)
+        self._force_update.clear()
+        # the first fetch of a domain tells nothing about its dynamics
+        self._adapt_intervals(
+            [domain for domain in domains if domain in self._domain_updated],
+            changed)
+        # a backend that has no values of a requested domain, like the web
+        # interface for speed, power and energy, is not asked again until
+        # the domain is due
+        for domain in domains | self._requested_domains:
+            self._domain_updated[domain] = now
+        self._requested_domains = set()
+        with self.stats.timer('discovery'):
+            self._discover_new_devices(data)
+        with self.stats.timer('dispatch'):
+            self._notify_listeners(changed, rolled)
+        self._schedule_save(changed)
+
+    def _schedule_save(self, changed):
+        """Save the cache a while after the first change since the last save."""
+        if self.store is None or not changed or self._save_scheduled:
+            return
+        self._save_scheduled = True
+        self.store.async_delay_save(self._saved_data, CACHE_SAVE_DELAY)
+
+    def _saved_data(self):
+        """Return the cache for the Store, later changes schedule the next save."""
+        self._save_scheduled = False
+        return self._cache_data()
+
+    def _cache_data(self):
+        """Return the discovered entities and their last values."""
+        return {
+            'entities': self._discovered,
+            'data': {
+                blnet_id: dict(entry) for blnet_id, entry in self.data.items()
+            },
+        }
+
+    @callback
+    def async_restore(self, cache):
+        """Create the entities of a previous run with their last values."""
+        try:
+            entities = {
+                platform: list(discovered)
+                for platform, discovered in cache['entities'].items()
+            }
+            data = {
+                blnet_id: MappingProxyType(dict(entry))
+                for blnet_id, entry in cache['data'].items()
+            }
+            restored = {
+                platform: [disc_info for disc_info in discovered
+                           if self._cached_key(disc_info) is not None]
+                for platform, discovered in entities.items()
+            }
+            keys = {
+                self._cached_key(disc_info)
+                for discovered in restored.values() for disc_info in discovered
+            }
+        except (KeyError, TypeError, ValueError, AttributeError) as ex:
+            _LOGGER.warning(f"Ignoring invalid BLNET cache: {ex}")
+            return
+        dropped = sum(map(len, entities.values())) - sum(map(len, restored.values()))
+        if dropped:
+            _LOGGER.info(f"Dropped {dropped} cached BLNET entities that no "
+                         f"longer match the configuration")
+        blnet_ids = {
+            disc_info['blnet_id']
+            for discovered in restored.values() for disc_info in discovered
+        }
+        data = {
+            blnet_id: entry for blnet_id, entry in data.items()
+            if blnet_id in blnet_ids
+        }
+        self.snapshot = Snapshot(
+            MappingProxyType({**self.snapshot.data, **data}),
+            self.snapshot.updated)
+        now = datetime.now()
+        for key in keys:
+            channel = self._channel(*key)
+            entry = data.get(channel.blnet_id, {})
+            channel.friendly_name = entry.get('friendly_name')
+            channel.value = entry.get('value')
+            channel.mode = entry.get('mode')
+            channel.unit_of_measurement = entry.get('unit_of_measurement')
+            channel.applied = now
+            self.sensors.add(key)
+        for platform, discovered in restored.items():
+            if not discovered:
+                continue
+            self._discovered.setdefault(platform, []).extend(discovered)
+            self._add_entities(platform, discovered)
+        _LOGGER.info(f"Restored {len(keys)} BLNET entities from the cache")
+
+    def _cached_key(self, disc_info):
+        """Return the key of the channel of a cached entity, None if the
+        entity does not match the configuration any more."""
+        domain, key = disc_info['domain'], disc_info['id']
+        node = disc_info.get('node')
+        if domain == 'derived':
+            # derived channels belong to no node
+            if node is not None:
+                return None
+        elif domain not in DOMAINS:
+            return None
+        elif len(self.nodes) > 1:
+            if node not in self.nodes:
+                return None
+        elif node is not None:
+            return None
+        else:
+            node = self.node
+        if disc_info['blnet_id'] != self._blnet_id(node, domain, key):
+            return None
+        if domain == 'derived' and disc_info['blnet_id'] not in self._derived:
+            return None
+        stat = disc_info.get('rolling')
+        if stat is not None and (self._rolling is None
+                                 or stat not in self._rolling[CONF_SENSORS]):
+            return None
+        return node, domain, key
+
+    def fetch(self):
+        """Fetch raw data of all nodes from BLNET device.
+
+        This blocks, so the coordinator runs it in the executor and passes
+        the result to process on the event loop.
+        """
+        pages = self._pages_to_fetch()
+        self._requested_domains = {
+            domain for node_pages in pages.values() for page in node_pages
+            for domain in PAGE_DOMAINS[page]
+        }
+        data = {}
+        try:
+            if self.blnet is None:
+                with self.stats.timer('connect'):
+                    self.blnet = self._connect()
+            with self.stats.timer('fetch'):
+                for node in self._node_order():
+                    if not pages[node]:
+                        continue
+                    _LOGGER.debug(
+                        f"Fetching pages {sorted(pages[node])} of node {node}")
+                    data[node] = self.blnet.fetch(node, pages[node])
+        except Exception:
+            self.stats.count('failures')
+            raise
+        return data
+
+    def fetch_outputs(self, nodes):
+        """Fetch only the digital outputs of the given nodes, for
+        process_outputs."""
+        return {node: self.blnet.fetch(node, {PAGE_DIGITAL}) for node in nodes}
+
+    def process_outputs(self, data):
+        """Apply read back digital outputs, keyed by node.
+
+        Unlike process this leaves the schedule of the regular updates
+        and the discovery alone.
+        """
+        changed = set()
+        for node, node_data in data.items():
+            self._update_digital_sensors(node, node_data, changed)
+        self._commit_update(datetime.now())
+        self._force_update.clear()
+        self._notify_listeners(changed)
+        self._schedule_save(changed)
+
+    def _node_order(self):
+        """Return the nodes, starting with the one selected on the BL-NET."""
+        # every node change costs a request, so the node left selected
+        # by the previous fetch or command is fetched first
+        active = getattr(self.blnet, 'node', None)
+        if active not in self.nodes:
+            return list(self.nodes)
+        index = self.nodes.index(active)
+        return self.nodes[index:] + self.nodes[:index]
+
+    def _blnet_id(self, node, domain, key):
+        """Return the identifier of a channel, namespaced by the device
+        name and by node if several nodes are polled."""
+        prefix = DOMAIN if self.name is None else f'{DOMAIN} {self.name}'
+        if len(self.nodes) > 1 and node is not None:
+            return f'{prefix} {node} {domain} {key}'
+        return f'{prefix} {domain} {key}'
+
+    def _name(self, node, name):
+        """Return the name of a channel, prefixed by the device name and
+        by the node if several nodes are polled."""
+        if name is None:
+            return name
+        if len(self.nodes) > 1 and node is not None:
+            name = f'Node {node} {name}'
+        if self.name is not None:
+            name = f'{self.name} {name}'
+        return name
+
+    def enabled_domains(self, node=None):
+        """Return the domains with at least one enabled entity,
+        optionally restricted to a single node.
+
+        Derived channels enable the domains of their sources."""
+        keys = []
+        for blnet_id in [*self._listeners, *self._rolling_listeners]:
+            if blnet_id in self._derived:
+                keys.extend(self._derived[blnet_id].keys)
+            elif blnet_id in self._channel_ids:
+                keys.append(self._channel_ids[blnet_id].key)
+        return {
+            domain for channel_node, domain, _ in keys
+            if domain in DOMAINS and (node is None or channel_node == node)
+        }
+
+    @property
+    def update_interval(self):
+        """Return the shortest interval a domain is currently polled in."""
+        return min(self.interval(domain) for domain in DOMAINS)
+
+    def interval(self, domain):
+        """Return the current poll interval of a domain."""
+        if domain == 'digital' and self._burst > 0:
+            return timedelta(seconds=self._adaptive[CONF_MIN_INTERVAL])
+        return self._intervals[domain]
 
-    def _update_domain_sensors(self, data):
+    def _due_at(self, domain, now):
+        """Return when the domain has to be fetched next."""
+        updated = self._domain_updated.get(domain)
+        if updated is None:
+            return now
+        return updated + self.interval(domain)
+
+    def due_domains(self, now):
+        """Return the domains whose scan interval has passed."""
+        due = {domain for domain in DOMAINS if self._due_at(domain, now) <= now}
+        if due:
+            # Domains that would be due before the next update are fetched
+            # right away, so that they share the requests of this one
+            merge_until = now + self.update_interval
+            due.update(domain for domain in DOMAINS
+                       if self._due_at(domain, now) <= merge_until)
+        return due
+
+    def next_update(self, now):
+        """Return when the next fetch is necessary."""
+        if self._last_full_fetch is None:
+            return now
+        due_times = [self._due_at(domain, now) for domain in self.enabled_domains()]
+        due_times.append(self._last_full_fetch + self._full_fetch_interval)
+        return min(due_times)
+
+    def _adapt_intervals(self, domains, changed):
+        """Poll moving domains faster and stable ones slower."""
+        if not self._adaptive:
+            return
+        if 'digital' in domains and self._burst > 0:
+            self._burst -= 1
+        min_interval = timedelta(seconds=self._adaptive[CONF_MIN_INTERVAL])
+        max_interval = timedelta(seconds=self._adaptive[CONF_MAX_INTERVAL])
+        changed_domains = {self._channel_ids[blnet_id].domain
+                           for blnet_id in changed if blnet_id in self._channel_ids}
+        for domain in domains:
+            if domain in changed_domains:
+                interval = self._intervals[domain] * ADAPTIVE_SPEEDUP
+            else:
+                interval = self._intervals[domain] * ADAPTIVE_BACKOFF
+            self._intervals[domain] = min(max(interval, min_interval), max_interval)
+        _LOGGER.debug(f"Adapted poll intervals: {self._intervals}")
+
+    def _pages_to_fetch(self):
+        """Return the pages of every node backing enabled entities that
+        are due, or all of them if it is time to look for new channels."""
+        now = datetime.now()
+        if (self._last_full_fetch is None
+                or now - self._last_full_fetch >= self._full_fetch_interval):
+            # only counts once applied, a failed full fetch is repeated
+            self._full_fetch_started = now
+            return {node: set(PAGE_DOMAINS) for node in self.nodes}
+        due = self.due_domains(now)
+        return {
+            node: pages_for_domains(due & self.enabled_domains(node))
+            for node in self.nodes
+        }
+
+    def _update_sensor_data(self, node, data, changed):
+        """Update data for existing sensors of a node."""
+        self._update_domain_sensors(node, data, changed)
+        self._update_digital_sensors(node, data, changed)
+
+    def _update_domain_sensors(self, node, data, changed):
         """Update sensors for all domains."""
+        now = datetime.now()
         for domain in ['analog', 'speed', 'power', 'energy']:
             for key, sensor in data.get(domain, {}).items():
-                self._update_single_sensor(domain, key, sensor)
+                self._update_single_sensor(node, domain, key, sensor, changed, now)
 
-    def _update_single_sensor(self, domain, key, sensor):
+    def _update_single_sensor(self, node, domain, key, sensor, changed, now=None):
         """Update a single sensor's attributes."""
-        entity_id = f'{DOMAIN} {domain} {key}'
-        self.data[entity_id] = {
-            'value': sensor.get('value'),
-            'unit_of_measurement': sensor.get('unit_of_measurement', UNIT_MAPPINGS[domain]),
-            'friendly_name': sensor.get('name'),
-            'icon': ICON_MAPPINGS[domain]
-        }
+        channel = self._channel(node, domain, key)
+        renamed = self._rename(channel, sensor.get('name'))
+        unit = sensor.get('unit_of_measurement', UNIT_MAPPINGS[domain])
+        value = sensor.get('value')
+        now = now or datetime.now()
+        if channel.samples is not None:
+            number = as_number(value)
+            if number is not None:
+                channel.samples.append(now.timestamp(), number)
+        if (channel.applied is not None and not renamed
+                and unit == channel.unit_of_measurement):
+            if value == channel.value and channel.blnet_id not in self._force_update:
+                return
+            if self._within_deadband(channel, value, now):
+                return
+        channel.unit_of_measurement = unit
+        channel.value = value
+        channel.applied = now
+        self._apply(channel, changed)
+
+    def _update_rolling(self, now):
+        """Aggregate the recent samples of all channels, return the
+        blnet_ids of the channels whose aggregates changed."""
+        rolled = set()
+        if self._rolling is None:
+            return rolled
+        since = now.timestamp() - self._rolling[CONF_WINDOW]
+        for channel in self.channels.values():
+            if channel.samples is None:
+                continue
+            rolling = channel.samples.aggregate(since)
+            if rolling != channel.rolling:
+                channel.rolling = rolling
+                rolled.add(channel.blnet_id)
+        return rolled
+
+    def _update_derived(self, changed, now):
+        """Compute the derived channels from the updated records in one
+        pass, applying those whose value changed."""
+        for derivation in self._derived.values():
+            channel = derivation.channel
+            sources = [self.channels.get(key) for key in derivation.keys]
+            if None in sources:
+                continue
+            # integrals grow with time, the others only change with a source
+            if (derivation.kind != 'integral' and channel.applied is not None
+                    and channel.blnet_id not in self._force_update
+                    and not any(source.blnet_id in changed for source in sources)):
+                continue
+            value = derivation.evaluate(sources, now)
+            unit = derivation.unit or derivation.default_unit(sources)
+            if (channel.applied is not None and value == channel.value
+                    and unit == channel.unit_of_measurement
+                    and channel.blnet_id not in self._force_update):
+                continue
+            channel.value = value
+            channel.unit_of_measurement = unit
+            channel.applied = now
+            self._apply(channel, changed)
 
-    def _update_digital_sensors(self, data):
+    def _channel_deadband(self, node, domain, key):
+        """Return the deadband of a channel, None if it has none."""
+        channel = (f'{node} {domain} {key}' if len(self.nodes) > 1
+                   else f'{domain} {key}')
+        return self._deadband[CONF_CHANNELS].get(channel, self._deadband.get(domain))
+
+    def _within_deadband(self, channel, value, now):
+        """Return whether a value changed too little to be applied, only
+        until the applied one reaches the maximum age."""
+        if (channel.deadband is None or channel.applied is None
+                or channel.blnet_id in self._force_update):
+            return False
+        if (now - channel.applied).total_seconds() >= self._deadband[CONF_MAX_AGE]:
+            return False
+        old, new = as_number(channel.value), as_number(value)
+        if old is None or new is None:
+            return False
+        deadband = channel.deadband
+        threshold = deadband.value * abs(old) if deadband.relative else deadband.value
+        return abs(new - old) < threshold
+
+    def _update_digital_sensors(self, node, data, changed):
         """Update digital sensors."""
+        now = datetime.now()
         for key, sensor in data.get('digital', {}).items():
-            entity_id = f'{DOMAIN} digital {key}'
-            self.data[entity_id] = {
-                'friendly_name': sensor.get('name'),
-                'mode': sensor.get('mode'),
-                'value': sensor.get('value')
-            }
+            channel = self._channel(node, 'digital', key)
+            renamed = self._rename(channel, sensor.get('name'))
+            mode, value = sensor.get('mode'), sensor.get('value')
+            if (channel.applied is not None and not renamed
+                    and mode == channel.mode and value == channel.value
+                    and channel.blnet_id not in self._force_update):
+                continue
+            channel.mode = mode
+            channel.value = value
+            channel.applied = now
+            self._apply(channel, changed)
+
+    def _rename(self, channel, name):
+        """Set the name of a channel, return whether its friendly name changed."""
+        if name == channel.name:
+            return False
+        channel.name = name
+        friendly_name = self._name(channel.node, name)
+        if friendly_name == channel.friendly_name:
+            return False
+        channel.friendly_name = friendly_name
+        return True
+
+    def _apply(self, channel, changed):
+        """Add the values of a changed channel to the next snapshot."""
+        if self._pending_data is None:
+            self._pending_data = dict(self.snapshot.data)
+        self._pending_data[channel.blnet_id] = MappingProxyType(channel.as_dict())
+        changed.add(channel.blnet_id)
+
+    def diagnostics_report(self):
+        """Return the timings, counters and poll intervals for tuning."""
+        report = self.stats.as_dict()
+        report['intervals'] = {
+            domain: self.interval(domain).total_seconds() for domain in DOMAINS
+        }
+        updated = self.snapshot.updated
+        report['last_updated'] = None if updated is None else updated.isoformat()
+        return report
+
+    @callback
+    def async_update_diagnostics(self):
+        """Publish the timings and counters to the diagnostic sensors."""
+        changed = set()
+        discovered = []
+        entries = {}
+        for stage in self.stats.stages:
+            summary = self.stats.summary(stage)
+            entries[stage] = (f'BLNET {stage} duration', {
+                'value': summary['last'],
+                'unit_of_measurement': 'ms',
+                'icon': 'mdi:timer-outline',
+                'attributes': summary,
+            })
+        for counter, (name, unit) in DIAGNOSTIC_COUNTERS.items():
+            entries[counter] = (name, {
+                'value': self.stats.counters[counter],
+                'unit_of_measurement': unit,
+                'icon': 'mdi:counter',
+            })
+        for key, (name, entry) in entries.items():
+            blnet_id = self._blnet_id(None, 'diagnostic', key.replace(' ', '_'))
+            entry['friendly_name'] = self._name(None, name)
+            if blnet_id not in self.diagnostics:
+                discovered.append({
+                    'name': entry['friendly_name'],
+                    'domain': 'diagnostic',
+                    'id': key,
+                    'device': self.name,
+                    'friendly_name': entry['friendly_name'],
+                    'blnet_id': blnet_id,
+                    'diagnostic': True,
+                })
+            if self.diagnostics.get(blnet_id) != entry:
+                self.diagnostics[blnet_id] = entry
+                changed.add(blnet_id)
+        if discovered:
+            self._add_entities('sensor', discovered)
+        self._notify_listeners(changed)
 
     def _discover_new_devices(self, data):
-        """Handle discovery of new devices."""
-        added_count = self._discover_sensors(data)
-        added_count += self._discover_digital_devices(data)
+        """Handle discovery of new devices of all nodes."""
+        discovered = {}
+        for node, node_data in data.items():
+            self._discover_sensors(node, node_data, discovered)
+            self._discover_digital_devices(node, node_data, discovered)
+        self._discover_derived(discovered)
+        added_count = 0
+        for platform, entities in discovered.items():
+            self._discovered.setdefault(platform, []).extend(entities)
+            self._add_entities(platform, entities)
+            added_count += len(entities)
         if added_count > 0:
             _LOGGER.info(f"Added {added_count} new devices")
 
-    def _discover_sensors(self, data):
-        """Discover and add new sensors."""
-        added_count = 0
+    def _add_entities(self, platform, entities):
+        """Add a batch of discovered entities to a platform."""
+        add_entities = self._platform_callbacks.get(platform)
+        if add_entities is not None:
+            add_entities(entities)
+        elif platform in self._pending_entities:
+            # The platform is already loading and will pick them up
+            self._pending_entities[platform].extend(entities)
+        else:
+            self._pending_entities[platform] = list(entities)
+            self._hass.async_create_task(async_load_platform(
+                self._hass, platform, DOMAIN, {'device': self.name},
+                self._config))
+
+    def _discover_sensors(self, node, data, discovered):
+        """Discover new sensors."""
         for domain in ['analog', 'speed', 'power', 'energy']:
-            for sensor_id in data[domain]:
-                if self._add_single_sensor(domain, sensor_id, data):
-                    added_count += 1
-        return added_count
-
-    def _add_single_sensor(self, domain, sensor_id, data):
-        """Add a single new sensor."""
-        name = data[domain][sensor_id].get('name')
-        blnet_id = '{} {} {}'.format(DOMAIN, domain, sensor_id)
-        if name in self.sensors:
-            return False
+            for sensor_id in data.get(domain, {}):
+                disc_info = self._add_single_sensor(node, domain, sensor_id, data)
+                if disc_info is not None:
+                    discovered.setdefault('sensor', []).append(disc_info)
+                    discovered['sensor'].extend(
+                        self._rolling_sensors(disc_info))
+
+    def _add_single_sensor(self, node, domain, sensor_id, data):
+        """Return the discovery info of a single new sensor."""
+        channel = self._channel(node, domain, sensor_id)
+        if channel.key in self.sensors:
+            return None
 
-        self.sensors.add(name)
+        self.sensors.add(channel.key)
+        name = channel.friendly_name
+        blnet_id = channel.blnet_id
         _LOGGER.info(f"Discovered {domain} sensor {sensor_id} in use, adding")
 
         disc_info = {
             'name': name,
             'domain': domain,
             'id': sensor_id,
+            'node': node if len(self.nodes) > 1 else None,
+            'device': self.name,
             'friendly_name': name,
             'blnet_id': blnet_id
         }
         _LOGGER.debug(f"Sensor data for {domain}[{sensor_id}]: {data[domain][sensor_id]} - Disc info: {disc_info}")
-        load_platform(self._hass, 'sensor', DOMAIN, disc_info, self._config)
-        return True
+        return disc_info
 
-    def _discover_digital_devices(self, data):
-        """Discover and add new digital devices."""
-        added_count = 0
-        for sensor_id in data['digital']:
-            if self._add_digital_device(sensor_id, data):
-                added_count += 1
-        return added_count
-
-    def _add_digital_device(self, sensor_id, data):
-        """Add a single new digital device."""
-        name = data['digital'][sensor_id].get('name')
-        blnet_id = '{} digital {}'.format(DOMAIN, sensor_id)
-        if name in self.sensors:
-            return False
+    def _rolling_sensors(self, disc_info):
+        """Return the discovery infos of the sensors of the rolling
+        aggregates of a channel."""
+        if self._rolling is None:
+            return []
+        return [
+            {**disc_info, 'name': f"{disc_info['name']} {stat}",
+             'friendly_name': f"{disc_info['friendly_name']} {stat}",
+             'rolling': stat}
+            for stat in self._rolling[CONF_SENSORS]
+        ]
+
+    def _discover_derived(self, discovered):
+        """Discover the derived channels once they have been computed."""
+        for derivation in self._derived.values():
+            channel = derivation.channel
+            if channel.applied is None or channel.key in self.sensors:
+                continue
+            self.sensors.add(channel.key)
+            _LOGGER.info(f"Computed derived sensor {channel.name}, adding")
+            discovered.setdefault('sensor', []).append({
+                'name': channel.friendly_name,
+                'domain': 'derived',
+                'id': channel.id,
+                'node': None,
+                'device': self.name,
+                'friendly_name': channel.friendly_name,
+                'blnet_id': channel.blnet_id
+            })
+
+    def _discover_digital_devices(self, node, data, discovered):
+        """Discover new digital devices."""
+        component = 'switch' if self.blnet.can_write else 'sensor'
+        for sensor_id in data.get('digital', {}):
+            disc_info = self._add_digital_device(node, sensor_id, data)
+            if disc_info is not None:
+                discovered.setdefault(component, []).append(disc_info)
 
-        self.sensors.add(name)
+    def _add_digital_device(self, node, sensor_id, data):
+        """Return the discovery info of a single new digital device."""
+        channel = self._channel(node, 'digital', sensor_id)
+        if channel.key in self.sensors:
+            return None
+
+        self.sensors.add(channel.key)
+        name = channel.friendly_name
+        blnet_id = channel.blnet_id
         _LOGGER.info(f"Discovered digital sensor {sensor_id} in use, adding")
 
-        disc_info = {
+        return {
             'name': name,
             'domain': 'digital',
             'id': sensor_id,
+            'node': node if len(self.nodes) > 1 else None,
+            'device': self.name,
             'friendly_name': name,
             'blnet_id': blnet_id
         }
-        component = 'switch' if self._config[CONF_USE_WEB] else 'sensor'
-        load_platform(self._hass, component, DOMAIN, disc_info, self._config)
-        return True
 
 
-class BLNETUpdateHandler:
-    """Handles periodic updates for BLNET."""
+class BLNETCoordinator:
+    """Schedules non-blocking updates for BLNET."""
 
-    def __init__(self, hass, data_handler, scan_interval):
+    def __init__(self, hass, data_handler, timeout=DEFAULT_TIMEOUT,
+                 import_logger=False):
         self.hass = hass
         self.data_handler = data_handler
-        self.scan_interval = scan_interval
-
-    def schedule_updates(self):
-        """Schedule periodic updates."""
-        def fetch_data(*_):
-            return self.data_handler.update()
-
-        # Initial update
-        fetch_data()
-        
-        # Schedule periodic updates
-        async_track_time_interval(
-            self.hass,
-            fetch_data,
-            timedelta(seconds=self.scan_interval)
+        self.timeout = timeout
+        self._job = None
+        self._unsub_refresh = None
+        self._stopped = False
+        # queued commands, keyed by output, and the future of their result
+        self._writes = {}
+        self._write_worker = None
+        self._write_job = None
+        # holds back updates of a device that stopped answering
+        self.breaker = CircuitBreaker()
+        # import of the data logger in progress and when to start the next
+        # one, if they are started regularly
+        self._import = None
+        self._next_import = None
+        if import_logger:
+            self._next_import = datetime.now()
+        data_handler.coordinator = self
+
+    @property
+    def running(self):
+        """Return whether a fetch is still in progress."""
+        return self._job is not None and not self._job.done()
+
+    def async_start(self, delay=0):
+        """Trigger the initial update, it schedules the following ones."""
+        if delay:
+            self.async_schedule_refresh(delay)
+        else:
+            self.hass.async_create_task(self._async_scheduled_refresh())
+
+    @callback
+    def async_stop(self, *_):
+        """Stop scheduling updates."""
+        self._stopped = True
+        if self._unsub_refresh is not None:
+            self._unsub_refresh()
+            self._unsub_refresh = None
+
+    @callback
+    def async_schedule_refresh(self, delay=None):
+        """Schedule the next update, by default when the next domain is due."""
+        if self._stopped:
+            return
+        if self._unsub_refresh is not None:
+            self._unsub_refresh()
+        if delay is None and self.breaker.is_open:
+            delay = self.breaker.remaining()
+        elif delay is None:
+            now = datetime.now()
+            delay = (self.data_handler.next_update(now) - now).total_seconds()
+        self._unsub_refresh = async_call_later(
+            self.hass, max(delay, MIN_REFRESH_DELAY),
+            self._async_scheduled_refresh
         )
+
+    async def _async_scheduled_refresh(self, *_):
+        """Update and schedule the next update."""
+        self._unsub_refresh = None
+        result = await self.async_refresh()
+        self.data_handler.async_update_diagnostics()
+        if result is None and not self.breaker.is_open:
+            # retry failed updates in the shortest regular interval
+            self.async_schedule_refresh(
+                self.data_handler.update_interval.total_seconds())
+        else:
+            self.async_schedule_refresh()
+
+    @property
+    def writing(self):
+        """Return whether a command is being sent."""
+        return self._write_job is not None and not self._write_job.done()
+
+    @callback
+    def async_write(self, value, switch_id, node):
+        """Queue setting a digital output to EIN, AUS or AUTO.
+
+        Returns a future of the result of the command. A command that is
+        still queued for the same output is replaced, its callers get the
+        result of the new one.
+        """
+        key = (node, switch_id)
+        if key in self._writes:
+            future = self._writes[key][1]
+        else:
+            future = asyncio.get_running_loop().create_future()
+        self._writes[key] = (value, future)
+        if self._write_worker is None or self._write_worker.done():
+            self._write_worker = self.hass.async_create_task(
+                self._async_process_writes())
+        return future
+
+    async def _async_process_writes(self):
+        """Send the queued commands between polls, all commands queued for
+        a node at once, and read back the switched outputs."""
+        while self._writes:
+            written = set()
+            while self._writes:
+                while self.running:
+                    await asyncio.wait([self._job])
+                node = next(iter(self._writes))[0]
+                batch = {
+                    switch_id: self._writes.pop((key_node, switch_id))
+                    for key_node, switch_id in list(self._writes)
+                    if key_node == node
+                }
+                outputs = {
+                    switch_id: value for switch_id, (value, _) in batch.items()
+                }
+                self._write_job = self.hass.async_add_executor_job(
+                    self.data_handler.set_outputs, outputs, node)
+                try:
+                    results = await self._write_job
+                except Exception as ex:
+                    _LOGGER.error(f"Error setting outputs {outputs}: {ex}")
+                    results = {}
+                switched = [
+                    switch_id for switch_id in batch if results.get(switch_id, False)
+                ]
+                if switched:
+                    written.add(node)
+                    self.data_handler.async_outputs_written(switched, node)
+                for switch_id, (_, future) in batch.items():
+                    if not future.done():
+                        future.set_result(switch_id in switched)
+            if written:
+                await self._async_refresh_outputs(written)
+
+    async def _async_refresh_outputs(self, nodes):
+        """Read back the digital outputs of the given nodes, the regular
+        updates are not rescheduled."""
+        while self.running:
+            await asyncio.wait([self._job])
+        self._write_job = self.hass.async_add_executor_job(
+            self.data_handler.fetch_outputs, nodes)
+        try:
+            data = await asyncio.wait_for(
+                asyncio.shield(self._write_job), self.timeout
+            )
+        except asyncio.TimeoutError:
+            _LOGGER.warning("Reading back BLNET outputs timed out")
+            return
+        except Exception as ex:
+            _LOGGER.error(f"Error reading back BLNET outputs: {ex}")
+            return
+        self.data_handler.process_outputs(data)
+
+    @callback
+    def _async_record_failure(self):
+        """Count a failed update, the entities become unavailable once the
+        device is left alone for a while."""
+        if self.breaker.record_failure():
+            _LOGGER.warning(
+                f"BLNET failed {self.breaker.failures} times in a row, "
+                f"retrying in {self.breaker.remaining():.0f} seconds"
+            )
+            self.data_handler.async_set_available(False)
+
+    async def async_refresh(self, *_):
+        """Fetch data in the executor and apply it on the event loop."""
+        if not self.breaker.allow():
+            _LOGGER.debug("BLNET is not answering, skipping update")
+            return None
+        while self.writing:
+            # let the command finish, the fetch then picks up its result
+            await asyncio.wait([self._write_job])
+        if self.running:
+            # A thread that timed out can not be interrupted, so we
+            # rather skip a cycle than running two fetches at once
+            _LOGGER.debug("Previous BLNET update still running, skipping")
+            return None
+
+        self._job = self.hass.async_add_executor_job(
+            self.data_handler.fetch
+        )
+        try:
+            data = await asyncio.wait_for(
+                asyncio.shield(self._job), self.timeout
+            )
+        except asyncio.TimeoutError:
+            _LOGGER.warning(
+                f"Fetching BLNET data timed out after {self.timeout} seconds"
+            )
+            self.data_handler.stats.count('timeouts')
+            self._async_record_failure()
+            return None
+        except Exception as ex:
+            _LOGGER.error(f"Error fetching BLNET data: {ex}")
+            self._async_record_failure()
+            return None
+
+        if self.breaker.is_open:
+            _LOGGER.info("BLNET answers again, resuming updates")
+        self.breaker.record_success()
+        self.data_handler.process(data)
+        self.data_handler.async_set_available(True)
+        if self._next_import is not None and datetime.now() >= self._next_import:
+            self._next_import = datetime.now() + IMPORT_LOGGER_INTERVAL
+            self.hass.async_create_task(self._async_scheduled_import())
+        return data
+
+    async def async_import_logger(self):
+        """Import the data logger into long-term statistics, an import
+        that is running already is awaited instead."""
+        if self._import is None or self._import.done():
+            self._import = self.hass.async_create_task(
+                async_import_logger(self.hass, self.data_handler))
+        return await asyncio.shield(self._import)
+
+    async def _async_scheduled_import(self):
+        """Import the data logger, logging failures."""
+        try:
+            await self.async_import_logger()
+        except Exception as ex:
+            _LOGGER.error(f"Error importing the BLNET data logger: {ex}")
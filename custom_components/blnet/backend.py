@@ -0,0 +1,51 @@
+"""
+Interface of the backends reading and writing values of a BL-NET
+
+A backend returns the values of a CAN node in the structure the data
+handler expects: a dict of domains (analog, digital, speed, energy,
+power), each mapping channel ids to dicts of name, value and optionally
+unit_of_measurement and mode.
+"""
+
+
+class BLNETBackend:
+    """Base class of the ways to access a BL-NET or a compatible gateway."""
+
+    @property
+    def can_write(self):
+        """Return whether the backend can switch digital outputs."""
+        return False
+
+    @property
+    def node(self):
+        """Return the CAN node currently selected on the device, if known."""
+        return None
+
+    def fetch(self, node=None, pages=None):
+        """
+        Fetch available data about selected node
+        (defaults to active node on the device)
+
+        Backends that read everything at once may ignore the pages.
+        """
+        raise NotImplementedError
+
+    def set_outputs(self, outputs, can_node=None):
+        """Set several digital outputs to EIN, AUS or AUTO, return whether
+        setting each of them succeeded."""
+        raise EnvironmentError(f"{type(self).__name__} can't set values")
+
+    def turn_on(self, digital_id, can_node=None):
+        """Turn the digital output on."""
+        raise EnvironmentError(f"{type(self).__name__} can't set values")
+
+    def turn_off(self, digital_id, can_node=None):
+        """Turn the digital output off."""
+        raise EnvironmentError(f"{type(self).__name__} can't set values")
+
+    def turn_auto(self, digital_id, can_node=None):
+        """Hand control of the digital output back to the controller."""
+        raise EnvironmentError(f"{type(self).__name__} can't set values")
+
+    def close(self):
+        """Release all connections."""
@@ -0,0 +1,179 @@
+"""
+Import the data logger of a BL-NET into long-term statistics
+
+The logger keeps the values of the last days to weeks in a fixed
+interval. They are read in chunks over the TA direct port, newest first,
+and aggregated to the hourly statistics the recorder keeps for sensors:
+mean, min and max of temperatures and power, the meter reading of
+energy. All hours of a channel are added at once, and the next import
+resumes after the last hour that is already there.
+"""
+import logging
+from datetime import timedelta
+
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.util import dt as dt_util, slugify
+
+_LOGGER = logging.getLogger(__name__)
+
+# Source of the statistics, the part of their ids before the colon
+SOURCE = 'blnet'
+# Logged domains that become statistics and whether they are meters
+STATISTIC_DOMAINS = {'analog': False, 'power': False, 'energy': True}
+HOUR = timedelta(hours=1)
+
+
+def statistic_id(blnet_id):
+    """Return the id of the statistics of a channel."""
+    return f'{SOURCE}:{slugify(blnet_id)}'
+
+
+def logged_time(logged):
+    """Return the naive local time of the logger in UTC."""
+    return dt_util.as_utc(logged.replace(tzinfo=dt_util.DEFAULT_TIME_ZONE))
+
+
+class HourlyStatistics:
+    """Aggregates logged records to hourly statistics of channels."""
+
+    def __init__(self, channels, since=None):
+        """
+        Initialize empty statistics
+
+        channels maps tuples of frame, domain and channel to the id of
+        their statistics. Records logged before since are ignored.
+        """
+        self._channels = channels
+        self._since = since
+        # values of every statistic, keyed by the start of their hour:
+        # sum, min, max, count and the time and value of the last one
+        self._hours = {}
+        # the hour of the newest record is not complete yet
+        self._newest_hour = None
+        self.records = 0
+
+    def add(self, logged, values):
+        """Add a record logged at a naive local time, values are keyed
+        by frame like the current values."""
+        time = logged_time(logged)
+        hour = time.replace(minute=0, second=0, microsecond=0)
+        if self._newest_hour is None or hour > self._newest_hour:
+            self._newest_hour = hour
+        if self._since is not None and time < self._since:
+            return
+        self.records += 1
+        for (frame, domain, channel), statistic in self._channels.items():
+            value = values.get(frame, {}).get(domain, {}).get(channel)
+            if value is None:
+                continue
+            hours = self._hours.setdefault(statistic, {})
+            bucket = hours.get(hour)
+            if bucket is None:
+                hours[hour] = [value, value, value, 1, time, value]
+                continue
+            bucket[0] += value
+            bucket[1] = min(bucket[1], value)
+            bucket[2] = max(bucket[2], value)
+            bucket[3] += 1
+            if time > bucket[4]:
+                bucket[4:] = time, value
+
+    def statistics(self, meters=()):
+        """
+        Return the statistics of all complete hours, sorted by start and
+        keyed by statistic id
+
+        The statistics whose ids are in meters get the last reading of an
+        hour as state and sum, the others its mean, min and max.
+        """
+        result = {}
+        for statistic, hours in self._hours.items():
+            rows = []
+            for hour in sorted(hours):
+                if hour >= self._newest_hour:
+                    continue
+                total, minimum, maximum, count, _, last = hours[hour]
+                if statistic in meters:
+                    rows.append({'start': hour, 'state': last, 'sum': last})
+                else:
+                    rows.append({'start': hour, 'mean': round(total / count, 3),
+                                 'min': minimum, 'max': maximum})
+            if rows:
+                result[statistic] = rows
+        return result
+
+
+def statistic_channels(data_handler):
+    """Return the metadata of the statistics of all discovered channels
+    the logger records, keyed by their frame, domain and channel."""
+    frames = data_handler.blnet.direct_frames
+    channels = {}
+    for channel in data_handler.channels.values():
+        if (channel.domain not in STATISTIC_DOMAINS
+                or channel.key not in data_handler.sensors):
+            continue
+        meter = STATISTIC_DOMAINS[channel.domain]
+        channels[(frames.get(channel.node, 0), channel.domain, channel.id)] = {
+            'has_mean': not meter,
+            'has_sum': meter,
+            'name': channel.friendly_name,
+            'source': SOURCE,
+            'statistic_id': statistic_id(channel.blnet_id),
+            'unit_of_measurement': channel.unit_of_measurement,
+        }
+    return channels
+
+
+async def async_import_logger(hass, data_handler):
+    """
+    Import the complete hours of the data logger that are not in the
+    statistics yet
+
+    Returns the number of read records and of imported hourly statistics.
+    """
+    direct = getattr(data_handler.blnet, 'direct', None)
+    if direct is None:
+        raise HomeAssistantError(
+            "Importing the data logger needs a connection to the TA direct port")
+    # the recorder is only needed, and set up, when importing
+    from homeassistant.components.recorder import get_instance
+    from homeassistant.components.recorder.statistics import (
+        async_add_external_statistics, get_last_statistics,
+    )
+    channels = statistic_channels(data_handler)
+    metadata = {meta['statistic_id']: meta for meta in channels.values()}
+
+    # resume after the oldest of the last imported hours
+    recorder = get_instance(hass)
+    since = None
+    for statistic in metadata:
+        last = await recorder.async_add_executor_job(
+            get_last_statistics, hass, 1, statistic, False, {'max', 'sum'})
+        if statistic not in last:
+            since = None
+            break
+        start = dt_util.utc_from_timestamp(last[statistic][0]['start']) + HOUR
+        since = start if since is None else min(since, start)
+
+    aggregated = HourlyStatistics({
+        key: meta['statistic_id'] for key, meta in channels.items()
+    }, since)
+    # the logger runs on local time without a zone
+    reader = direct.read_log(
+        None if since is None else dt_util.as_local(since).replace(tzinfo=None))
+    while True:
+        chunk = await hass.async_add_executor_job(next, reader, None)
+        if chunk is None:
+            break
+        for logged, values in chunk:
+            aggregated.add(logged, values)
+
+    statistics = aggregated.statistics({
+        statistic for statistic, meta in metadata.items() if meta['has_sum']
+    })
+    for statistic, rows in statistics.items():
+        async_add_external_statistics(hass, metadata[statistic], rows)
+    imported = sum(len(rows) for rows in statistics.values())
+    _LOGGER.info(f"Imported {imported} hourly statistics from "
+                 f"{aggregated.records} logged records")
+    return {'records': aggregated.records, 'statistics': imported}
@@ -0,0 +1,69 @@
+"""
+Circuit breaker for polling a device that stopped answering
+
+After a few failed updates in a row the device is left alone for a
+while, doubling the pause after every failed retry. The pauses are
+randomized a little, so several devices don't retry in lockstep.
+"""
+import random
+import time
+
+# Failed updates in a row that open the breaker
+DEFAULT_THRESHOLD = 3
+# First and longest pause in seconds
+DEFAULT_MIN_BACKOFF = 30
+DEFAULT_MAX_BACKOFF = 1800
+# Share of the pause it is randomly lengthened or shortened by
+DEFAULT_JITTER = 0.2
+
+
+class CircuitBreaker:
+    """Counts failed updates and tells when the next one may be tried."""
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD,
+                 min_backoff=DEFAULT_MIN_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF, jitter=DEFAULT_JITTER,
+                 rng=random.random):
+        """Initialize a closed breaker."""
+        self.threshold = threshold
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self._rng = rng
+        # failed updates in a row and how often the breaker opened since
+        self.failures = 0
+        self.trips = 0
+        # monotonic time the next update may be tried while open
+        self._retry_at = None
+
+    @property
+    def is_open(self):
+        """Return whether updates are held back or only tried once."""
+        return self._retry_at is not None
+
+    def remaining(self):
+        """Return the seconds until the next update may be tried."""
+        if self._retry_at is None:
+            return 0
+        return max(self._retry_at - time.monotonic(), 0)
+
+    def allow(self):
+        """Return whether an update may be tried now."""
+        return self.remaining() == 0
+
+    def record_success(self):
+        """Close the breaker after a successful update."""
+        self.failures = 0
+        self.trips = 0
+        self._retry_at = None
+
+    def record_failure(self):
+        """Count a failed update, return whether the breaker is open."""
+        self.failures += 1
+        if self.failures < self.threshold:
+            return False
+        backoff = min(self.min_backoff * 2 ** self.trips, self.max_backoff)
+        backoff *= 1 + self.jitter * (2 * self._rng() - 1)
+        self.trips += 1
+        self._retry_at = time.monotonic() + backoff
+        return True
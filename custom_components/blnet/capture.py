@@ -0,0 +1,267 @@
+"""
+Record the raw answers of a device and replay them
+
+A capture file is one deflate stream of records, each a header of the
+time, node, kind and size of an answer followed by the answer itself.
+Consecutive answers hardly differ, so the stream compresses them very
+well. It is flushed after every record and rotated like a log file.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+from .client import BLNETClient
+from .cmi import DEFAULT_NODE, parse_cmi_response
+from .ta_direct import LATEST_SIZE, decode_latest
+from .web import parse_analog_page, parse_digital_page
+
+_LOGGER = logging.getLogger(__name__)
+
+# time, node, kind and size of a recorded answer
+RECORD = struct.Struct('<dHBI')
+# Kinds of answers: the pages of the web interface, the current values
+# of the TA direct port and the response of the C.M.I. JSON API
+KINDS = ('analog', 'digital', 'direct', 'cmi')
+KIND_CODES = {kind: code for code, kind in enumerate(KINDS, 1)}
+# Node of answers not referring to a selected CAN node
+NO_NODE = 0
+
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_BACKUP_COUNT = 3
+COMPRESSION_LEVEL = 6
+
+
+class CaptureWriter:
+    """Appends raw answers of a device to a rotating capture file."""
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES,
+                 backup_count=DEFAULT_BACKUP_COUNT):
+        """Initialize the writer, the file is opened on the first record."""
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+        self._file = None
+        self._compressor = None
+
+    def _open(self):
+        """Start a new capture file with a new compressed stream."""
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            # keep the capture of a previous run
+            self._rotate()
+        self._file = open(self.path, 'wb')
+        self._compressor = zlib.compressobj(COMPRESSION_LEVEL)
+
+    def _rotate(self):
+        """Move the current file to the backups, dropping the oldest."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f'{self.path}.{index}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{index + 1}')
+        if self.backup_count > 0:
+            os.replace(self.path, f'{self.path}.1')
+
+    def write(self, kind, payload, node=None):
+        """Record an answer of the given kind."""
+        record = RECORD.pack(time.time(), node or NO_NODE, KIND_CODES[kind],
+                             len(payload)) + bytes(payload)
+        with self.lock:
+            try:
+                if self._file is not None and self._file.tell() >= self.max_bytes:
+                    self._rotate()
+                if self._file is None:
+                    self._open()
+                # every record is flushed completely, so an interrupted
+                # capture loses at most the last one
+                self._file.write(self._compressor.compress(record)
+                                 + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+                self._file.flush()
+            except OSError as ex:
+                _LOGGER.error(f"Could not write capture {self.path}: {ex}")
+
+    def close(self):
+        """Finish the compressed stream and close the file."""
+        with self.lock:
+            if self._file is not None:
+                self._file.write(self._compressor.flush())
+                self._file.close()
+                self._file = None
+
+
+def read_capture(path):
+    """
+    Read all records of a capture and its backups, oldest first
+
+    Yields tuples of time, node, kind and payload. An incomplete last
+    record of an interrupted capture is skipped.
+    """
+    paths = [path]
+    while os.path.exists(f'{path}.{len(paths)}'):
+        paths.append(f'{path}.{len(paths)}')
+    for file_path in reversed(paths):
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path, 'rb') as capture:
+            data = zlib.decompressobj().decompress(capture.read())
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            timestamp, node, code, size = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if offset + size > len(data):
+                break
+            yield timestamp, node, KINDS[code - 1], data[offset:offset + size]
+            offset += size
+
+
+class _Recording:
+    """Recorded answers of every kind and node in the order they arrived."""
+
+    def __init__(self, records):
+        self._queues = {}
+        self._last = {}
+        # nodes in the order they were first selected
+        self.nodes = []
+        self.consumed = 0
+        for _, node, kind, payload in records:
+            self._queues.setdefault((kind, node), deque()).append(payload)
+            if node != NO_NODE and node not in self.nodes:
+                self.nodes.append(node)
+
+    def has(self, kind):
+        """Return whether answers of the kind were recorded."""
+        return any(key[0] == kind for key in self._queues)
+
+    @property
+    def exhausted(self):
+        """Return whether all answers were replayed."""
+        return not any(self._queues.values())
+
+    def next(self, kind, node):
+        """Return the next answer, the last one once all were replayed."""
+        key = (kind, NO_NODE if node is None else node)
+        queue = self._queues.get(key)
+        if queue:
+            self._last[key] = queue.popleft()
+            self.consumed += 1
+        return self._last.get(key)
+
+
+class _ReplaySession:
+    """Serves recorded pages in place of a BLNETWebSession."""
+
+    def __init__(self, recording):
+        self.lock = threading.RLock()
+        self._recording = recording
+        self._node = None
+
+    @property
+    def node(self):
+        return self._node
+
+    def set_node(self, node):
+        if node is not None:
+            self._node = node
+
+    def _read(self, kind, parse):
+        payload = self._recording.next(kind, self._node)
+        return parse(payload.decode()) if payload is not None else None
+
+    def read_analog_values(self):
+        return self._read('analog', parse_analog_page)
+
+    def read_digital_values(self):
+        return self._read('digital', parse_digital_page)
+
+    def close(self):
+        """Nothing to release."""
+
+
+class _ReplayDirect:
+    """Serves recorded frames in place of a BLNETDirectConnection."""
+
+    def __init__(self, recording):
+        self._recording = recording
+
+    def get_latest(self, max_retries=None):
+        payload = self._recording.next('direct', NO_NODE)
+        mode, size = payload[0], LATEST_SIZE[payload[0]]
+        values = []
+        for offset in range(1, len(payload), size):
+            values.extend(decode_latest(payload[offset:offset + size], mode))
+        return dict(enumerate(values))
+
+    def close(self):
+        """Nothing to release."""
+
+
+class ReplayBackend(BLNETClient):
+    """
+    Answers fetches with the answers of a capture
+
+    Answers are converted exactly like live ones. An answer that is
+    requested more often than it was recorded is repeated.
+    """
+
+    def __init__(self, path, nodes=None):
+        """Load a capture, its frames are assigned to nodes in order."""
+        self._recording = _Recording(read_capture(path))
+        recording = self._recording
+        session = None
+        if recording.has('analog') or recording.has('digital'):
+            session = _ReplaySession(recording)
+        direct = _ReplayDirect(recording) if recording.has('direct') else None
+        nodes = recording.nodes if nodes is None else nodes
+        super().__init__(session, direct, direct_frames={
+            node: frame for frame, node in enumerate(nodes)})
+
+    @property
+    def can_write(self):
+        """Return False, a capture can't be switched."""
+        return False
+
+    @property
+    def exhausted(self):
+        """Return whether all recorded answers were replayed."""
+        return self._recording.exhausted
+
+    @property
+    def consumed(self):
+        """Return the number of recorded answers replayed so far."""
+        return self._recording.consumed
+
+    def fetch(self, node=None, pages=None):
+        """Fetch the next recorded values of a node."""
+        if self._recording.has('cmi'):
+            payload = self._recording.next(
+                'cmi', DEFAULT_NODE if node is None else node)
+            return parse_cmi_response(json.loads(payload)) if payload else {}
+        return super().fetch(node, pages)
+
+
+def replay(data_handler):
+    """
+    Feed all answers of a ReplayBackend through its data handler
+
+    Every update fetches all pages of all nodes as fast as possible.
+    Returns the number of updates.
+    """
+    backend = data_handler.blnet
+    updates = 0
+    while not backend.exhausted:
+        consumed = backend.consumed
+        data_handler.process({
+            node: backend.fetch(node) for node in data_handler.nodes
+        })
+        updates += 1
+        if backend.consumed == consumed:
+            # the remaining answers are never requested
+            break
+    return updates
@@ -0,0 +1,66 @@
+"""
+Index of the channels of a BL-NET
+
+Every channel of a node gets one small record when it is first seen.
+Updates write the new values into it, and its entities keep a
+reference to it, so nothing is looked up by name or rebuilt per update.
+"""
+
+
+def as_number(value):
+    """Return a value as float, None if it is no number."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Channel:
+    """Current values of a single channel of a node."""
+
+    __slots__ = ('node', 'domain', 'id', 'blnet_id', 'name', 'friendly_name',
+                 'value', 'mode', 'unit_of_measurement', 'icon', 'deadband',
+                 'applied', 'samples', 'rolling')
+
+    def __init__(self, node, domain, channel_id, blnet_id, icon=None):
+        """Initialize a channel without values."""
+        self.node = node
+        self.domain = domain
+        self.id = channel_id
+        self.blnet_id = blnet_id
+        # name on the device and the name prefixed by device and node
+        self.name = None
+        self.friendly_name = None
+        self.value = None
+        # AUTO or HAND, only digital outputs have a mode
+        self.mode = None
+        self.unit_of_measurement = None
+        self.icon = icon
+        # smallest change of the value that is applied, if any
+        self.deadband = None
+        # time the value was last applied at, None if it never was
+        self.applied = None
+        # SampleBuffer of the recent values and their rolling aggregates,
+        # if they are kept
+        self.samples = None
+        self.rolling = None
+
+    @property
+    def key(self):
+        """Return the node, domain and id the channel is indexed by."""
+        return self.node, self.domain, self.id
+
+    def as_dict(self):
+        """Return the values like the entries of the data of a handler."""
+        if self.domain == 'digital':
+            return {
+                'friendly_name': self.friendly_name,
+                'mode': self.mode,
+                'value': self.value,
+            }
+        return {
+            'value': self.value,
+            'unit_of_measurement': self.unit_of_measurement,
+            'friendly_name': self.friendly_name,
+            'icon': self.icon,
+        }
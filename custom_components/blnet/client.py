@@ -0,0 +1,229 @@
+"""
+High-level access to a BL-NET through a shared web session
+
+Provides the interface of pyblnet's BLNET on top of a BLNETWebSession,
+so that polls and switch commands reuse one connection and one login.
+"""
+import logging
+import time
+
+from .backend import BLNETBackend
+from .stats import timer
+
+_LOGGER = logging.getLogger(__name__)
+
+DOMAINS = ('analog', 'digital', 'speed', 'energy', 'power')
+
+# Data sources of a fetch and the domains each of them provides
+PAGE_ANALOG = 'analog'
+PAGE_DIGITAL = 'digital'
+PAGE_DIRECT = 'direct'
+PAGE_DOMAINS = {
+    PAGE_ANALOG: ('analog',),
+    PAGE_DIGITAL: ('digital',),
+    # analog and digital values of the web interface are refined by it
+    PAGE_DIRECT: DOMAINS,
+}
+
+# Seconds to use the web interface only after the direct connection failed
+DIRECT_RETRY_INTERVAL = 300
+# Seconds the frames of the direct connection serve the fetches of other nodes
+DIRECT_MAX_AGE = 2
+# Seconds after which names of analog values are read from the web again
+WEB_NAMES_LIFETIME = 3600
+# Values of the digital outputs on the web interface
+DIGITAL_STATES = {0: 'AUS', 1: 'EIN'}
+
+
+def pages_for_domains(domains):
+    """Return the pages backing at least one of the given domains."""
+    return {
+        page for page, page_domains in PAGE_DOMAINS.items()
+        if not set(domains).isdisjoint(page_domains)
+    }
+
+
+class BLNETClient(BLNETBackend):
+    """Reads and writes values of a BL-NET over a shared session."""
+
+    def __init__(self, session=None, direct=None, max_retries=5,
+                 direct_frames=None):
+        """Initialize with a web session and an optional TA direct connection.
+
+        direct_frames maps CAN nodes to the frames of the direct connection
+        holding their values, by default every node reads the first one.
+        """
+        self.session = session
+        self.direct = direct
+        self.max_retries = max_retries
+        self.direct_frames = direct_frames or {}
+        # last frames of the direct connection, the time they were read and
+        # the nodes which already used them
+        self._direct_latest = (None, None, set())
+        # last analog values of the web interface and their time, keyed by
+        # node, they supply names and units to the direct values
+        self._web_analog = {}
+        # time the direct connection failed, it is not used for a while
+        self._direct_failed = None
+        # CycleStats timing the direct connection, if any
+        self.stats = None
+
+    @property
+    def can_write(self):
+        """Return whether outputs can be switched over the web interface."""
+        return self.session is not None
+
+    @property
+    def node(self):
+        """Return the CAN node currently selected on the device, if known."""
+        return self.session.node if self.session is not None else None
+
+    def fetch(self, node=None, pages=None):
+        """
+        Fetch available data about selected node
+        (defaults to active node on the device)
+
+        Only the given pages are requested, all of them if pages is None.
+        The result only contains the domains that were actually fetched.
+        Analog values are taken from the direct connection if it works,
+        the web page is then only read for new names.
+        """
+        pages = set(PAGE_DOMAINS if pages is None else pages)
+        data = {}
+        direct = None
+        if self.direct is not None and PAGE_DIRECT in pages:
+            direct = self._fetch_direct(node)
+        web_pages = pages & {PAGE_ANALOG, PAGE_DIGITAL}
+        if direct is not None and node in self._web_analog:
+            updated, web_analog = self._web_analog[node]
+            if time.monotonic() - updated < WEB_NAMES_LIFETIME:
+                # The names are known, only the values are needed
+                web_pages.discard(PAGE_ANALOG)
+                data['analog'] = {
+                    sensor_id: dict(sensor)
+                    for sensor_id, sensor in web_analog.items()
+                }
+        if self.session is not None and web_pages:
+            with self.session.lock:
+                self.session.set_node(node)
+                if PAGE_ANALOG in web_pages:
+                    data['analog'] = self._convert_web(
+                        self.session.read_analog_values())
+                    self._web_analog[node] = (time.monotonic(), data['analog'])
+                if PAGE_DIGITAL in web_pages:
+                    data['digital'] = self._convert_web(
+                        self.session.read_digital_values())
+        if direct is not None:
+            self._apply_direct(data, direct)
+        return data
+
+    def _fetch_direct(self, node):
+        """Return the current values of a node from the direct connection,
+        None if it failed and the web interface is used instead."""
+        if (self._direct_failed is not None and time.monotonic()
+                - self._direct_failed < DIRECT_RETRY_INTERVAL):
+            return None
+        frame = self.direct_frames.get(node, 0)
+        updated, frames, used = self._direct_latest
+        if (updated is not None and node not in used
+                and time.monotonic() - updated < DIRECT_MAX_AGE):
+            # all frames are read at once, fetches of other nodes reuse them
+            used.add(node)
+            return frames.get(frame)
+        try:
+            with timer(self.stats, 'fetch direct'):
+                frames = self.direct.get_latest(self.max_retries)
+        except (OSError, ValueError) as ex:
+            if self.session is None:
+                raise
+            _LOGGER.warning(
+                f"TA direct access failed, using the web interface: {ex}")
+            self._direct_failed = time.monotonic()
+            if self.stats is not None:
+                self.stats.count('failures')
+            return None
+        self._direct_failed = None
+        self._direct_latest = (time.monotonic(), frames, {node})
+        return frames.get(frame)
+
+    def _apply_direct(self, data, direct):
+        """Merge the values of the direct connection into the data."""
+        if self.session is None:
+            # Without the web interface all channels are taken as they are
+            for domain in ('analog', 'digital'):
+                data[domain] = {
+                    sensor_id: {'name': f'{domain.capitalize()} {sensor_id}'}
+                    for sensor_id in direct[domain]
+                }
+        # Override values for analog and digital as values are
+        # expected to be more precise here
+        for sensor_id, value in direct['analog'].items():
+            if sensor_id in data.get('analog', {}):
+                data['analog'][sensor_id]['value'] = value
+        for sensor_id, value in direct['digital'].items():
+            if sensor_id in data.get('digital', {}):
+                data['digital'][sensor_id]['value'] = DIGITAL_STATES[value]
+        for domain in ('speed', 'energy', 'power'):
+            data[domain] = {}
+            for sensor_id, value in direct[domain].items():
+                if value is None:
+                    continue
+                data[domain][sensor_id] = {
+                    'name': f'{domain.capitalize()} {sensor_id}',
+                    'value': value,
+                }
+
+    def turn_on(self, digital_id, can_node=None):
+        """Turn the digital output on."""
+        return self._turn(digital_id, 'EIN', can_node)
+
+    def turn_off(self, digital_id, can_node=None):
+        """Turn the digital output off."""
+        return self._turn(digital_id, 'AUS', can_node)
+
+    def turn_auto(self, digital_id, can_node=None):
+        """Hand control of the digital output back to the UVR."""
+        return self._turn(digital_id, 'AUTO', can_node)
+
+    def _turn(self, digital_id, value, can_node=None):
+        """Set a digital output in the shared session."""
+        if self.session is None:
+            raise EnvironmentError("Can't set values with blnet web disabled")
+        with self.session.lock:
+            self.session.set_node(can_node)
+            self.session.set_digital_value(digital_id, value)
+        return True
+
+    def set_outputs(self, outputs, can_node=None):
+        """
+        Set several digital outputs of a node in one go
+
+        outputs maps output ids to EIN, AUS or AUTO. The node is selected
+        once and the outputs are set without interleaving other requests.
+        Returns whether setting each output succeeded.
+        """
+        if self.session is None:
+            raise EnvironmentError("Can't set values with blnet web disabled")
+        results = {}
+        with self.session.lock:
+            self.session.set_node(can_node)
+            for digital_id, value in outputs.items():
+                try:
+                    self.session.set_digital_value(digital_id, value)
+                    results[digital_id] = True
+                except (ValueError, OSError) as ex:
+                    _LOGGER.error(f"Could not set output {digital_id}: {ex}")
+                    results[digital_id] = False
+        return results
+
+    def close(self):
+        """Release the web session and the direct connection."""
+        if self.session is not None:
+            self.session.close()
+        if self.direct is not None:
+            self.direct.close()
+
+    @staticmethod
+    def _convert_web(values):
+        """Key a list of web values by their integer id."""
+        return {int(sensor['id']): sensor for sensor in values or ()}
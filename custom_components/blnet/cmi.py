@@ -0,0 +1,201 @@
+"""
+Read values through the JSON API of a TA C.M.I.
+
+The C.M.I. returns all inputs and outputs of a CAN node in a single
+request, which is a lot cheaper than scraping the pages of a BL-NET.
+It answers at most one API request per minute, for all nodes together,
+so snapshots are reused within that time and the nodes take turns.
+"""
+import logging
+import threading
+import time
+
+import requests
+
+from .backend import BLNETBackend
+from .stats import timer
+
+_LOGGER = logging.getLogger(__name__)
+
+API_PAGE = '/INCLUDE/api.cgi?jsonnode={}&jsonparam=I,O,La'
+DEFAULT_USERNAME = 'admin'
+DEFAULT_NODE = 1
+DEFAULT_TIMEOUT = 5
+# The C.M.I. only answers one API request per minute
+MIN_REQUEST_INTERVAL = 60
+
+STATUS_OK = 0
+STATUS_MESSAGES = {
+    1: "node error",
+    2: "failure",
+    3: "syntax error",
+    4: "too many requests",
+    5: "device not supported",
+    6: "too few arguments",
+    7: "CAN busy",
+}
+
+# Units of the API and the units of the data handler
+UNITS = {
+    '1': '°C',
+    '2': 'W/m²',
+    '3': 'l/h',
+    '7': 'K',
+    '8': '%',
+    '10': 'kW',
+    '11': 'kWh',
+    '12': 'MWh',
+    '13': 'V',
+    '21': 'Hz',
+    '22': 'l/min',
+    '23': 'bar',
+    '46': '°C',
+}
+UNIT_POWER = '10'
+UNITS_ENERGY = ('11', '12')
+
+
+def _value(item):
+    """Return the value and unit code of an item of the API."""
+    value = item.get('Value', {})
+    return value.get('Value'), str(value.get('Unit'))
+
+
+def parse_cmi_response(payload):
+    """Map a response of the JSON API to the domains of the data handler."""
+    status = payload.get('Status code', STATUS_OK)
+    if status != STATUS_OK:
+        raise ConnectionError(
+            f"C.M.I. answered with {STATUS_MESSAGES.get(status, status)}")
+    content = payload.get('Data', {})
+    data = {domain: {} for domain in ('analog', 'digital', 'speed',
+                                      'energy', 'power')}
+    for item in content.get('Inputs', ()):
+        number = item['Number']
+        value, unit = _value(item)
+        data['analog'][number] = {
+            'name': f'Input {number}',
+            'value': value,
+            'unit_of_measurement': UNITS.get(unit, ''),
+        }
+    for item in content.get('Outputs', ()):
+        number = item['Number']
+        value, _ = _value(item)
+        if item.get('AD') == 'D':
+            data['digital'][number] = {
+                'name': f'Output {number}',
+                'value': 'EIN' if value else 'AUS',
+            }
+        else:
+            # analog outputs of a UVR1611 are speed controlled pumps
+            data['speed'][number] = {'name': f'Speed {number}', 'value': value}
+    for item in content.get('Logging Analog', ()):
+        number = item['Number']
+        value, unit = _value(item)
+        if unit == UNIT_POWER:
+            data['power'][number] = {'name': f'Power {number}', 'value': value}
+        elif unit in UNITS_ENERGY:
+            data['energy'][number] = {
+                'name': f'Energy {number}',
+                'value': value,
+                'unit_of_measurement': UNITS[unit],
+            }
+    return data
+
+
+class CMIBackend(BLNETBackend):
+    """Reads the values of CAN nodes through the JSON API of a C.M.I."""
+
+    def __init__(self, address, username=DEFAULT_USERNAME, password=None,
+                 timeout=DEFAULT_TIMEOUT):
+        """Initialize the backend, no request is sent yet."""
+        if not address.startswith(('http://', 'https://')):
+            address = 'http://' + address
+        self.address = address.rstrip('/')
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._session = None
+        # last snapshot of every node and the time it was requested
+        self._snapshots = {}
+        # time of the last request, the rate limit holds for all nodes
+        self._requested = None
+        # nodes asked for while the rate limit held, in the order they
+        # get the next requests
+        self._waiting = []
+        # CaptureWriter recording the responses, if any
+        self.capture = None
+        # CycleStats timing the requests, if any
+        self.stats = None
+
+    def _get(self, path):
+        """Send an authenticated GET request."""
+        if self._session is None:
+            self._session = requests.Session()
+            self._session.auth = (self.username, self.password or '')
+        response = self._session.get(self.address + path, timeout=self.timeout)
+        if self.stats is not None:
+            self.stats.count('requests')
+            self.stats.count('bytes', len(response.content))
+        if response.status_code == 401:
+            raise ConnectionError(f"Access to {self.address} was denied")
+        response.raise_for_status()
+        return response
+
+    def probe(self):
+        """Check that a C.M.I. answers under the address."""
+        with self.lock:
+            try:
+                self._get('/')
+            except requests.exceptions.RequestException as ex:
+                raise ValueError(f"No C.M.I. reached at {self.address}") from ex
+
+    def fetch(self, node=None, pages=None):
+        """
+        Fetch all values of a node in one request
+
+        Within the rate limit of the C.M.I. the last snapshot of the node
+        is returned, or no values if there is none yet. Once it passed, the
+        node that waits longest is requested, so with several nodes each
+        one is requested in turn.
+        """
+        if pages is not None and not pages:
+            return {}
+        node = DEFAULT_NODE if node is None else node
+        with self.lock:
+            requested, data = self._snapshots.get(node, (None, {}))
+            if (self._requested is None
+                    or time.monotonic() - self._requested >= MIN_REQUEST_INTERVAL):
+                turn = self._waiting.pop(0) if self._waiting else node
+                self._request(turn)
+                if turn == node:
+                    return self._snapshots[node][1]
+            if requested is None or requested < self._requested:
+                if node not in self._waiting:
+                    self._waiting.append(node)
+            _LOGGER.debug(f"Reusing C.M.I. snapshot of node {node}")
+            return data
+
+    def _request(self, node):
+        """Request the snapshot of a node."""
+        self._requested = time.monotonic()
+        with timer(self.stats, 'fetch cmi'):
+            response = self._get(API_PAGE.format(node))
+        if self.capture is not None:
+            self.capture.write('cmi', response.content, node)
+        with timer(self.stats, 'parse cmi'):
+            try:
+                payload = response.json()
+            except ValueError as ex:
+                raise ConnectionError(
+                    f"Invalid answer of C.M.I.: {ex}") from ex
+            data = parse_cmi_response(payload)
+        self._snapshots[node] = (self._requested, data)
+
+    def close(self):
+        """Close the HTTP connections."""
+        with self.lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
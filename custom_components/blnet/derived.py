@@ -0,0 +1,87 @@
+"""
+Channels computed from other channels of a BL-NET
+
+Spreads, sums and ratios of channels and the integral of a channel over
+time are declared in the configuration. They are computed once per
+update from the records of their sources, instead of rendering a
+template on every change of a source.
+"""
+import re
+
+from .channels import as_number
+
+# Kinds of derived channels and the number of sources they take,
+# None if any number
+DERIVED_KINDS = {'difference': 2, 'sum': None, 'ratio': 2, 'integral': 1}
+DERIVED_ICONS = {
+    'difference': 'mdi:thermometer-lines',
+    'sum': 'mdi:sigma',
+    'ratio': 'mdi:division',
+    'integral': 'mdi:chart-areaspline',
+}
+DIGITS = 3
+# A source like "analog 3", or "2 analog 3" with several nodes
+SOURCE_PATTERN = re.compile(r'^(?:(\d+) )?(analog|speed|power|energy) (\d+)$')
+
+
+def parse_source(source, default_node):
+    """Return the node, domain and id of the channel a source refers to."""
+    node, domain, channel_id = SOURCE_PATTERN.match(source).groups()
+    return (default_node if node is None else int(node)), domain, int(channel_id)
+
+
+class Derivation:
+    """Computes the value of a derived channel from its sources."""
+
+    __slots__ = ('kind', 'name', 'unit', 'keys', 'channel', '_total', '_last')
+
+    def __init__(self, kind, name, keys, unit=None):
+        """Initialize a derivation of the channels with the given keys."""
+        self.kind = kind
+        self.name = name
+        self.unit = unit
+        self.keys = keys
+        # record of the derived channel, set by the data handler
+        self.channel = None
+        # unrounded integral and the last sample of its source
+        self._total = None
+        self._last = None
+
+    def default_unit(self, sources):
+        """Return the unit of the result derived from the sources."""
+        unit = sources[0].unit_of_measurement
+        if self.kind == 'ratio' or unit is None:
+            return None
+        if self.kind == 'integral':
+            return f'{unit}h' if unit in ('W', 'kW') else f'{unit}*h'
+        return unit
+
+    def evaluate(self, sources, now):
+        """Return the value derived from the records of the sources at the
+        time now, None if a source has no value."""
+        values = [as_number(source.value) for source in sources]
+        if None in values:
+            return None
+        if self.kind == 'difference':
+            result = values[0] - values[1]
+        elif self.kind == 'sum':
+            result = sum(values)
+        elif self.kind == 'ratio':
+            if values[1] == 0:
+                return None
+            result = values[0] / values[1]
+        else:
+            result = self._integrate(values[0], now)
+        return round(result, DIGITS)
+
+    def _integrate(self, value, now):
+        """Add the area since the last sample by the trapezoidal rule."""
+        if self._total is None:
+            # continue the integral of a previous run
+            self._total = as_number(self.channel.value) or 0.0
+        if self._last is not None:
+            last_time, last_value = self._last
+            hours = (now - last_time).total_seconds() / 3600
+            self._total += (last_value + value) / 2 * hours
+        self._last = (now, value)
+        return self._total
@@ -0,0 +1,71 @@
+"""
+Recent samples of the channels and rolling aggregates over them
+
+Every numeric channel keeps its last samples in a ring buffer of two
+fixed-size arrays of doubles. The minimum, maximum, mean and rate of
+change over a time window are computed from them after each update,
+without asking the recorder.
+"""
+from array import array
+
+# Aggregates of the samples in the window, the rate is per hour
+ROLLING_STATS = ('min', 'max', 'mean', 'rate')
+DIGITS = 3
+
+
+class SampleBuffer:
+    """Ring buffer of the last timestamps and values of a channel."""
+
+    __slots__ = ('_times', '_values', '_next', 'size')
+
+    def __init__(self, capacity):
+        """Initialize an empty buffer of the given number of samples."""
+        self._times = array('d', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        # index the next sample is written to and the number of samples
+        self._next = 0
+        self.size = 0
+
+    def append(self, timestamp, value):
+        """Add a sample, replacing the oldest one if the buffer is full."""
+        self._times[self._next] = timestamp
+        self._values[self._next] = value
+        self._next = (self._next + 1) % len(self._times)
+        if self.size < len(self._times):
+            self.size += 1
+
+    def aggregate(self, since):
+        """Return the rolling aggregates of the samples taken at or after
+        the timestamp since, None if there are none."""
+        times, values = self._times, self._values
+        capacity = len(times)
+        index = self._next
+        count = 0
+        total = 0.0
+        minimum = maximum = newest = None
+        for _ in range(self.size):
+            index = (index - 1) % capacity
+            if times[index] < since:
+                break
+            value = values[index]
+            if newest is None:
+                minimum = maximum = newest = value
+                newest_time = times[index]
+            elif value < minimum:
+                minimum = value
+            elif value > maximum:
+                maximum = value
+            total += value
+            count += 1
+            # the samples are walked from the newest to the oldest
+            oldest, oldest_time = value, times[index]
+        if count == 0:
+            return None
+        span = newest_time - oldest_time
+        rate = (newest - oldest) / span * 3600 if span > 0 else 0.0
+        return {
+            'min': round(minimum, DIGITS),
+            'max': round(maximum, DIGITS),
+            'mean': round(total / count, DIGITS),
+            'rate': round(rate, DIGITS),
+        }
@@ -3,6 +3,8 @@ Connect to a BL-NET via it's web interface and read and write data
 """
 import logging
 
+from homeassistant.const import EntityCategory
+from homeassistant.core import callback
 from homeassistant.helpers.entity import Entity
 
 _LOGGER = logging.getLogger(__name__)
@@ -11,36 +13,53 @@ DOMAIN = 'blnet'
 FRIENDLY_NAME = 'friendly_name'
 
 
-def setup_platform(hass, config, add_devices, discovery_info=None):
+async def async_setup_platform(hass, config, async_add_entities,
+                               discovery_info=None):
     """Set up the BLNET component"""
 
     if discovery_info is None:
         _LOGGER.error("No BL-Net communication configured")
         return False
 
-    sensor_id = discovery_info['id']
-    blnet_id = discovery_info['blnet_id']
-    name = discovery_info['name']
-    friendly_name = discovery_info['friendly_name']
-    _LOGGER.debug(f"Discovery info: {discovery_info}")
-    comm = hass.data['DATA_{}'.format(DOMAIN)]
-
-    add_devices([BLNETComponent(hass, sensor_id, name, blnet_id, friendly_name, comm)], True)
+    comm = hass.data['DATA_{}'.format(DOMAIN)][discovery_info.get('device')]
+
+    @callback
+    def add_entities(discovered):
+        """Add a batch of discovered sensors."""
+        _LOGGER.debug(f"Adding {len(discovered)} discovered sensors")
+        entities = []
+        for disc_info in discovered:
+            args = (hass, disc_info['id'], disc_info['name'],
+                    disc_info['blnet_id'], disc_info['friendly_name'], comm)
+            if disc_info.get('diagnostic'):
+                entities.append(BLNETDiagnosticSensor(*args))
+            elif disc_info.get('rolling'):
+                entities.append(BLNETRollingSensor(*args, disc_info['rolling']))
+            else:
+                entities.append(BLNETComponent(*args))
+        async_add_entities(entities)
+
+    comm.async_register_platform('sensor', add_entities)
     return True
 
 
 class BLNETComponent(Entity):
     """Implementation of a BL-NET - UVR1611 sensor and switch component."""
 
+    _attr_should_poll = False
+
     def __init__(self, hass, sensor_id, name, blnet_id, friendly_name, communication):
         """Initialize the BL-NET sensor."""
         self._identifier = blnet_id
         self.communication = communication
+        # record of the channel, resolved when the entity is added
+        self._channel = None
         self._name = name
         self._friendly_name = friendly_name
         self._state = None
         self._unit_of_measurement = None
         self._icon = None
+        self._attributes = {}
 
     @property
     def friendly_name(self):
@@ -57,6 +76,11 @@ class BLNETComponent(Entity):
         """Return a unique ID for the sensor."""
         return f"blnet_sensor_{self._identifier}"
 
+    @property
+    def available(self):
+        """Return False while the BL-NET is not answering."""
+        return self.communication.available
+
     @property
     def state(self):
         """Return the state of the device."""
@@ -72,6 +96,11 @@ class BLNETComponent(Entity):
         """Return the state of the device."""
         return self._unit_of_measurement
 
+    @property
+    def extra_state_attributes(self):
+        """Return the state attributes of the sensor."""
+        return self._attributes
+
     @property
     def device_state_attributes(self):
         """Return the state attributes of the device."""
@@ -80,20 +109,85 @@ class BLNETComponent(Entity):
         attrs[FRIENDLY_NAME] = self._friendly_name
         return attrs
 
-    def update(self):
+    async def async_added_to_hass(self):
+        """Subscribe to data updates of this sensor."""
+        self._update_from_data()
+        self.async_on_remove(self.communication.async_add_listener(
+            self._identifier, self._async_handle_update))
+
+    @callback
+    def _async_handle_update(self):
+        """Handle changed data of this sensor."""
+        self._update_from_data()
+        self.async_write_ha_state()
+
+    def _update_from_data(self):
         """Get the latest data from communication device """
-        sensor_data = self.communication.data.get(self._identifier)
-        
-        if sensor_data is None:
+        if self._channel is None:
+            self._channel = self.communication.channel(self._identifier)
+        channel = self._channel
+
+        if channel is None:
             _LOGGER.warning(f"No data found for sensor {self._identifier}")
             return
 
-        _LOGGER.debug(f"Found sensor data: {sensor_data}")
-        # we simply set the identifier using the data from the sensor
-        # self._identifier = sensor_data.get('friendly_name')
-        # self._name = sensor_data.get('friendly_name')
+        self._friendly_name = channel.friendly_name
+        self._state = channel.value
+        self._unit_of_measurement = channel.unit_of_measurement
+        self._icon = channel.icon
+
+
+class BLNETDiagnosticSensor(BLNETComponent):
+    """Timing or counter of the updates of a BL-NET, disabled by default."""
 
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_entity_registry_enabled_default = False
+
+    @property
+    def available(self):
+        """Return True, the diagnostics tell why the values are missing."""
+        return True
+
+    def _update_from_data(self):
+        """Get the latest timing or counter from the data handler."""
+        sensor_data = self.communication.diagnostics.get(self._identifier)
+        if sensor_data is None:
+            return
         self._friendly_name = sensor_data.get('friendly_name')
         self._state = sensor_data.get('value')
         self._unit_of_measurement = sensor_data.get('unit_of_measurement')
         self._icon = sensor_data.get('icon')
+        self._attributes = sensor_data.get('attributes', {})
+
+
+class BLNETRollingSensor(BLNETComponent):
+    """Rolling minimum, maximum, mean or rate of change of a channel."""
+
+    def __init__(self, hass, sensor_id, name, blnet_id, friendly_name,
+                 communication, stat):
+        """Initialize the sensor of one aggregate of a channel."""
+        super().__init__(hass, sensor_id, name, blnet_id, friendly_name,
+                         communication)
+        self._stat = stat
+
+    @property
+    def unique_id(self):
+        """Return a unique ID for the aggregate of the channel."""
+        return f"blnet_sensor_{self._identifier}_{self._stat}"
+
+    async def async_added_to_hass(self):
+        """Subscribe to data and aggregate updates of the channel."""
+        self._update_from_data()
+        self.async_on_remove(self.communication.async_add_listener(
+            self._identifier, self._async_handle_update, rolling=True))
+
+    def _update_from_data(self):
+        """Get the latest aggregate from the record of the channel."""
+        super()._update_from_data()
+        channel = self._channel
+        if channel is None:
+            return
+        self._friendly_name = f'{channel.friendly_name} {self._stat}'
+        self._state = (channel.rolling or {}).get(self._stat)
+        if self._stat == 'rate' and self._unit_of_measurement is not None:
+            self._unit_of_measurement = f'{self._unit_of_measurement}/h'
@@ -0,0 +1,92 @@
+"""
+Timings of the stages of updates and counters of the requests to a device
+
+The durations of the last updates are kept per stage, so percentiles
+show how long fetching, parsing and applying the values usually takes.
+"""
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+# Number of durations kept per stage
+DEFAULT_WINDOW = 100
+PERCENTILES = (50, 95)
+COUNTERS = ('requests', 'bytes', 'failures', 'timeouts')
+
+
+def timer(stats, stage):
+    """Return a context timing a stage, doing nothing without stats."""
+    return nullcontext() if stats is None else stats.timer(stage)
+
+
+def _percentile(durations, percentile):
+    """Return the percentile of sorted durations by the nearest rank."""
+    rank = math.ceil(percentile / 100 * len(durations))
+    return durations[max(rank, 1) - 1]
+
+
+class CycleStats:
+    """Collects the durations of stages and counts requests and failures."""
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        """Initialize empty statistics."""
+        self.window = window
+        self.lock = threading.Lock()
+        # durations of the last runs in seconds, keyed by stage
+        self._durations = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the enclosed code as a run of the stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_duration(stage, time.perf_counter() - start)
+
+    def add_duration(self, stage, seconds):
+        """Record a run of a stage."""
+        with self.lock:
+            if stage not in self._durations:
+                self._durations[stage] = deque(maxlen=self.window)
+            self._durations[stage].append(seconds)
+
+    def count(self, counter, amount=1):
+        """Increase a counter."""
+        with self.lock:
+            self.counters[counter] += amount
+
+    @property
+    def stages(self):
+        """Return the stages that ran at least once."""
+        with self.lock:
+            return list(self._durations)
+
+    def summary(self, stage):
+        """Return the last, percentile and longest durations of a stage
+        in milliseconds, None if it never ran."""
+        with self.lock:
+            durations = self._durations.get(stage)
+            if not durations:
+                return None
+            last = durations[-1]
+            durations = sorted(durations)
+        summary = {'last': last}
+        for percentile in PERCENTILES:
+            summary[f'p{percentile}'] = _percentile(durations, percentile)
+        summary['max'] = durations[-1]
+        summary = {key: round(value * 1000, 1) for key, value in summary.items()}
+        summary['count'] = len(durations)
+        return summary
+
+    def as_dict(self):
+        """Return the summaries of all stages and the counters."""
+        with self.lock:
+            counters = dict(self.counters)
+        return {
+            'stages': {stage: self.summary(stage) for stage in self.stages},
+            'counters': counters,
+        }
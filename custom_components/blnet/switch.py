@@ -5,6 +5,8 @@ Switch to control digital outputs
 """
 import logging
 
+from homeassistant.core import callback
+from homeassistant.exceptions import HomeAssistantError
 from homeassistant.const import (
     STATE_UNKNOWN,
     STATE_OFF,
@@ -24,20 +26,33 @@ MODE = 'mode'
 FRIENDLY_NAME = 'friendly_name'
 
 
-def setup_platform(hass, config, add_devices, discovery_info=None):
+async def async_setup_platform(hass, config, async_add_entities,
+                               discovery_info=None):
     """Set up the BLNET component"""
 
     if discovery_info is None:
         _LOGGER.error("No BL-Net communication configured")
         return False
 
-    switch_id = discovery_info['id']
-    blnet_id = discovery_info['blnet_id']
-    name = discovery_info['name']
-    comm = hass.data['DATA_{}'.format(DOMAIN)]
-
-    add_devices([BLNETSwitch(switch_id, blnet_id, name, comm),
-                 BLNETModeSwitch(switch_id, blnet_id, name, comm)], True)
+    comm = hass.data['DATA_{}'.format(DOMAIN)][discovery_info.get('device')]
+
+    @callback
+    def add_entities(discovered):
+        """Add a batch of discovered digital outputs."""
+        entities = []
+        for disc_info in discovered:
+            switch_id = disc_info['id']
+            blnet_id = disc_info['blnet_id']
+            name = disc_info['name']
+            node = disc_info.get('node')
+            device = disc_info.get('device')
+            entities.append(BLNETSwitch(
+                switch_id, blnet_id, name, comm, node, device))
+            entities.append(BLNETModeSwitch(
+                switch_id, blnet_id, name, comm, node, device))
+        async_add_entities(entities)
+
+    comm.async_register_platform('switch', add_entities)
     return True
 
 
@@ -46,48 +61,65 @@ class BLNETSwitch(SwitchEntity):
     Representation of a switch that toggles a digital output of the UVR1611.
     """
 
-    def __init__(self, switch_id, blnet_id, name, comm):
+    _attr_should_poll = False
+
+    def __init__(self, switch_id, blnet_id, name, comm, node=None,
+                 device=None):
         """Initialize the switch."""
         self._blnet_id = blnet_id
         self._id = switch_id
+        # CAN node of the output, None if only a single node is polled
+        self._node = node
+        # name of the BL-NET, None if it is the only one
+        self._device = device
         self.communication = comm
+        # record of the output, resolved when the entity is added
+        self._channel = None
         self._name = name
         self._friendly_name = name
         self._state = STATE_UNKNOWN
         self._assumed_state = True
         self._icon = None
         self._mode = STATE_UNKNOWN
-        self._last_updated = None
 
     @property
     def unique_id(self):
         """Home assist requires a unique ID property."""
-        return f"blnet_switch_{self._id}"
+        return "_".join(
+            str(part) for part in
+            ("blnet_switch", self._device, self._node, self._id)
+            if part is not None)
     
-    def update(self):
+    async def async_added_to_hass(self):
+        """Subscribe to data updates of the digital output."""
+        self._update_from_data()
+        self.async_on_remove(self.communication.async_add_listener(
+            self._blnet_id, self._async_handle_update))
+
+    @callback
+    def _async_handle_update(self):
+        """Handle changed data of the digital output."""
+        self._update_from_data()
+        self.async_write_ha_state()
+
+    def _update_from_data(self):
         """Get the latest data from communication device """
-        # check if new data has arrived
-        last_blnet_update = self.communication.last_updated()
-
-        if last_blnet_update == self._last_updated:
-            return
-
-        sensor_data = self.communication.data.get(self._blnet_id)
+        if self._channel is None:
+            self._channel = self.communication.channel(self._blnet_id)
+        channel = self._channel
 
-        if sensor_data is None:
+        if channel is None:
             return
 
-        self._friendly_name = sensor_data.get('friendly_name')
-        if sensor_data.get('value') == "EIN":
+        self._friendly_name = channel.friendly_name
+        if channel.value == "EIN":
             self._state = STATE_ON
             self._icon = 'mdi:flash'
         # Nonautomated switch, toggled off => switch off
         else:
             self._state = STATE_OFF
             self._icon = 'mdi:flash-off'
-        self._mode = sensor_data.get('mode')
-
-        self._last_updated = last_blnet_update
+        self._mode = channel.mode
         self._assumed_state = False
 
     @property
@@ -95,6 +127,11 @@ class BLNETSwitch(SwitchEntity):
         """Return the name of the switch."""
         return self._name
 
+    @property
+    def available(self):
+        """Return False while the BL-NET is not answering."""
+        return self.communication.available
+
     @property
     def state(self):
         """Return the state of the device."""
@@ -119,17 +156,24 @@ class BLNETSwitch(SwitchEntity):
         """Return true if device is on."""
         return self._state == STATE_ON
 
-    def turn_on(self, **kwargs):
+    async def async_turn_on(self, **kwargs):
         """Turn the device on."""
-        self.communication.turn_on(self._id)
-        self._state = STATE_ON
-        self._assumed_state = True
+        await self._async_write(self.communication.async_turn_on, STATE_ON)
 
-    def turn_off(self, **kwargs):
+    async def async_turn_off(self, **kwargs):
         """Turn the device off."""
-        self.communication.turn_off(self._id)
-        self._state = STATE_OFF
+        await self._async_write(self.communication.async_turn_off, STATE_OFF)
+
+    async def _async_write(self, command, state):
+        """Send a command and assume its state until it is read back,
+        keep the last read state if it failed."""
+        if not await command(self._id, self._node):
+            self._update_from_data()
+            self.async_write_ha_state()
+            raise HomeAssistantError(f"Could not switch {self._name}")
+        self._state = state
         self._assumed_state = True
+        self.async_write_ha_state()
 
     @property
     def assumed_state(self) -> bool:
@@ -142,49 +186,66 @@ class BLNETModeSwitch(SwitchEntity):
     of a digital output of the UVR1611. On means automated
     """
 
-    def __init__(self, switch_id, blnet_id, name, comm):
+    _attr_should_poll = False
+
+    def __init__(self, switch_id, blnet_id, name, comm, node=None,
+                 device=None):
         """Initialize the switch."""
         self._blnet_id = blnet_id
         self._id = switch_id
+        # CAN node of the output, None if only a single node is polled
+        self._node = node
+        # name of the BL-NET, None if it is the only one
+        self._device = device
         self.communication = comm
+        # record of the output, resolved when the entity is added
+        self._channel = None
         self._name = name
         self._friendly_name = name
         self._state = STATE_UNKNOWN
         self._activated = self._state
         self._assumed_state = True
         self._icon = None
-        self._last_updated = None
 
     @property
     def unique_id(self):
         """Return a unique ID for the mode switch."""
-        return f"blnet_mode_switch_{self._id}"
+        return "_".join(
+            str(part) for part in
+            ("blnet_mode_switch", self._device, self._node, self._id)
+            if part is not None)
     
-    def update(self):
+    async def async_added_to_hass(self):
+        """Subscribe to data updates of the digital output."""
+        self._update_from_data()
+        self.async_on_remove(self.communication.async_add_listener(
+            self._blnet_id, self._async_handle_update))
+
+    @callback
+    def _async_handle_update(self):
+        """Handle changed data of the digital output."""
+        self._update_from_data()
+        self.async_write_ha_state()
+
+    def _update_from_data(self):
         """Get the latest data from communication device """
-        # check if new data has arrived
-        last_blnet_update = self.communication.last_updated()
-
-        if last_blnet_update == self._last_updated:
-            return
-
-        sensor_data = self.communication.data.get(self._blnet_id)
+        if self._channel is None:
+            self._channel = self.communication.channel(self._blnet_id)
+        channel = self._channel
 
-        if sensor_data is None:
+        if channel is None:
             return
 
         self._friendly_name = "{} automated".format(
-            sensor_data.get('friendly_name'))
-        if sensor_data.get('mode') == 'HAND':
+            channel.friendly_name)
+        if channel.mode == 'HAND':
             self._state = STATE_OFF
             self._icon = 'mdi:cog-off'
         else:
             self._state = STATE_ON
             self._icon = 'mdi:cog'
         
-        self._activated = sensor_data.get('value')
-
-        self._last_updated = last_blnet_update
+        self._activated = channel.value
         self._assumed_state = False
 
     @property
@@ -192,6 +253,11 @@ class BLNETModeSwitch(SwitchEntity):
         """Return the name of the switch."""
         return self._name
 
+    @property
+    def available(self):
+        """Return False while the BL-NET is not answering."""
+        return self.communication.available
+
     @property
     def state(self):
         """Return the state of the device."""
@@ -214,22 +280,29 @@ class BLNETModeSwitch(SwitchEntity):
         """Return true if device is on."""
         return self._state
 
-    def turn_on(self, **kwargs):
+    async def async_turn_on(self, **kwargs):
         """Turn the device on."""
-        self.communication.turn_auto(self._id)
-        self._state = STATE_ON
-        self._assumed_state = True
+        await self._async_write(self.communication.async_turn_auto, STATE_ON)
 
-    def turn_off(self, **kwargs):
+    async def async_turn_off(self, **kwargs):
         """Turn the device off, in this case meaning to turn off automation,
         an sending a HAND/EIN or HAND/AUS turn manual control on."""
 
         if self._activated == "EIN":
-            self.communication.turn_on(self._id)
+            await self._async_write(self.communication.async_turn_on, STATE_OFF)
         else:
-            self.communication.turn_off(self._id)
-        self._state = STATE_OFF
+            await self._async_write(self.communication.async_turn_off, STATE_OFF)
+
+    async def _async_write(self, command, state):
+        """Send a command and assume its mode until it is read back,
+        keep the last read mode if it failed."""
+        if not await command(self._id, self._node):
+            self._update_from_data()
+            self.async_write_ha_state()
+            raise HomeAssistantError(f"Could not switch the mode of {self._name}")
+        self._state = state
         self._assumed_state = True
+        self.async_write_ha_state()
 
     @property
     def assumed_state(self)->bool:
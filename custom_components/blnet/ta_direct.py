@@ -0,0 +1,383 @@
+"""
+Streaming connection to the TA direct (bootloader) port of a BL-NET
+
+Keeps one TCP connection open and decodes the current data frames with
+precompiled structs as they arrive, instead of scraping the web pages.
+The protocol is the one pyblnet's BLNETDirect speaks.
+"""
+import logging
+import socket
+import struct
+import threading
+import time
+from datetime import datetime
+
+_LOGGER = logging.getLogger(__name__)
+
+# Commands of the bootloader protocol
+GET_MODE = 0x81
+GET_HEADER = 0xAA
+GET_LATEST = 0xAB
+READ_DATA = 0xAC
+END_READ = 0xAD
+WAIT_TIME = 0xBA
+
+# Modes of the bootloader
+CAN_MODE = 0xDC
+DL_MODE = 0xA8
+DL2_MODE = 0xD1
+
+DEFAULT_TIMEOUT = 5
+MAX_RETRIES = 5
+# Longest wait requested by the device that is honoured in seconds
+MAX_WAIT = 10
+
+# Current values of one controller: 16 inputs, the outputs as bit field,
+# 4 speed steps, the heat meter flags and power, kWh and MWh of 2 heat meters
+FRAME = struct.Struct('<16HH4BBlhHlhH')
+# Offsets of the frames in a response to GET_LATEST, the last byte of a
+# response is its checksum
+LATEST_FRAMES = {
+    CAN_MODE: (1,),
+    DL_MODE: (1,),
+    DL2_MODE: (1, 2 + FRAME.size),
+}
+LATEST_SIZE = {
+    CAN_MODE: 2 + FRAME.size,
+    DL_MODE: 2 + FRAME.size,
+    DL2_MODE: 3 + 2 * FRAME.size,
+}
+# Size of the header, known after its first 6 bytes in CAN mode
+HEADER_START = 6
+HEADER_SIZE = {DL_MODE: 13, DL2_MODE: 14}
+
+# Time a record was logged at, it follows the values of each frame
+LOG_TIME = struct.Struct('<6B')
+LOG_DATASET_SIZE = FRAME.size + LOG_TIME.size
+# The logger memory is a ring buffer ending at this address, an empty
+# logger has this address as its oldest and newest record
+LOG_MEMORY_END = 0x07FFFF
+LOG_EMPTY = 0xFFFFFF
+# Records read while holding the connection
+DEFAULT_LOG_CHUNK = 64
+
+# Analog input types
+TYPE_MASK = 0x7000
+TYPE_DIGITAL = 0x1000
+TYPE_TEMP = 0x2000
+TYPE_VOLUME = 0x3000
+TYPE_RAS = 0x7000
+SIGN_BIT = 0x8000
+VALUE_MASK = 0x0FFF
+RAS_VALUE_MASK = 0x01FF
+SPEED_INACTIVE = 0x80
+SPEED_MASK = 0x1F
+
+
+def _checksum_ok(data):
+    """Return whether the last byte is the checksum of the others."""
+    return sum(data[:-1]) % 256 == data[-1]
+
+
+def _convert_analog(value):
+    """Convert a raw input value according to its type."""
+    value_type = value & TYPE_MASK
+    if value_type == TYPE_DIGITAL:
+        return 1 if value & SIGN_BIT else 0
+    mask = RAS_VALUE_MASK if value_type == TYPE_RAS else VALUE_MASK
+    result = value & mask
+    if value & SIGN_BIT:
+        result = -((result ^ mask) + 1)
+    if value_type in (TYPE_TEMP, TYPE_RAS):
+        return round(result * 0.1, 3)
+    if value_type == TYPE_VOLUME:
+        return float(result * 4)
+    return float(result)
+
+
+def decode_frame(buffer, offset=0):
+    """Decode the current values of one controller from a buffer."""
+    values = FRAME.unpack_from(buffer, offset)
+    digital = values[16]
+    active = values[21]
+    heat_meters = (values[22:25], values[25:28])
+    return {
+        'analog': {
+            channel + 1: _convert_analog(value)
+            for channel, value in enumerate(values[:16])
+        },
+        'digital': {
+            channel + 1: (digital >> channel) & 1 for channel in range(16)
+        },
+        'speed': {
+            index + 1: None if value & SPEED_INACTIVE else value & SPEED_MASK
+            for index, value in enumerate(values[17:21])
+        },
+        'energy': {
+            index + 1: round(mwh * 1000 + kwh * 0.1, 3)
+            if active & (1 << index) else None
+            for index, (_, kwh, mwh) in enumerate(heat_meters)
+        },
+        'power': {
+            index + 1: round(power / 2560, 3)
+            if active & (1 << index) else None
+            for index, (power, _, _) in enumerate(heat_meters)
+        },
+    }
+
+
+def decode_latest(response, mode):
+    """Decode all frames of a response to GET_LATEST."""
+    return [decode_frame(response, offset) for offset in LATEST_FRAMES[mode]]
+
+
+def log_layout(mode, frames):
+    """Return the address step between logged records, the size of a
+    response to READ_DATA and the offsets of its frames."""
+    if mode == CAN_MODE:
+        return (64 * frames, 4 + LOG_DATASET_SIZE * frames,
+                [3 + LOG_DATASET_SIZE * frame for frame in range(frames)])
+    if mode == DL_MODE:
+        return 64, 65, [0]
+    return 128, 126, [0, 3 + LOG_DATASET_SIZE]
+
+
+def decode_log_record(response, offsets):
+    """
+    Decode a response to READ_DATA
+
+    Returns the time the record was logged at and the values of all
+    frames, keyed by frame, or None if the record is empty.
+    """
+    if not any(response[offsets[0]:offsets[0] + FRAME.size]):
+        return None
+    seconds, minutes, hours, day, month, year = LOG_TIME.unpack_from(
+        response, offsets[0] + FRAME.size)
+    try:
+        logged = datetime(2000 + year, month, day, hours, minutes, seconds)
+    except ValueError:
+        return None
+    return logged, {
+        frame: decode_frame(response, offset)
+        for frame, offset in enumerate(offsets)
+    }
+
+
+class BLNETDirectConnection:
+    """Persistent connection to the TA direct port of a BL-NET."""
+
+    def __init__(self, address, port=40000, timeout=DEFAULT_TIMEOUT):
+        """Initialize the connection, nothing is sent yet."""
+        self.address = address
+        self.port = port
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._socket = None
+        self._mode = None
+        self._frames = None
+        # responses are read into this buffer without copying
+        self._buffer = bytearray(max(LATEST_SIZE.values()))
+        # CaptureWriter recording the responses, if any
+        self.capture = None
+        # CycleStats counting the requests, if any
+        self.stats = None
+
+    def _connect(self):
+        """Open the connection if it is not open yet."""
+        if self._socket is None:
+            _LOGGER.debug(f"Connecting to TA direct port {self.address}:{self.port}")
+            self._socket = socket.create_connection(
+                (self.address, self.port), self.timeout)
+
+    def _send(self, *command):
+        """Send a command of single bytes."""
+        self._socket.sendall(bytes(command))
+
+    def _read(self, size, offset=0):
+        """Read exactly size bytes into the buffer behind offset."""
+        if offset + size > len(self._buffer):
+            self._buffer.extend(bytes(offset + size - len(self._buffer)))
+        view = memoryview(self._buffer)[offset:offset + size]
+        received = 0
+        while received < size:
+            count = self._socket.recv_into(view[received:], size - received)
+            if count == 0:
+                raise ConnectionError("TA direct connection closed by BL-NET")
+            received += count
+        return memoryview(self._buffer)[:offset + size]
+
+    def probe(self):
+        """Check that the bootloader answers in a supported mode."""
+        with self.lock:
+            try:
+                self._query_mode()
+            except OSError as ex:
+                self.close()
+                raise ConnectionError(
+                    f"No TA direct access at {self.address}:{self.port}: {ex}"
+                ) from ex
+
+    def _query_mode(self):
+        """Read the mode of the bootloader."""
+        self._connect()
+        self._send(GET_MODE)
+        mode = self._read(1)[0]
+        if mode not in LATEST_SIZE:
+            raise ConnectionError(f"BL-Net mode {mode:#x} is not supported")
+        self._mode = mode
+
+    def _read_header(self):
+        """Read the header of the data logger for the number of frames,
+        return the addresses of its oldest and newest record."""
+        self._send(GET_HEADER)
+        if self._mode == CAN_MODE:
+            frames = self._read(HEADER_START)[HEADER_START - 1]
+            header = self._read(frames + 7, HEADER_START)
+        else:
+            frames = 1
+            header = self._read(HEADER_SIZE[self._mode])
+        if not _checksum_ok(header):
+            raise ConnectionError("Invalid checksum of TA direct header")
+        self._frames = frames
+        # both addresses are the last bytes before the checksum
+        return (int.from_bytes(header[-7:-4], 'little'),
+                int.from_bytes(header[-4:-1], 'little'))
+
+    def _read_latest(self, frame, max_retries):
+        """Read the response with the current values of a frame, waiting
+        if asked to. It is only valid until the next read."""
+        for _ in range(max_retries):
+            self._send(GET_LATEST, frame + 1)
+            if self._read(1)[0] == WAIT_TIME:
+                response = self._read(2, 1)
+                if _checksum_ok(response):
+                    time.sleep(min(response[1], MAX_WAIT))
+                continue
+            response = self._read(LATEST_SIZE[self._mode] - 1, 1)
+            if not _checksum_ok(response):
+                continue
+            if self.stats is not None:
+                self.stats.count('requests')
+                self.stats.count('bytes', len(response))
+            return response
+        raise ConnectionError(f"Could not get latest data of frame {frame}")
+
+    def _get_latest(self, max_retries):
+        """Read the current values of all frames."""
+        if self._mode is None:
+            self._query_mode()
+        self._connect()
+        if self._frames is None:
+            self._read_header()
+        values = []
+        # the mode followed by the responses of all frames
+        raw = bytearray([self._mode])
+        for frame in range(self._frames):
+            response = self._read_latest(frame, max_retries)
+            values.extend(decode_latest(response, self._mode))
+            if self.capture is not None:
+                raw += response
+        self._end_read()
+        if self.capture is not None:
+            self.capture.write('direct', raw)
+        return dict(enumerate(values))
+
+    def _end_read(self):
+        """Leave the read mode of the bootloader."""
+        self._send(END_READ)
+        if self._read(1)[0] != END_READ:
+            raise ConnectionError("End read command failed")
+
+    def _read_log_record(self, address, size):
+        """Read the logged record at an address, the response is only
+        valid until the next read."""
+        low, middle, high = (address & 0xFF, (address & 0x7F00) >> 7,
+                             (address & 0xFF8000) >> 15)
+        self._send(READ_DATA, low, middle, high, 1,
+                   (READ_DATA + 1 + low + middle + high) % 256)
+        response = self._read(size)
+        if not _checksum_ok(response):
+            raise ConnectionError(f"Invalid checksum of logged record {address:#x}")
+        if self.stats is not None:
+            self.stats.count('requests')
+            self.stats.count('bytes', size)
+        return response
+
+    def read_log(self, since=None, chunk_size=DEFAULT_LOG_CHUNK):
+        """
+        Read the records of the data logger, newest first
+
+        Yields lists of up to chunk_size tuples of the time a record was
+        logged at and its values, keyed by frame like get_latest. The
+        connection is only held while a chunk is read, so updates go on
+        in between. Reading stops at the first record logged before the
+        naive local time since.
+        """
+        address = None
+        remaining = 1
+        while remaining > 0:
+            chunk = []
+            with self.lock:
+                try:
+                    if address is None:
+                        if self._mode is None:
+                            self._query_mode()
+                        self._connect()
+                        start, end = self._read_header()
+                        step, size, offsets = log_layout(self._mode, self._frames)
+                        last = (LOG_MEMORY_END // step) * step
+                        if LOG_EMPTY in (start, end):
+                            remaining = 0
+                        elif end >= start:
+                            remaining = (end - start) // step + 1
+                        else:
+                            # the newest records wrapped around
+                            remaining = (last - start + end) // step + 2
+                        address = end
+                    while remaining > 0 and len(chunk) < chunk_size:
+                        record = decode_log_record(
+                            self._read_log_record(address, size), offsets)
+                        remaining -= 1
+                        address = address - step if address >= step else last
+                        if record is None:
+                            continue
+                        if since is not None and record[0] < since:
+                            remaining = 0
+                            break
+                        chunk.append(record)
+                    self._end_read()
+                except OSError:
+                    self.close()
+                    raise
+            if chunk:
+                yield chunk
+
+    def get_latest(self, max_retries=MAX_RETRIES):
+        """
+        Fetch the current values of all frames, keyed by frame
+
+        A connection closed in the meantime is opened again once.
+        """
+        with self.lock:
+            reconnect = self._socket is not None
+            try:
+                return self._get_latest(max_retries)
+            except OSError:
+                self.close()
+                if not reconnect:
+                    raise
+            _LOGGER.debug("TA direct connection was lost, reconnecting")
+            try:
+                return self._get_latest(max_retries)
+            except OSError:
+                self.close()
+                raise
+
+    def close(self):
+        """Close the connection."""
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            finally:
+                self._socket = None
+                self._frames = None
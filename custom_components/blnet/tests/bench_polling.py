@@ -0,0 +1,102 @@
+"""
+Benchmark polling the simulated BL-NET
+
+Measures the first update, which discovers all channels, and the steady
+state updates afterwards for several numbers of nodes and channels,
+answer latencies and failing logins. Run it with
+
+    python -m custom_components.blnet.tests.bench_polling [cycles]
+"""
+import statistics
+import sys
+import time
+import tracemalloc
+from unittest.mock import Mock, patch
+
+from custom_components.blnet import BLNETConnector, BLNETDataHandler
+from custom_components.blnet.tests.simulator import BLNETSimulator, PASSWORD
+
+# nodes, analog channels, digital channels, latency, failing logins, use_ta
+SCENARIOS = (
+    (1, 16, 15, 0.0, 0, False),
+    (1, 16, 15, 0.0, 0, True),
+    (3, 16, 15, 0.0, 0, True),
+    (1, 16, 15, 0.02, 0, False),
+    (1, 16, 15, 0.02, 0, True),
+    (3, 16, 15, 0.02, 1, True),
+)
+
+
+def _update(handler):
+    """Update the handler, logins failing on purpose are retried."""
+    try:
+        handler.update()
+    except ConnectionError:
+        handler.update()
+
+
+def run(nodes, analog, digital, latency, login_failures, use_ta, cycles):
+    """Poll a simulated BL-NET and return the measurements."""
+    with BLNETSimulator(nodes=nodes, analog=analog, digital=digital,
+                        latency=latency,
+                        login_failures=login_failures) as sim:
+        web = sim.web_address
+        connector = BLNETConnector(
+            resource=web[:web.rindex(':')], password=PASSWORD,
+            web_port=int(web[web.rindex(':') + 1:]), ta_port=sim.ta_port,
+            use_ta=use_ta, nodes=list(sim.nodes))
+        try:
+            handler = BLNETDataHandler(
+                connector.connect(), list(sim.nodes), Mock(),
+                {'use_web': True})
+            tracemalloc.start()
+            start = time.perf_counter()
+            _update(handler)
+            discovery = time.perf_counter() - start
+            requests = sim.requests
+            # every discovered entity is enabled
+            for blnet_id in handler.data:
+                handler.async_add_listener(blnet_id, lambda: None)
+            durations = []
+            for _ in range(cycles):
+                sim.advance()
+                # as if the scan intervals of all domains passed
+                handler._domain_updated.clear()
+                start = time.perf_counter()
+                _update(handler)
+                durations.append(time.perf_counter() - start)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            connector.close()
+        durations.sort()
+        return {
+            'discovery': discovery,
+            'mean': statistics.mean(durations),
+            'p95': durations[int(0.95 * (len(durations) - 1))],
+            'requests': (sim.requests - requests) / cycles,
+            'entities': len(handler.data),
+            'peak': peak,
+        }
+
+
+def main(cycles=50):
+    """Print a table of all scenarios."""
+    print(f"{'nodes':>5} {'chan':>5} {'lat ms':>6} {'fail':>4} {'ta':>3} "
+          f"{'disc ms':>8} {'mean ms':>8} {'p95 ms':>8} {'req/cyc':>7} "
+          f"{'ents':>5} {'peak KiB':>8}")
+    with patch('custom_components.blnet.async_load_platform', new_callable=Mock):
+        for nodes, analog, digital, latency, failures, use_ta in SCENARIOS:
+            result = run(nodes, analog, digital, latency, failures, use_ta,
+                         cycles)
+            print(f"{nodes:>5} {analog + digital:>5} {latency * 1000:>6.0f} "
+                  f"{failures:>4} {'yes' if use_ta else 'no':>3} "
+                  f"{result['discovery'] * 1000:>8.1f} "
+                  f"{result['mean'] * 1000:>8.1f} "
+                  f"{result['p95'] * 1000:>8.1f} "
+                  f"{result['requests']:>7.1f} {result['entities']:>5} "
+                  f"{result['peak'] / 1024:>8.0f}")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
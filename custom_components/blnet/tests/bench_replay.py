@@ -0,0 +1,65 @@
+"""
+Benchmark parsing and applying recorded answers
+
+Replays a capture through a data handler as fast as possible. Without
+a capture file the traffic of the simulated BL-NET is recorded first.
+Run it with
+
+    python -m custom_components.blnet.tests.bench_replay [capture] [nodes]
+"""
+import os
+import sys
+import tempfile
+import time
+from unittest.mock import Mock, patch
+
+from custom_components.blnet import BLNETConnector, BLNETDataHandler
+from custom_components.blnet.capture import ReplayBackend, replay
+from custom_components.blnet.tests.simulator import BLNETSimulator, PASSWORD
+
+
+def record(path, nodes=2, updates=200):
+    """Record updates of a simulated BL-NET with the direct port."""
+    with BLNETSimulator(nodes=nodes) as sim:
+        web = sim.web_address
+        connector = BLNETConnector(
+            resource=web[:web.rindex(':')], password=PASSWORD,
+            web_port=int(web[web.rindex(':') + 1:]), ta_port=sim.ta_port,
+            use_ta=True, nodes=list(sim.nodes), capture=path)
+        try:
+            handler = BLNETDataHandler(
+                connector.connect(), list(sim.nodes), Mock(), {})
+            for _ in range(updates):
+                sim.advance()
+                # every update reads all pages
+                handler._last_full_fetch = None
+                handler.update()
+        finally:
+            connector.close()
+
+
+def main(path=None, nodes=None):
+    """Print the replay rate of a capture."""
+    with tempfile.TemporaryDirectory() as directory, \
+            patch('custom_components.blnet.async_load_platform', new_callable=Mock):
+        if path is None:
+            path = os.path.join(directory, 'capture.bin')
+            record(path)
+            print(f"Recorded {os.path.getsize(path)} bytes")
+        nodes = None if nodes is None else [int(node) for node in nodes.split(',')]
+        start = time.perf_counter()
+        backend = ReplayBackend(path, nodes)
+        loaded = time.perf_counter() - start
+        handler = BLNETDataHandler(
+            backend, nodes or list(backend.direct_frames) or [None], Mock(), {})
+        start = time.perf_counter()
+        updates = replay(handler)
+        duration = time.perf_counter() - start
+        print(f"Loaded the capture in {loaded * 1000:.1f} ms")
+        print(f"Replayed {backend.consumed} answers in {updates} updates "
+              f"in {duration * 1000:.1f} ms, "
+              f"{duration / max(updates, 1) * 1e6:.0f} us per update")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
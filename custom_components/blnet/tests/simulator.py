@@ -0,0 +1,284 @@
+"""
+Local simulation of a BL-NET for end-to-end tests and benchmarks
+
+Serves the pages of the web interface and the TA direct port with a
+configurable number of CAN nodes and channels, answer latency and
+failing logins. Values drift on every call of advance(), log() stores
+them in the data logger.
+"""
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from custom_components.blnet.ta_direct import FRAME, LOG_EMPTY
+
+PASSWORD = '0123'
+COOKIE = 'TAID="5A5A"'
+
+PAGE = (
+    '<html><head><title>UVR1611 / Knoten {node}</title></head><body>'
+    '<div class="c"><div class="ze cen bgb">{title}<br></div>'
+    '<div class="ze cen"><div class="c" style="width:21em;"> '
+    '{rows}</div></div></div></body></html>'
+)
+ANALOG_ROW = (
+    '&nbsp;{id}:&nbsp;{name}<br>&nbsp;&nbsp;&nbsp;{sign}&nbsp;{value} &deg;C '
+    '&nbsp;&nbsp;PAR?<span class="pf"><button type="button">&lt;=</button>'
+    '</span><br>'
+)
+DIGITAL_ROW = (
+    '&nbsp;{id}:&nbsp;{name}<br>&nbsp;&nbsp;&nbsp;&nbsp;{mode}/{value}'
+    '<span id="A12000{id:02X}"><button type="button">&#8249;&#8250;</button>'
+    '</span>&nbsp;&nbsp;&nbsp;PAR?<br>'
+)
+DENIED_PAGE = '<html><head><title>BL-Net Zugang verweigert</title></head></html>'
+MAIN_PAGE = '<html><head><title>BL-Net Menü</title></head></html>'
+OUTPUT_MODES = {'1': ('HAND', 'AUS'), '2': ('HAND', 'EIN'), '3': ('AUTO', None)}
+
+
+class SimulatedNode:
+    """Values of a single controller on the CAN bus."""
+
+    def __init__(self, node, analog, digital, rng):
+        self.node = node
+        self.analog = {
+            channel: round(rng.uniform(-10, 80), 1)
+            for channel in range(1, analog + 1)
+        }
+        self.digital = {
+            channel: ['AUTO', rng.choice(['AUS', 'EIN'])]
+            for channel in range(1, digital + 1)
+        }
+
+    def analog_page(self):
+        """Render the page of the analog values."""
+        rows = ''.join(
+            ANALOG_ROW.format(
+                id=channel, name=f'T{self.node}.{channel}',
+                sign='-' if value < 0 else '&nbsp;',
+                value=f'{abs(value):.1f}'.replace('.', ','))
+            for channel, value in self.analog.items()
+        )
+        return PAGE.format(node=self.node, title='EINGAENGE', rows=rows)
+
+    def digital_page(self):
+        """Render the page of the digital values."""
+        rows = ''.join(
+            DIGITAL_ROW.format(id=channel, name=f'A{self.node}.{channel}',
+                               mode=mode, value=value)
+            for channel, (mode, value) in self.digital.items()
+        )
+        return PAGE.format(node=self.node, title='AUSGAENGE', rows=rows)
+
+    def frame(self):
+        """Encode the current values like the TA direct port does."""
+        analog = [
+            (int(round(value * 10)) & 0x0FFF) | 0x2000 | (0x8000 if value < 0 else 0)
+            for value in list(self.analog.values())[:16]
+        ]
+        analog += [0] * (16 - len(analog))
+        digital = sum(
+            1 << (channel - 1) for channel, (_, value) in self.digital.items()
+            if value == 'EIN' and channel <= 16
+        )
+        return FRAME.pack(*analog, digital, 0x80, 5, 5, 5, 1,
+                          10240, 12, 5, 0, 0, 0)
+
+
+class BLNETSimulator:
+    """Serves the web interface and the TA direct port of a fake BL-NET."""
+
+    def __init__(self, nodes=1, analog=16, digital=15, latency=0.0,
+                 password=PASSWORD, login_failures=0, change_ratio=0.2,
+                 seed=0):
+        self.latency = latency
+        self.password = password
+        self.login_failures = login_failures
+        self.change_ratio = change_ratio
+        self.requests = 0
+        self.logins = 0
+        self.node = 1
+        self._rng = random.Random(seed)
+        self.nodes = {
+            node: SimulatedNode(node, analog, digital, self._rng)
+            for node in range(1, nodes + 1)
+        }
+        # logged times and frames of all nodes, oldest first
+        self.logged = []
+        self._lock = threading.Lock()
+        self._web = None
+        self._direct = None
+
+    @property
+    def web_address(self):
+        """Return the address of the web interface."""
+        return 'http://127.0.0.1:{}'.format(self._web.server_address[1])
+
+    @property
+    def ta_port(self):
+        """Return the port of the TA direct access."""
+        return self._direct.server_address[1]
+
+    def start(self):
+        """Start serving in background threads."""
+        simulator = self
+
+        class WebHandler(_WebHandler):
+            sim = simulator
+
+        class DirectHandler(_DirectHandler):
+            sim = simulator
+
+        self._web = ThreadingHTTPServer(('127.0.0.1', 0), WebHandler)
+        self._direct = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', 0), DirectHandler)
+        for server in (self._web, self._direct):
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        for server in (self._web, self._direct):
+            server.shutdown()
+            server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def advance(self):
+        """Let a part of the analog values drift."""
+        with self._lock:
+            for node in self.nodes.values():
+                for channel in node.analog:
+                    if self._rng.random() < self.change_ratio:
+                        node.analog[channel] = round(
+                            node.analog[channel] + self._rng.uniform(-1, 1), 1)
+
+    def log(self, logged):
+        """Store the current values in the data logger at a naive time."""
+        with self._lock:
+            self.logged.append(
+                (logged, [node.frame() for node in self.nodes.values()]))
+
+    def _wait(self):
+        """Count a request and answer it with the configured latency."""
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class _WebHandler(BaseHTTPRequestHandler):
+    """Answers like the web interface of a BL-NET."""
+
+    sim = None
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        """Keep the output clean."""
+
+    def _answer(self, text, cookie=False):
+        body = text.encode('latin-1', 'replace')
+        self.send_response(200)
+        if cookie:
+            self.send_header('Set-Cookie', COOKIE)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        sim = self.sim
+        sim._wait()
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        with sim._lock:
+            accepted = form.get('blp', [None])[0] == sim.password
+            if accepted and sim.login_failures:
+                sim.login_failures -= 1
+                accepted = False
+            if accepted:
+                sim.logins += 1
+        self._answer(MAIN_PAGE, cookie=accepted)
+
+    def do_GET(self):
+        sim = self.sim
+        sim._wait()
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/':
+            return self._answer(MAIN_PAGE)
+        if sim.password is not None and self.headers.get('Cookie') != COOKIE:
+            return self._answer(DENIED_PAGE)
+        with sim._lock:
+            if url.path == '/can.htm':
+                sim.node = int(query['blaB'][0])
+                return self._answer(MAIN_PAGE, cookie=True)
+            node = sim.nodes[sim.node]
+            if url.path == '/580500.htm':
+                return self._answer(node.analog_page(), cookie=True)
+            if url.path == '/580600.htm':
+                for key, (value,) in query.items():
+                    if key.startswith('blw91A1200'):
+                        channel = int(key[len('blw91A1200'):], 16)
+                        mode, state = OUTPUT_MODES[value]
+                        node.digital[channel] = [
+                            mode, state or node.digital[channel][1]]
+                return self._answer(node.digital_page(), cookie=True)
+        return self._answer(MAIN_PAGE, cookie=True)
+
+
+class _DirectHandler(socketserver.BaseRequestHandler):
+    """Answers like the bootloader of a BL-NET in CAN mode."""
+
+    sim = None
+
+    def _send(self, data):
+        self.request.sendall(data + bytes([sum(data) % 256]))
+
+    def handle(self):
+        sim = self.sim
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        while True:
+            command = self.request.recv(1)
+            if not command:
+                return
+            sim._wait()
+            if command == b'\x81':
+                self.request.sendall(b'\xdc')
+            elif command == b'\xaa':
+                frames = len(sim.nodes)
+                with sim._lock:
+                    count = len(sim.logged)
+                start, end = (0, (count - 1) * 64 * frames) if count else (
+                    LOG_EMPTY, LOG_EMPTY)
+                self._send(struct.pack('<BB3sB', 0x80, 1, bytes(3), frames)
+                           + bytes(frames) + start.to_bytes(3, 'little')
+                           + end.to_bytes(3, 'little'))
+            elif command == b'\xac':
+                low, middle, high, _, _ = self.request.recv(5, socket.MSG_WAITALL)
+                address = low | middle << 7 | high << 15
+                with sim._lock:
+                    logged, frames = sim.logged[address // (64 * len(sim.nodes))]
+                times = struct.pack(
+                    '<6B', logged.second, logged.minute, logged.hour,
+                    logged.day, logged.month, logged.year - 2000)
+                self._send(bytes(3) + b''.join(frame + times for frame in frames))
+            elif command == b'\xab':
+                frame = self.request.recv(1)[0]
+                with sim._lock:
+                    node = sim.nodes[frame]
+                    self._send(b'\x80' + node.frame())
+            elif command == b'\xad':
+                self.request.sendall(b'\xad')
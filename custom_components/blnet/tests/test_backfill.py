@@ -0,0 +1,138 @@
+"""Tests for importing the data logger into long-term statistics."""
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import Mock, patch
+
+from homeassistant.util import dt as dt_util
+
+from custom_components.blnet import BLNETConnector, BLNETDataHandler
+from custom_components.blnet.backfill import (
+    HourlyStatistics, logged_time, statistic_channels,
+)
+from custom_components.blnet.tests.simulator import BLNETSimulator, PASSWORD
+
+START = datetime(2024, 1, 15, 10, 0)
+
+
+def record(analog=None, energy=None):
+    """Return the values of a logged record of one frame."""
+    return {0: {'analog': {1: analog}, 'energy': {1: energy}}}
+
+
+class TestHourlyStatistics(unittest.TestCase):
+    """Test aggregating logged records to hourly statistics."""
+
+    def setUp(self):
+        """Aggregate a temperature and a heat meter."""
+        self.channels = {
+            (0, 'analog', 1): 'blnet:blnet_analog_1',
+            (0, 'energy', 1): 'blnet:blnet_energy_1',
+        }
+        self.meters = {'blnet:blnet_energy_1'}
+
+    def test_hours(self):
+        """Test complete hours get mean, min, max and meter readings."""
+        aggregated = HourlyStatistics(self.channels)
+        # newest first, like the logger is read
+        for minutes, analog, energy in ((130, 30.0, 12.0), (70, 25.0, 11.5),
+                                        (60, 20.0, 11.0), (50, 12.0, 10.5),
+                                        (10, 10.0, 10.0)):
+            aggregated.add(START + timedelta(minutes=minutes),
+                           record(analog, energy))
+        statistics = aggregated.statistics(self.meters)
+
+        first = logged_time(START)
+        self.assertEqual(aggregated.records, 5)
+        # the hour of the newest record is not complete yet
+        self.assertEqual(statistics['blnet:blnet_analog_1'], [
+            {'start': first, 'mean': 11.0, 'min': 10.0, 'max': 12.0},
+            {'start': first + timedelta(hours=1),
+             'mean': 22.5, 'min': 20.0, 'max': 25.0},
+        ])
+        self.assertEqual(statistics['blnet:blnet_energy_1'], [
+            {'start': first, 'state': 10.5, 'sum': 10.5},
+            {'start': first + timedelta(hours=1), 'state': 11.5, 'sum': 11.5},
+        ])
+        self.assertEqual(first.tzinfo, dt_util.UTC)
+
+    def test_resume(self):
+        """Test records before the resumed hour and inactive meters are
+        left out."""
+        since = logged_time(START) + timedelta(hours=1)
+        aggregated = HourlyStatistics(self.channels, since)
+        for minutes in (150, 90, 30):
+            aggregated.add(START + timedelta(minutes=minutes), record(20.0))
+        statistics = aggregated.statistics(self.meters)
+
+        self.assertEqual(aggregated.records, 2)
+        self.assertEqual(list(statistics), ['blnet:blnet_analog_1'])
+        self.assertEqual([row['start'] for row in statistics['blnet:blnet_analog_1']],
+                         [since])
+
+
+class TestLoggerImport(unittest.TestCase):
+    """Test reading the data logger of the simulated BL-NET."""
+
+    def setUp(self):
+        """Start a simulated BL-NET with two nodes and a filled logger."""
+        self.sim = BLNETSimulator(nodes=2, analog=4, digital=3).start()
+        self.addCleanup(self.sim.stop)
+        self.history = []
+        for index in range(150):
+            self.sim.advance()
+            self.sim.log(START + timedelta(minutes=index))
+            self.history.append(self.sim.nodes[2].analog[3])
+        web = self.sim.web_address
+        self.connector = BLNETConnector(
+            resource=web[:web.rindex(':')], password=PASSWORD,
+            web_port=int(web[web.rindex(':') + 1:]),
+            ta_port=self.sim.ta_port, use_ta=True, nodes=[1, 2])
+        self.addCleanup(self.connector.close)
+
+    def test_read_log(self):
+        """Test the records are read in chunks, newest first, and stop
+        before the requested time."""
+        direct = self.connector.connect().direct
+        chunks = list(direct.read_log(chunk_size=64))
+        self.assertEqual([len(chunk) for chunk in chunks], [64, 64, 22])
+        records = [record for chunk in chunks for record in chunk]
+        self.assertEqual(records[0][0], START + timedelta(minutes=149))
+        self.assertEqual(records[-1][0], START)
+        self.assertEqual([values[1]['analog'][3] for _, values in records],
+                         self.history[::-1])
+
+        since = START + timedelta(minutes=100)
+        records = [record for chunk in direct.read_log(since) for record in chunk]
+        self.assertEqual(len(records), 50)
+
+        # the polls still work in between
+        self.assertEqual(direct.get_latest()[1]['analog'][3], self.history[-1])
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_channels(self, mock_load_platform):
+        """Test the discovered channels are mapped to the logged frames."""
+        handler = BLNETDataHandler(
+            self.connector.connect(), [1, 2], Mock(), {})
+        handler.update()
+        channels = statistic_channels(handler)
+
+        meta = channels[(1, 'analog', 3)]
+        self.assertEqual(meta['statistic_id'], 'blnet:blnet_2_analog_3')
+        self.assertEqual(meta['name'], 'Node 2 T2.3')
+        self.assertEqual(meta['unit_of_measurement'], '°C')
+        self.assertTrue(meta['has_mean'])
+        self.assertTrue(channels[(0, 'energy', 1)]['has_sum'])
+        self.assertNotIn((0, 'speed', 1), channels)
+
+        aggregated = HourlyStatistics({
+            key: meta['statistic_id'] for key, meta in channels.items()})
+        for chunk in handler.blnet.direct.read_log():
+            for logged, values in chunk:
+                aggregated.add(logged, values)
+        rows = aggregated.statistics()['blnet:blnet_2_analog_3']
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['max'], max(self.history[:60]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+"""Tests for the circuit breaker of the updates."""
+import unittest
+
+from custom_components.blnet.breaker import CircuitBreaker
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Test the CircuitBreaker class."""
+
+    def test_backoff(self):
+        """Test pauses double up to the maximum, varied by the jitter."""
+        breaker = CircuitBreaker(threshold=2, min_backoff=10, max_backoff=35,
+                                 jitter=0.2, rng=lambda: 1.0)
+        self.assertFalse(breaker.record_failure())
+        self.assertTrue(breaker.allow())
+
+        pauses = []
+        for _ in range(4):
+            self.assertTrue(breaker.record_failure())
+            self.assertFalse(breaker.allow())
+            pauses.append(round(breaker.remaining()))
+        self.assertEqual(pauses, [12, 24, 42, 42])
+
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.record_failure())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Tests for recording and replaying answers of a device."""
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from custom_components.blnet import BLNETConnector, BLNETDataHandler
+from custom_components.blnet.capture import (
+    CaptureWriter, ReplayBackend, read_capture, replay,
+)
+from custom_components.blnet.tests.simulator import BLNETSimulator, PASSWORD
+
+
+class TestCaptureFile(unittest.TestCase):
+    """Test writing and reading capture files."""
+
+    def setUp(self):
+        """Create a directory for the captures."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'capture.bin')
+
+    def test_rotate(self):
+        """Test records are read across rotated files, oldest first."""
+        writer = CaptureWriter(self.path, max_bytes=200, backup_count=2)
+        for index in range(50):
+            writer.write('digital', os.urandom(20) + bytes([index]), 2)
+        writer.close()
+        self.assertTrue(os.path.exists(self.path + '.2'))
+        self.assertFalse(os.path.exists(self.path + '.3'))
+
+        records = list(read_capture(self.path))
+        indices = [payload[-1] for _, _, _, payload in records]
+        self.assertEqual(indices, list(range(50 - len(indices), 50)))
+        self.assertEqual({(node, kind) for _, node, kind, _ in records},
+                         {(2, 'digital')})
+
+    def test_interrupted(self):
+        """Test an incomplete last record is skipped."""
+        writer = CaptureWriter(self.path)
+        writer.write('direct', b'first')
+        writer.write('direct', b'second')
+        with open(self.path, 'rb') as capture:
+            data = capture.read()
+        with open(self.path, 'wb') as capture:
+            capture.write(data[:-8])
+        self.assertEqual(
+            [payload for *_, payload in read_capture(self.path)], [b'first'])
+        writer.close()
+
+        # a new writer keeps the previous capture
+        writer = CaptureWriter(self.path)
+        writer.write('direct', b'third')
+        writer.close()
+        self.assertTrue(os.path.exists(self.path + '.1'))
+
+
+class TestReplay(unittest.TestCase):
+    """Test replaying the traffic of the simulated BL-NET."""
+
+    def setUp(self):
+        """Start a simulated BL-NET with two nodes."""
+        self.sim = BLNETSimulator(nodes=2, analog=4, digital=3).start()
+        self.addCleanup(self.sim.stop)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'capture.bin')
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_replay(self, mock_load_platform):
+        """Test a replay ends with the values of the recorded updates."""
+        web = self.sim.web_address
+        connector = BLNETConnector(
+            resource=web[:web.rindex(':')], password=PASSWORD,
+            web_port=int(web[web.rindex(':') + 1:]), ta_port=self.sim.ta_port,
+            use_ta=True, nodes=[1, 2], capture=self.path)
+        handler = BLNETDataHandler(connector.connect(), [1, 2], Mock(), {})
+        for _ in range(3):
+            self.sim.advance()
+            handler._last_full_fetch = None
+            handler.update()
+        connector.close()
+
+        backend = ReplayBackend(self.path)
+        self.assertEqual(backend.direct_frames, {1: 0, 2: 1})
+        replayed = BLNETDataHandler(backend, [1, 2], Mock(), {})
+        self.assertEqual(replay(replayed), 3)
+        self.assertTrue(backend.exhausted)
+        self.assertEqual(replayed.data, handler.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
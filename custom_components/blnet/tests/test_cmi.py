@@ -0,0 +1,146 @@
+"""Tests for the C.M.I. JSON API backend."""
+import base64
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+from custom_components.blnet import BLNETConnector
+from custom_components.blnet.cmi import CMIBackend, parse_cmi_response
+
+RESPONSE = {
+    'Header': {'Version': 5, 'Device': '80', 'Timestamp': 1700000000},
+    'Data': {
+        'Inputs': [
+            {'Number': 1, 'AD': 'A', 'Value': {'Value': 52.3, 'Unit': '1'}},
+            {'Number': 2, 'AD': 'A', 'Value': {'Value': -3.5, 'Unit': '1'}},
+        ],
+        'Outputs': [
+            {'Number': 1, 'AD': 'D', 'Value': {'Value': 1, 'Unit': '43'}},
+            {'Number': 2, 'AD': 'D', 'Value': {'Value': 0, 'Unit': '43'}},
+            {'Number': 6, 'AD': 'A', 'Value': {'Value': 21, 'Unit': '0'}},
+        ],
+        'Logging Analog': [
+            {'Number': 1, 'AD': 'A', 'Value': {'Value': 4.2, 'Unit': '10'}},
+            {'Number': 2, 'AD': 'A', 'Value': {'Value': 1234.5, 'Unit': '11'}},
+        ],
+    },
+    'Status': 'OK',
+    'Status code': 0,
+}
+CREDENTIALS = 'Basic ' + base64.b64encode(b'admin:secret').decode()
+
+
+class FakeCMI(BaseHTTPRequestHandler):
+    """Answers the API requests like a C.M.I."""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.headers.get('Authorization') != CREDENTIALS:
+            self.send_response(401)
+            self.end_headers()
+            return
+        body = json.dumps(RESPONSE).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keep the test output clean."""
+
+
+class TestParser(unittest.TestCase):
+    """Test mapping responses of the API."""
+
+    def test_parse(self):
+        """Test all values end up in the domains of the data handler."""
+        data = parse_cmi_response(RESPONSE)
+        self.assertEqual(data['analog'][2], {
+            'name': 'Input 2', 'value': -3.5, 'unit_of_measurement': '°C'})
+        self.assertEqual(data['digital'][1]['value'], 'EIN')
+        self.assertEqual(data['digital'][2]['value'], 'AUS')
+        self.assertEqual(data['speed'], {6: {'name': 'Speed 6', 'value': 21}})
+        self.assertEqual(data['power'][1]['value'], 4.2)
+        self.assertEqual(data['energy'][2]['unit_of_measurement'], 'kWh')
+
+    def test_status_error(self):
+        """Test errors reported by the API raise."""
+        with self.assertRaises(ConnectionError):
+            parse_cmi_response({'Status': 'TOO MANY REQUESTS', 'Status code': 4})
+
+
+class TestCMIBackend(unittest.TestCase):
+    """Test the CMIBackend class against a fake C.M.I."""
+
+    def setUp(self):
+        """Start the fake C.M.I."""
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeCMI)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.address = '127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        """Stop the fake C.M.I."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch(self):
+        """Test a node is read in a single request and reused for a minute."""
+        backend = CMIBackend(self.address, password='secret')
+        backend.probe()
+
+        data = backend.fetch(2, {'analog'})
+        self.assertEqual(data['analog'][1]['value'], 52.3)
+        self.assertIs(backend.fetch(2), data)
+        self.assertEqual(self.server.requests, [
+            '/', '/INCLUDE/api.cgi?jsonnode=2&jsonparam=I,O,La'])
+        self.assertFalse(backend.can_write)
+        with self.assertRaises(EnvironmentError):
+            backend.turn_on(1)
+        backend.close()
+
+    @patch('custom_components.blnet.cmi.time.monotonic')
+    def test_nodes_take_turns(self, mock_monotonic):
+        """Test the rate limit holds for all nodes and they are requested
+        in turn."""
+        mock_monotonic.return_value = 1000.0
+        backend = CMIBackend(self.address, password='secret')
+        node1 = backend.fetch(1)
+        # a second node within the limit has no values yet
+        self.assertEqual(backend.fetch(2), {})
+
+        # the waiting node gets the next request, even when asked second
+        mock_monotonic.return_value = 1100.0
+        self.assertIs(backend.fetch(1), node1)
+        node2 = backend.fetch(2)
+        self.assertEqual(node2['analog'][1]['value'], 52.3)
+
+        mock_monotonic.return_value = 1200.0
+        self.assertIsNot(backend.fetch(1), node1)
+        self.assertIs(backend.fetch(2), node2)
+        self.assertEqual(self.server.requests, [
+            '/INCLUDE/api.cgi?jsonnode={}&jsonparam=I,O,La'.format(node)
+            for node in (1, 2, 1)])
+
+    def test_denied(self):
+        """Test wrong credentials raise."""
+        backend = CMIBackend(self.address, password='wrong')
+        with self.assertRaises(ConnectionError):
+            backend.fetch()
+
+    @patch('custom_components.blnet.CMIBackend.probe')
+    def test_connector(self, mock_probe):
+        """Test the connector creates the configured backend."""
+        connector = BLNETConnector(
+            resource='http://192.168.1.2', password='secret', backend='cmi')
+        backend = connector.connect()
+        self.assertIsInstance(backend, CMIBackend)
+        self.assertEqual(backend.address, 'http://192.168.1.2:80')
+        mock_probe.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
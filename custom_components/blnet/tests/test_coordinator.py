@@ -0,0 +1,300 @@
+"""Tests for the BLNET update coordinator."""
+import asyncio
+import threading
+import unittest
+from datetime import timedelta
+from unittest.mock import AsyncMock, Mock, patch
+
+from homeassistant.exceptions import HomeAssistantError
+
+from custom_components.blnet import (
+    BLNETCoordinator, CONFIG_SCHEMA, SET_OUTPUTS_SCHEMA, async_setup,
+)
+
+
+def make_hass():
+    """Create a minimal hass mock that runs executor jobs in threads."""
+    hass = Mock()
+    loop = asyncio.get_running_loop()
+    hass.async_add_executor_job = lambda func, *args: loop.run_in_executor(
+        None, func, *args
+    )
+    return hass
+
+
+class TestBLNETCoordinator(unittest.IsolatedAsyncioTestCase):
+    """Test the BLNETCoordinator class."""
+
+    async def test_refresh_applies_data(self):
+        """Test fetched data is handed to the data handler."""
+        data_handler = Mock()
+        data_handler.fetch = Mock(return_value={'analog': {}})
+        coordinator = BLNETCoordinator(make_hass(), data_handler, 5)
+
+        result = await coordinator.async_refresh()
+
+        self.assertEqual(result, {'analog': {}})
+        data_handler.process.assert_called_once_with({'analog': {}})
+
+    async def test_refresh_timeout_skips_overlapping_cycle(self):
+        """Test a timed out fetch is not applied and blocks the next cycle."""
+        release = threading.Event()
+        data_handler = Mock()
+        data_handler.fetch = Mock(side_effect=lambda: release.wait(5))
+        coordinator = BLNETCoordinator(make_hass(), data_handler, 0.05)
+
+        self.assertIsNone(await coordinator.async_refresh())
+        self.assertTrue(coordinator.running)
+        self.assertIsNone(await coordinator.async_refresh())
+        self.assertEqual(data_handler.fetch.call_count, 1)
+        data_handler.process.assert_not_called()
+
+        release.set()
+        await coordinator._job
+
+    async def test_refresh_error(self):
+        """Test errors during a fetch are logged and not applied."""
+        data_handler = Mock()
+        data_handler.fetch = Mock(side_effect=ValueError("offline"))
+        coordinator = BLNETCoordinator(make_hass(), data_handler, 5)
+
+        self.assertIsNone(await coordinator.async_refresh())
+        data_handler.process.assert_not_called()
+
+    @patch('custom_components.blnet.async_call_later')
+    async def test_schedule_next_due_domain(self, mock_call_later):
+        """Test the next update is scheduled when the next domain is due."""
+        data_handler = Mock()
+        data_handler.fetch = Mock(return_value={'digital': {}})
+        data_handler.next_update = lambda now: now + timedelta(seconds=30)
+        data_handler.update_interval = timedelta(seconds=10)
+        coordinator = BLNETCoordinator(make_hass(), data_handler, 5)
+        self.assertIs(data_handler.coordinator, coordinator)
+
+        await coordinator._async_scheduled_refresh()
+        delay = mock_call_later.call_args.args[1]
+        self.assertAlmostEqual(delay, 30, delta=1)
+
+        # Failed updates are retried in the shortest interval
+        data_handler.fetch.side_effect = ConnectionError("offline")
+        await coordinator._async_scheduled_refresh()
+        self.assertEqual(mock_call_later.call_args.args[1], 10)
+
+        coordinator.async_stop()
+        mock_call_later.return_value.assert_called_once_with()
+
+    @patch('custom_components.blnet.async_call_later')
+    async def test_circuit_breaker(self, mock_call_later):
+        """Test an unreachable device is left alone with growing pauses
+        and its entities are unavailable meanwhile."""
+        data_handler = Mock()
+        data_handler.fetch = Mock(side_effect=ConnectionError("offline"))
+        data_handler.update_interval = timedelta(seconds=10)
+        coordinator = BLNETCoordinator(make_hass(), data_handler, 5)
+        coordinator.breaker._rng = lambda: 0.5
+
+        for _ in range(3):
+            await coordinator._async_scheduled_refresh()
+        data_handler.async_set_available.assert_called_once_with(False)
+        self.assertAlmostEqual(mock_call_later.call_args.args[1], 30, delta=1)
+
+        # Nothing is fetched while the breaker is open
+        self.assertIsNone(await coordinator.async_refresh())
+        self.assertEqual(data_handler.fetch.call_count, 3)
+
+        # A failed retry doubles the pause
+        coordinator.breaker._retry_at = 0
+        await coordinator._async_scheduled_refresh()
+        self.assertAlmostEqual(mock_call_later.call_args.args[1], 60, delta=1)
+
+        # The first successful update closes the breaker again
+        coordinator.breaker._retry_at = 0
+        data_handler.fetch.side_effect = None
+        data_handler.fetch.return_value = {1: {}}
+        self.assertEqual(await coordinator.async_refresh(), {1: {}})
+        self.assertFalse(coordinator.breaker.is_open)
+        data_handler.async_set_available.assert_called_with(True)
+
+    async def test_writes_are_serialized_and_coalesced(self):
+        """Test commands run one batch at a time and only the last one
+        per output is sent."""
+        hass = make_hass()
+        hass.async_create_task = asyncio.get_running_loop().create_task
+        release = threading.Event()
+        sent = []
+
+        def set_outputs(outputs, node):
+            release.wait(5)
+            sent.append((dict(outputs), node))
+            return {switch_id: switch_id != 4 for switch_id in outputs}
+
+        data_handler = Mock()
+        data_handler.set_outputs = Mock(side_effect=set_outputs)
+        coordinator = BLNETCoordinator(hass, data_handler, 5)
+
+        first = coordinator.async_write('EIN', 1, None)
+        await asyncio.sleep(0)
+        # The first command is being sent, the others wait in the queue
+        second = coordinator.async_write('EIN', 2, None)
+        replaced = coordinator.async_write('AUS', 3, None)
+        last = coordinator.async_write('AUTO', 3, None)
+        failed = coordinator.async_write('AUS', 4, None)
+        other_node = coordinator.async_write('AUS', 1, 2)
+        self.assertIs(replaced, last)
+
+        release.set()
+        self.assertEqual(
+            await asyncio.gather(first, second, last, failed, other_node),
+            [True, True, True, False, True])
+        self.assertEqual(sent, [
+            ({1: 'EIN'}, None),
+            ({2: 'EIN', 3: 'AUTO', 4: 'AUS'}, None),
+            ({1: 'AUS'}, 2),
+        ])
+
+    async def test_writes_wait_for_poll(self):
+        """Test a command is only sent once the running poll is done."""
+        hass = make_hass()
+        hass.async_create_task = asyncio.get_running_loop().create_task
+        release = threading.Event()
+        calls = []
+        data_handler = Mock()
+        data_handler.fetch = Mock(
+            side_effect=lambda: release.wait(5) and calls.append('fetch'))
+        data_handler.set_outputs = Mock(
+            side_effect=lambda outputs, node: calls.append('write') or {1: True})
+        coordinator = BLNETCoordinator(hass, data_handler, 5)
+
+        refresh = asyncio.ensure_future(coordinator.async_refresh())
+        await asyncio.sleep(0.01)
+        write = coordinator.async_write('EIN', 1, None)
+        await asyncio.sleep(0.01)
+        self.assertEqual(calls, [])
+
+        release.set()
+        await refresh
+        self.assertTrue(await write)
+        self.assertEqual(calls, ['fetch', 'write'])
+
+    @patch('custom_components.blnet.async_call_later')
+    async def test_outputs_read_back_after_writes(self, mock_call_later):
+        """Test written outputs are read back without rescheduling polls."""
+        hass = make_hass()
+        hass.async_create_task = asyncio.get_running_loop().create_task
+        data_handler = Mock()
+        data_handler.set_outputs = Mock(
+            side_effect=lambda outputs, node: {1: node == 2})
+        data_handler.fetch_outputs = Mock(return_value={2: {'digital': {}}})
+        coordinator = BLNETCoordinator(hass, data_handler, 5)
+
+        await asyncio.gather(coordinator.async_write('EIN', 1, 2),
+                             coordinator.async_write('AUS', 1, 3))
+        await coordinator._write_worker
+
+        # the switched output is marked on the event loop
+        data_handler.async_outputs_written.assert_called_once_with([1], 2)
+        # Only the node that was actually switched is read back, once
+        data_handler.fetch_outputs.assert_called_once_with({2})
+        data_handler.process_outputs.assert_called_once_with({2: {'digital': {}}})
+        data_handler.process.assert_not_called()
+        mock_call_later.assert_not_called()
+
+
+class TestSetup(unittest.IsolatedAsyncioTestCase):
+    """Test setting up several devices."""
+
+    @patch('custom_components.blnet.Store')
+    @patch('custom_components.blnet.async_call_later')
+    @patch('custom_components.blnet.BLNETConnector.connect')
+    async def test_setup_several_devices(self, mock_connect, mock_call_later,
+                                         mock_store):
+        """Test every device gets its own handler and staggered polls."""
+        mock_store.return_value.async_load = AsyncMock(return_value=None)
+        hass = make_hass()
+        hass.data = {}
+        config = CONFIG_SCHEMA({'blnet': [
+            {'name': 'A', 'resource': 'http://192.168.1.2'},
+            {'name': 'B', 'resource': 'http://192.168.1.3'},
+        ]})
+
+        self.assertTrue(await async_setup(hass, config))
+
+        handlers = hass.data['DATA_blnet']
+        self.assertEqual(sorted(handlers), ['A', 'B'])
+        self.assertIsNot(handlers['A'], handlers['B'])
+        self.assertEqual(mock_connect.call_count, 2)
+        # The first device polls at once, the second one a bit later
+        hass.async_create_task.assert_called_once()
+        hass.async_create_task.call_args.args[0].close()
+        self.assertEqual(mock_call_later.call_args.args[1], 2)
+        self.assertEqual(hass.bus.async_listen_once.call_count, 2)
+
+        # Several outputs of a device are set with a single service call
+        services = {
+            register.args[1]: register.args[2]
+            for register in hass.services.async_register.call_args_list
+        }
+        service = services['set_outputs']
+        handlers['B'].async_set_outputs = AsyncMock(
+            return_value={1: True, 5: False})
+        call = Mock()
+        call.data = SET_OUTPUTS_SCHEMA({
+            'device': 'B', 'outputs': {'1': 'on', 5: 'AUTO'}})
+        self.assertEqual(await service(call),
+                         {'outputs': {'1': True, '5': False}})
+        handlers['B'].async_set_outputs.assert_called_once_with(
+            {1: 'EIN', 5: 'AUTO'}, None)
+
+        # The timings of a device are returned for tuning
+        handlers['A'].stats.add_duration('fetch', 0.25)
+        call.data = {'device': 'A'}
+        report = await services['get_diagnostics'](call)
+        self.assertEqual(report['stages']['fetch']['p95'], 250.0)
+        self.assertEqual(report['intervals']['analog'], 360.0)
+        call.data = {'device': 'C'}
+        with self.assertRaises(HomeAssistantError):
+            await services['get_diagnostics'](call)
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    @patch('custom_components.blnet.Store')
+    @patch('custom_components.blnet.BLNETConnector.connect')
+    async def test_setup_from_cache(self, mock_connect, mock_store,
+                                    mock_load_platform):
+        """Test cached entities are created before the device is reached."""
+        mock_store.return_value.async_load = AsyncMock(return_value={
+            'entities': {'sensor': [{
+                'name': 'T1', 'domain': 'analog', 'id': 1, 'node': None,
+                'device': None, 'friendly_name': 'T1',
+                'blnet_id': 'blnet analog 1',
+            }]},
+            'data': {'blnet analog 1': {
+                'value': '20.5', 'unit_of_measurement': '°C',
+                'friendly_name': 'T1', 'icon': 'mdi:thermometer'}},
+        })
+        hass = make_hass()
+        hass.data = {}
+        config = CONFIG_SCHEMA({'blnet': {'resource': 'http://192.168.1.2'}})
+
+        self.assertTrue(await async_setup(hass, config))
+        hass.async_create_task.call_args.args[0].close()
+
+        mock_connect.assert_not_called()
+        self.assertEqual(mock_store.call_args.args[2], 'blnet_cache')
+        handler = hass.data['DATA_blnet'][None]
+        self.assertIsNone(handler.blnet)
+        self.assertEqual(handler.data['blnet analog 1']['value'], '20.5')
+        self.assertEqual(handler.channel('blnet analog 1').unit_of_measurement,
+                         '°C')
+        self.assertEqual(
+            handler._pending_entities['sensor'][0]['blnet_id'], 'blnet analog 1')
+        mock_load_platform.assert_called_once()
+
+        # The first update connects to the device
+        mock_connect.return_value.fetch.return_value = {}
+        handler.fetch()
+        mock_connect.assert_called_once_with()
+        self.assertIs(handler.blnet, mock_connect.return_value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""Tests for the channels computed from other channels."""
+import unittest
+from datetime import datetime, timedelta
+
+from custom_components.blnet.channels import Channel
+from custom_components.blnet.derived import Derivation, parse_source
+
+START = datetime(2024, 1, 15, 10, 0)
+
+
+def channel(domain, value, unit):
+    """Return the record of a channel with a value."""
+    record = Channel(1, domain, 1, f'blnet {domain} 1')
+    record.value = value
+    record.unit_of_measurement = unit
+    return record
+
+
+class TestDerivation(unittest.TestCase):
+    """Test computing derived channels from the records of their sources."""
+
+    def test_parse_source(self):
+        """Test sources default to the first node."""
+        self.assertEqual(parse_source('analog 3', 1), (1, 'analog', 3))
+        self.assertEqual(parse_source('2 power 1', 1), (2, 'power', 1))
+
+    def test_evaluate(self):
+        """Test spreads, sums and ratios of the current values."""
+        flow, back = channel('analog', '45.3', '°C'), channel('analog', '38.1', '°C')
+        spread = Derivation('difference', 'Spread', [])
+        self.assertEqual(spread.evaluate([flow, back], START), 7.2)
+        self.assertEqual(spread.default_unit([flow, back]), '°C')
+        self.assertEqual(Derivation('sum', 'Sum', []).evaluate(
+            [flow, back, back], START), 121.5)
+
+        heat, electric = channel('power', '6.3', 'kW'), channel('power', '0', 'kW')
+        cop = Derivation('ratio', 'COP', [])
+        self.assertIsNone(cop.evaluate([heat, electric], START))
+        electric.value = '1.5'
+        self.assertEqual(cop.evaluate([heat, electric], START), 4.2)
+        self.assertIsNone(cop.default_unit([heat, electric]))
+        # values that are no numbers leave the result unknown
+        back.value = None
+        self.assertIsNone(spread.evaluate([flow, back], START))
+
+    def test_integral(self):
+        """Test the integral over time continues a restored value."""
+        power = channel('power', '2.0', 'kW')
+        heat = Derivation('integral', 'Heat', [])
+        heat.channel = channel('derived', 10.0, 'kWh')
+        self.assertEqual(heat.default_unit([power]), 'kWh')
+        self.assertEqual(heat.evaluate([power], START), 10.0)
+        power.value = '4.0'
+        self.assertEqual(
+            heat.evaluate([power], START + timedelta(minutes=30)), 11.5)
+        self.assertEqual(
+            heat.evaluate([power], START + timedelta(minutes=45)), 12.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
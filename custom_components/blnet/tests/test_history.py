@@ -0,0 +1,35 @@
+"""Tests for the rolling aggregates of recent samples."""
+import unittest
+
+from custom_components.blnet.history import SampleBuffer
+
+
+class TestSampleBuffer(unittest.TestCase):
+    """Test the ring buffer of samples."""
+
+    def test_aggregate(self):
+        """Test the aggregates of the samples in the window."""
+        samples = SampleBuffer(10)
+        self.assertIsNone(samples.aggregate(0))
+        for timestamp, value in ((0, 50.0), (600, 20.0), (1200, 26.0),
+                                 (1800, 23.0)):
+            samples.append(timestamp, value)
+
+        self.assertEqual(samples.aggregate(600), {
+            'min': 20.0, 'max': 26.0, 'mean': 23.0, 'rate': 9.0})
+        self.assertEqual(samples.aggregate(1800), {
+            'min': 23.0, 'max': 23.0, 'mean': 23.0, 'rate': 0.0})
+        self.assertIsNone(samples.aggregate(1801))
+
+    def test_wrap(self):
+        """Test the oldest samples are replaced once the buffer is full."""
+        samples = SampleBuffer(3)
+        for timestamp in range(7):
+            samples.append(timestamp * 60, float(timestamp))
+        self.assertEqual(samples.size, 3)
+        self.assertEqual(samples.aggregate(0), {
+            'min': 4.0, 'max': 6.0, 'mean': 5.0, 'rate': 60.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,21 @@
 """Tests for the BLNET sensor component."""
+import json
 import unittest
 from unittest.mock import Mock, patch
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from custom_components.blnet.sensor import BLNETComponent
-from custom_components.blnet import BLNETDataHandler, BLNETConnector
+import voluptuous as vol
+
+from homeassistant.const import EntityCategory
+
+from custom_components.blnet.sensor import (
+    BLNETComponent, BLNETDiagnosticSensor, BLNETRollingSensor,
+)
+from custom_components.blnet import (
+    BLNETDataHandler, BLNETConnector, CONFIG_SCHEMA,
+)
+from custom_components.blnet.channels import Channel
+from custom_components.blnet.client import DOMAINS
 
 class TestBLNETComponent(unittest.TestCase):
     """Test the BLNETComponent class."""
@@ -44,6 +55,83 @@ class TestBLNETComponent(unittest.TestCase):
         self.assertEqual(sensor._identifier, "test_blnet_A1")
         self.assertEqual(sensor._friendly_name, "Test Sensor")
 
+    def test_handle_update(self):
+        """Test pushed data is written to the state machine."""
+        channel = Channel(1, 'analog', 1, 'test_blnet_1', 'mdi:thermometer')
+        channel.value = '21.5'
+        channel.unit_of_measurement = '°C'
+        channel.friendly_name = 'Renamed Sensor'
+        channel.rolling = {'min': 20.0, 'max': 22.0, 'mean': 21.0, 'rate': 4.0}
+        self.communication.channel.return_value = channel
+        sensor = BLNETComponent(
+            hass=self.hass,
+            sensor_id=1,
+            name="test_sensor",
+            blnet_id="test_blnet_1",
+            friendly_name="Test Sensor",
+            communication=self.communication
+        )
+        sensor.async_write_ha_state = Mock()
+        self.assertFalse(sensor.should_poll)
+
+        sensor._async_handle_update()
+
+        sensor.async_write_ha_state.assert_called_once()
+        self.assertEqual(sensor.state, '21.5')
+        self.assertEqual(sensor.unit_of_measurement, '°C')
+        self.assertEqual(sensor.friendly_name, 'Renamed Sensor')
+        self.assertEqual(sensor.icon, 'mdi:thermometer')
+        # the aggregates only go to their own sensors
+        self.assertEqual(sensor.extra_state_attributes, {})
+
+        # the record is resolved once and read on every update
+        channel.value = '22.0'
+        sensor._async_handle_update()
+        self.assertEqual(sensor.state, '22.0')
+        self.communication.channel.assert_called_once_with('test_blnet_1')
+
+    def test_rolling_sensor(self):
+        """Test an aggregate of a channel is a sensor of its own."""
+        channel = Channel(1, 'analog', 1, 'test_blnet_1', 'mdi:thermometer')
+        channel.friendly_name = 'T1'
+        channel.unit_of_measurement = '°C'
+        channel.rolling = {'min': 20.0, 'max': 22.0, 'mean': 21.0, 'rate': 4.0}
+        self.communication.channel.return_value = channel
+        sensor = BLNETRollingSensor(
+            self.hass, 1, 'T1 rate', 'test_blnet_1', 'T1 rate',
+            self.communication, 'rate')
+        sensor._update_from_data()
+
+        self.assertEqual(sensor.state, 4.0)
+        self.assertEqual(sensor.unit_of_measurement, '°C/h')
+        self.assertEqual(sensor.friendly_name, 'T1 rate')
+        self.assertEqual(sensor.unique_id, 'blnet_sensor_test_blnet_1_rate')
+        self.assertEqual(sensor.extra_state_attributes, {})
+
+
+class TestBLNETDiagnosticSensor(unittest.TestCase):
+    """Test the BLNETDiagnosticSensor class."""
+
+    def test_update(self):
+        """Test the sensor reads the diagnostics and is disabled by default."""
+        communication = Mock()
+        communication.diagnostics = {'blnet diagnostic fetch': {
+            'value': 12.5, 'unit_of_measurement': 'ms',
+            'friendly_name': 'Fetch duration',
+            'attributes': {'p95': 20.0},
+        }}
+        sensor = BLNETDiagnosticSensor(
+            Mock(), 'fetch', 'Fetch duration', 'blnet diagnostic fetch',
+            'Fetch duration', communication)
+        sensor.async_write_ha_state = Mock()
+
+        sensor._async_handle_update()
+
+        self.assertEqual(sensor.state, 12.5)
+        self.assertEqual(sensor.extra_state_attributes, {'p95': 20.0})
+        self.assertFalse(sensor.entity_registry_enabled_default)
+        self.assertEqual(sensor.entity_category, EntityCategory.DIAGNOSTIC)
+
 
 class TestBLNETDataHandler(unittest.TestCase):
     """Test the BLNETDataHandler class."""
@@ -70,14 +158,28 @@ class TestBLNETDataHandler(unittest.TestCase):
         self.assertEqual(handler._hass, self.hass)
         self.assertEqual(handler._config, self.config)
         self.assertEqual(handler.data, {})
-        self.assertIsNone(handler._last_updated)
+        self.assertIsNone(handler.last_updated())
 
-    def test_last_updated(self):
-        """Test last_updated method."""
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_snapshot(self, mock_load_platform):
+        """Test updates replace a read-only snapshot with its timestamp."""
         handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
         self.assertIsNone(handler.last_updated())
-        handler._last_updated = datetime.now()
+        handler.process({self.node: {
+            'analog': {1: {'name': 'T1', 'value': '20.0'}}}})
+        first = handler.snapshot
         self.assertIsNotNone(handler.last_updated())
+        with self.assertRaises(TypeError):
+            handler.data['blnet analog 2'] = {}
+        with self.assertRaises(TypeError):
+            handler.data['blnet analog 1']['value'] = '0.0'
+
+        handler.process({self.node: {
+            'analog': {1: {'name': 'T1', 'value': '21.0'}}}})
+        # a reader holding the previous snapshot keeps consistent values
+        self.assertEqual(first.data['blnet analog 1']['value'], '20.0')
+        self.assertEqual(handler.data['blnet analog 1']['value'], '21.0')
+        self.assertGreaterEqual(handler.last_updated(), first.updated)
 
     def test_turn_on_off(self):
         """Test turn_on and turn_off methods."""
@@ -95,6 +197,614 @@ class TestBLNETDataHandler(unittest.TestCase):
         handler.turn_auto(1)
         self.blnet.turn_auto.assert_called_once_with(1, self.node)
 
+    def test_set_outputs(self):
+        """Test setting several outputs and marking the switched ones."""
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+        self.blnet.set_outputs.return_value = {1: True, 2: False}
+
+        self.assertEqual(handler.set_outputs({1: 'EIN', 2: 'AUTO'}),
+                         {1: True, 2: False})
+        self.blnet.set_outputs.assert_called_once_with({1: 'EIN', 2: 'AUTO'}, 1)
+        # the executor job leaves the state of the updates alone
+        self.assertEqual(handler._force_update, set())
+        handler.async_outputs_written([1])
+        self.assertEqual(handler._force_update, {'blnet digital 1'})
+
+        self.blnet.set_outputs.side_effect = ConnectionError("offline")
+        self.assertEqual(handler.set_outputs({3: 'AUS'}), {3: False})
+
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_process_notifies_changed(self, mock_load_platform):
+        """Test only entities with changed data are notified."""
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+        analog_listener = Mock()
+        digital_listener = Mock()
+        handler.async_add_listener('blnet analog 1', analog_listener)
+        handler.async_add_listener('blnet digital 1', digital_listener)
+        data = {
+            'analog': {1: {'name': 'T1', 'value': '20.0'}},
+            'speed': {}, 'power': {}, 'energy': {},
+            'digital': {1: {'name': 'P1', 'mode': 'AUTO', 'value': 'AUS'}},
+        }
+
+        handler.process({self.node: data})
+        self.assertEqual(analog_listener.call_count, 1)
+        self.assertEqual(digital_listener.call_count, 1)
+
+        # Unchanged data does not notify anyone
+        handler.process({self.node: data})
+        self.assertEqual(analog_listener.call_count, 1)
+        self.assertEqual(digital_listener.call_count, 1)
+
+        # Only the changed analog value is pushed
+        data['analog'][1] = {'name': 'T1', 'value': '20.5'}
+        handler.process({self.node: data})
+        self.assertEqual(analog_listener.call_count, 2)
+        self.assertEqual(digital_listener.call_count, 1)
+        self.assertEqual(handler.data['blnet analog 1']['value'], '20.5')
+
+        # A switch command forces a refresh of its output
+        handler.async_outputs_written([1])
+        handler.process({self.node: data})
+        self.assertEqual(digital_listener.call_count, 2)
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_process_outputs(self, mock_load_platform):
+        """Test read back outputs update their entities only."""
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+        handler.process({self.node: {
+            'digital': {1: {'name': 'P1', 'mode': 'AUTO', 'value': 'AUS'}},
+        }})
+        listener = Mock()
+        handler.async_add_listener('blnet digital 1', listener)
+        updated = dict(handler._domain_updated)
+        self.blnet.fetch.return_value = {
+            'digital': {1: {'name': 'P1', 'mode': 'HAND', 'value': 'EIN'}},
+        }
+
+        data = handler.fetch_outputs({self.node})
+        self.blnet.fetch.assert_called_with(self.node, {'digital'})
+        handler.process_outputs(data)
+
+        self.assertEqual(listener.call_count, 1)
+        self.assertEqual(handler.data['blnet digital 1']['mode'], 'HAND')
+        self.assertEqual(handler._domain_updated, updated)
+
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_discovery_is_batched(self, mock_load_platform):
+        """Test each platform is loaded once and receives batches."""
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+        data = {
+            'analog': {1: {'name': 'T1', 'value': '20.0'},
+                       2: {'name': 'T2', 'value': '21.0'}},
+            'speed': {1: {'name': 'S1', 'value': '5'}},
+            'power': {}, 'energy': {},
+            'digital': {1: {'name': 'P1', 'mode': 'AUTO', 'value': 'AUS'}},
+        }
+
+        handler.process({self.node: data})
+        self.assertEqual(mock_load_platform.call_count, 2)
+        loaded = {call.args[1] for call in mock_load_platform.call_args_list}
+        self.assertEqual(loaded, {'sensor', 'switch'})
+        # loaded from the event loop, not through the thread safe path
+        self.hass.async_create_task.assert_called_with(
+            mock_load_platform.return_value)
+
+        add_sensors = Mock()
+        handler.async_register_platform('sensor', add_sensors)
+        add_sensors.assert_called_once()
+        self.assertEqual(
+            [info['blnet_id'] for info in add_sensors.call_args.args[0]],
+            ['blnet analog 1', 'blnet analog 2', 'blnet speed 1']
+        )
+
+        # Later discoveries go straight to the loaded platform
+        data['analog'][3] = {'name': 'T3', 'value': '22.0'}
+        data['analog'][4] = {'name': 'T4', 'value': '23.0'}
+        handler.process({self.node: data})
+        self.assertEqual(mock_load_platform.call_count, 2)
+        self.assertEqual(add_sensors.call_count, 2)
+        self.assertEqual(len(add_sensors.call_args.args[0]), 2)
+
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_fetch_only_enabled_pages(self, mock_load_platform):
+        """Test only pages of enabled entities are fetched between full fetches."""
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+        self.blnet.fetch.return_value = {
+            'analog': {1: {'name': 'T1', 'value': '20.0'}},
+            'speed': {}, 'power': {}, 'energy': {},
+            'digital': {1: {'name': 'P1', 'mode': 'AUTO', 'value': 'AUS'}},
+        }
+
+        handler.update()
+        self.assertEqual(self.blnet.fetch.call_args.args,
+                         (self.node, {'analog', 'digital', 'direct'}))
+
+        # Only the digital output is enabled
+        handler.async_add_listener('blnet digital 1', Mock())
+        handler._domain_updated.clear()
+        handler.update()
+        self.assertEqual(self.blnet.fetch.call_args.args,
+                         (self.node, {'digital', 'direct'}))
+
+        # Periodically everything is fetched to discover new channels
+        handler._last_full_fetch -= timedelta(hours=2)
+        handler.update()
+        self.assertEqual(self.blnet.fetch.call_args.args,
+                         (self.node, {'analog', 'digital', 'direct'}))
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_empty_domains(self, mock_load_platform):
+        """Test requested domains without values are not due right away."""
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+        self.blnet.fetch.return_value = {
+            'power': {1: {'value': '2.5'}}}
+        handler.update()
+        handler.async_add_listener('blnet power 1', Mock())
+
+        # the web interface or a direct port in its backoff have no power
+        self.blnet.fetch.return_value = {}
+        handler._last_full_fetch -= timedelta(hours=2)
+        handler.update()
+        now = datetime.now()
+        self.assertGreater(handler.next_update(now),
+                           now + timedelta(seconds=300))
+        self.assertEqual(handler.due_domains(now), set())
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_incomplete_full_fetch(self, mock_load_platform):
+        """Test a full fetch without values of a node is repeated soon."""
+        self.blnet.fetch.side_effect = lambda node, pages: (
+            {'analog': {1: {'name': 'T1', 'value': '20.0'}}} if node == 1 else {})
+        handler = BLNETDataHandler(self.blnet, [1, 2], self.hass, self.config)
+        handler.update()
+        now = datetime.now()
+        self.assertLessEqual(handler.next_update(now),
+                             now + handler.update_interval)
+
+        self.blnet.fetch.side_effect = None
+        self.blnet.fetch.return_value = {
+            'analog': {1: {'name': 'T1', 'value': '20.0'}}}
+        handler._last_full_fetch -= handler.update_interval
+        handler.update()
+        self.assertEqual(handler.channel('blnet 2 analog 1').value, '20.0')
+        self.assertGreater(handler.next_update(datetime.now()),
+                           now + handler.update_interval)
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_multiple_nodes(self, mock_load_platform):
+        """Test several nodes are fetched and namespaced in one handler."""
+        handler = BLNETDataHandler(self.blnet, [1, 2, 3], self.hass, self.config)
+        self.assertEqual(handler.node, 1)
+        self.blnet.node = 2
+        self.blnet.fetch.side_effect = lambda node, pages: {
+            'analog': {1: {'name': 'T1', 'value': str(node)}},
+            'digital': {1: {'name': 'P1', 'mode': 'AUTO', 'value': 'AUS'}},
+        }
+
+        handler.update()
+        # The node still selected on the device is fetched first
+        self.assertEqual([call.args[0] for call in self.blnet.fetch.call_args_list],
+                         [2, 3, 1])
+        self.assertEqual(handler.data['blnet 3 analog 1']['value'], '3')
+        self.assertEqual(handler.data['blnet 3 analog 1']['friendly_name'],
+                         'Node 3 T1')
+
+        add_switches = Mock()
+        handler.async_register_platform('switch', add_switches)
+        self.assertEqual(
+            [(info['node'], info['name']) for info in add_switches.call_args.args[0]],
+            [(2, 'Node 2 P1'), (3, 'Node 3 P1'), (1, 'Node 1 P1')]
+        )
+
+        # Only nodes with enabled entities are fetched in between
+        self.blnet.fetch.reset_mock()
+        handler.async_add_listener('blnet 3 digital 1', Mock())
+        handler._domain_updated.clear()
+        handler.update()
+        self.blnet.fetch.assert_called_once_with(3, {'digital', 'direct'})
+
+        handler.turn_on(1, 3)
+        self.blnet.turn_on.assert_called_once_with(1, 3)
+        handler.async_outputs_written([1], 3)
+        self.assertIn('blnet 3 digital 1', handler._force_update)
+
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_rolling(self, mock_load_platform):
+        """Test the recent values of all channels are aggregated."""
+        config = CONFIG_SCHEMA({'blnet': {
+            'resource': 'http://192.168.1.2',
+            'rolling': {'samples': 3, 'sensors': 'mean'},
+        }})['blnet'][0]
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, config)
+        callback = Mock()
+        for value in ('20.0', '22.0'):
+            handler.process({self.node: {
+                'analog': {1: {'name': 'T1', 'value': value}},
+                'digital': {1: {'name': 'P1', 'mode': 'AUTO', 'value': 'EIN'}},
+            }})
+        channel = handler.channel('blnet analog 1')
+        self.assertEqual(channel.rolling['min'], 20.0)
+        self.assertEqual(channel.rolling['max'], 22.0)
+        self.assertEqual(channel.rolling['mean'], 21.0)
+        self.assertIsNone(handler.channel('blnet digital 1').samples)
+        discovered = handler._pending_entities['sensor']
+        self.assertEqual([disc_info.get('rolling') for disc_info in discovered],
+                         [None, 'mean'])
+        self.assertEqual(discovered[1]['name'], 'T1 mean')
+
+        # only the sensors of the aggregates hear of changed aggregates of
+        # unchanged values
+        rolling_callback = Mock()
+        handler.async_add_listener('blnet analog 1', callback)
+        handler.async_add_listener('blnet analog 1', rolling_callback,
+                                   rolling=True)
+        self.assertEqual(handler.enabled_domains(), {'analog'})
+        for _ in range(3):
+            handler.process({self.node: {
+                'analog': {1: {'name': 'T1', 'value': '22.0'}}}})
+        self.assertEqual(channel.rolling['mean'], 22.0)
+        callback.assert_not_called()
+        self.assertEqual(rolling_callback.call_count, 2)
+        with self.assertRaises(vol.Invalid):
+            CONFIG_SCHEMA({'blnet': {'resource': 'http://192.168.1.2',
+                                     'rolling': {'window': 600}}})
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_derived(self, mock_load_platform):
+        """Test derived channels are computed and published on change."""
+        config = CONFIG_SCHEMA({'blnet': {
+            'resource': 'http://192.168.1.2',
+            'derived': [
+                {'name': 'Solar spread', 'type': 'difference',
+                 'sources': ['analog 1', 'analog 2'], 'unit_of_measurement': 'K'},
+                {'name': 'COP', 'type': 'ratio', 'sources': ['power 1', 'power 2']},
+            ],
+        }})['blnet'][0]
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, config)
+        handler.process({self.node: {
+            'analog': {1: {'name': 'T1', 'value': '60.0'},
+                       2: {'name': 'T2', 'value': '45.5'}},
+        }})
+        self.assertEqual(handler.data['blnet derived solar_spread'], {
+            'value': 14.5, 'unit_of_measurement': 'K',
+            'friendly_name': 'Solar spread', 'icon': 'mdi:thermometer-lines'})
+        # derived channels without values of all sources are not added
+        discovered = handler._pending_entities['sensor']
+        self.assertEqual([disc_info['blnet_id'] for disc_info in discovered],
+                         ['blnet analog 1', 'blnet analog 2',
+                          'blnet derived solar_spread'])
+
+        # only listen to the derived channel, its sources are still fetched
+        callback = Mock()
+        handler.async_add_listener('blnet derived solar_spread', callback)
+        self.assertEqual(handler.enabled_domains(), {'analog'})
+        handler.process({self.node: {
+            'analog': {1: {'name': 'T1', 'value': '61.0'},
+                       2: {'name': 'T2', 'value': '46.5'}},
+        }})
+        callback.assert_not_called()
+        handler.process({self.node: {
+            'analog': {1: {'name': 'T1', 'value': '62.0'},
+                       2: {'name': 'T2', 'value': '46.5'}},
+        }})
+        callback.assert_called_once()
+        self.assertEqual(handler.channel('blnet derived solar_spread').value, 15.5)
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_same_names(self, mock_load_platform):
+        """Test channels sharing a name all get entities."""
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+        handler.process({self.node: {
+            'analog': {1: {'name': 'T.Speicher', 'value': '40.0'},
+                       2: {'name': 'T.Speicher', 'value': '55.0'}},
+        }})
+        discovered = handler._pending_entities['sensor']
+        self.assertEqual([disc_info['blnet_id'] for disc_info in discovered],
+                         ['blnet analog 1', 'blnet analog 2'])
+        self.assertEqual(handler.channel('blnet analog 2').value, '55.0')
+        self.assertEqual(handler.channels[(self.node, 'analog', 2)].friendly_name,
+                         'T.Speicher')
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_named_device(self, mock_load_platform):
+        """Test channels of a named device are namespaced by its name."""
+        self.config['name'] = 'Site B'
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+
+        handler.process({self.node: {
+            'analog': {1: {'name': 'T1', 'value': '20.0'}},
+        }})
+
+        self.assertEqual(handler.data['blnet Site B analog 1']['friendly_name'],
+                         'Site B T1')
+        self.assertEqual(mock_load_platform.call_args.args[3],
+                         {'device': 'Site B'})
+
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_diagnostics(self, mock_load_platform):
+        """Test timings and counters are published to diagnostic sensors."""
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+        self.blnet.fetch.return_value = {
+            'analog': {1: {'name': 'T1', 'value': '20.0'}}}
+        handler.update()
+        self.blnet.fetch.side_effect = ConnectionError("refused")
+        handler._last_full_fetch = None
+        with self.assertRaises(ConnectionError):
+            handler.update()
+
+        handler.async_update_diagnostics()
+
+        sensors = handler._pending_entities['sensor']
+        self.assertIn('blnet diagnostic fetch',
+                      [sensor['blnet_id'] for sensor in sensors])
+        self.assertTrue(all(sensor.get('diagnostic') for sensor in sensors[1:]))
+        fetch = handler.diagnostics['blnet diagnostic fetch']
+        self.assertEqual(fetch['friendly_name'], 'BLNET fetch duration')
+        self.assertEqual(fetch['unit_of_measurement'], 'ms')
+        self.assertEqual(fetch['attributes']['count'], 2)
+        self.assertEqual(
+            handler.diagnostics['blnet diagnostic failures']['value'], 1)
+        # diagnostics stay out of the values of the device
+        self.assertNotIn('blnet diagnostic fetch', handler.data)
+
+        listener = Mock()
+        handler.async_add_listener('blnet diagnostic failures', listener)
+        handler.async_update_diagnostics()
+        listener.assert_not_called()
+        handler.stats.count('failures')
+        handler.async_update_diagnostics()
+        listener.assert_called_once_with()
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_cache(self, mock_load_platform):
+        """Test a restored cache creates the same entities with their values."""
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+        handler.store = Mock()
+        handler.process({self.node: {
+            'analog': {1: {'name': 'T1', 'value': '20.0'}},
+            'digital': {1: {'name': 'P1', 'mode': 'AUTO', 'value': 'EIN'}},
+        }})
+        save, delay = handler.store.async_delay_save.call_args.args
+        # the cache has to survive a round trip through JSON
+        cache = json.loads(json.dumps(save()))
+
+        restored = BLNETDataHandler(None, self.node, self.hass, self.config)
+        restored.async_restore(cache)
+
+        self.assertEqual(restored.data, handler.data)
+        self.assertEqual(
+            {key: channel.as_dict() for key, channel in restored.channels.items()},
+            {key: channel.as_dict() for key, channel in handler.channels.items()})
+        self.assertEqual(restored._pending_entities, handler._pending_entities)
+        # known channels are not discovered again
+        self.blnet.fetch.return_value = {
+            'analog': {1: {'name': 'T1', 'value': '21.0'}}}
+        restored.blnet = self.blnet
+        restored.update()
+        self.assertEqual(len(restored._pending_entities['sensor']), 1)
+        self.assertEqual(restored.data['blnet analog 1']['value'], '21.0')
+
+        restored.async_restore({'entities': None})
+        self.assertEqual(len(restored._discovered['sensor']), 1)
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_cache_save(self, mock_load_platform):
+        """Test frequent updates do not postpone the save of the cache."""
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+        handler.store = Mock()
+        data = {'analog': {1: {'name': 'T1', 'value': '20.0'}}}
+        for value in ('20.0', '20.5', '20.5', '21.0'):
+            data['analog'][1]['value'] = value
+            handler.process({self.node: data})
+        handler.store.async_delay_save.assert_called_once()
+
+        # once saved, the next change schedules the next save
+        save, delay = handler.store.async_delay_save.call_args.args
+        self.assertEqual(save()['data']['blnet analog 1']['value'], '21.0')
+        handler.process({self.node: data})
+        self.assertEqual(handler.store.async_delay_save.call_count, 1)
+        data['analog'][1]['value'] = '21.5'
+        handler.process({self.node: data})
+        self.assertEqual(handler.store.async_delay_save.call_count, 2)
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_stale_cache(self, mock_load_platform):
+        """Test cached entities of another configuration are not restored."""
+        self.config['derived'] = [{'name': 'Spread', 'type': 'difference',
+                                   'sources': ['analog 1', 'analog 2']}]
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+        handler.store = Mock()
+        handler.process({self.node: {
+            'analog': {1: {'name': 'T1', 'value': '20.0'},
+                       2: {'name': 'T2', 'value': '15.0'}},
+        }})
+        save, delay = handler.store.async_delay_save.call_args.args
+        cache = json.loads(json.dumps(save()))
+        self.assertEqual(len(cache['entities']['sensor']), 3)
+
+        # several nodes now, and the derived channel is gone
+        del self.config['derived']
+        restored = BLNETDataHandler(None, [1, 2], self.hass, self.config)
+        restored.async_restore(cache)
+        self.assertEqual(restored._pending_entities, {})
+        self.assertEqual(restored.data, {})
+        self.assertEqual(restored.sensors, set())
+
+        # the channels are discovered again under their new ids
+        self.blnet.fetch.return_value = {
+            'analog': {1: {'name': 'T1', 'value': '21.0'}}}
+        restored.blnet = self.blnet
+        restored.update()
+        self.assertEqual(
+            [disc_info['blnet_id']
+             for disc_info in restored._pending_entities['sensor']],
+            ['blnet 1 analog 1', 'blnet 2 analog 1'])
+
+    def test_due_domains(self):
+        """Test domains are due after their own scan interval."""
+        self.config['scan_intervals'] = {'digital': 10, 'energy': 600}
+        self.config['scan_interval'] = 60
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+        self.assertEqual(handler.update_interval, timedelta(seconds=10))
+        now = datetime.now()
+        self.assertEqual(handler.due_domains(now), set(DOMAINS))
+
+        handler._domain_updated = {domain: now for domain in DOMAINS}
+        self.assertEqual(handler.due_domains(now + timedelta(seconds=5)), set())
+        self.assertEqual(handler.due_domains(now + timedelta(seconds=10)),
+                         {'digital'})
+        # Domains due before the next tick are merged into this one
+        self.assertEqual(handler.due_domains(now + timedelta(seconds=55)),
+                         {'digital', 'analog', 'speed', 'power'})
+        self.assertEqual(handler.due_domains(now + timedelta(seconds=600)),
+                         set(DOMAINS))
+
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_adaptive_intervals(self, mock_load_platform):
+        """Test intervals shrink on change, grow when stable and burst after writes."""
+        self.config['scan_interval'] = 60
+        self.config['adaptive_polling'] = {
+            'min_interval': 10, 'max_interval': 120, 'burst': 2}
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, self.config)
+        data = {
+            'analog': {1: {'name': 'T1', 'value': '20.0'}},
+            'digital': {1: {'name': 'P1', 'mode': 'AUTO', 'value': 'AUS'}},
+        }
+        # The initial fetch does not change the intervals
+        handler.process({self.node: data})
+        self.assertEqual(handler.interval('analog'), timedelta(seconds=60))
+
+        handler.process({self.node: data})
+        self.assertEqual(handler.interval('analog'), timedelta(seconds=90))
+        handler.process({self.node: data})
+        self.assertEqual(handler.interval('analog'), timedelta(seconds=120))
+
+        data['analog'][1] = {'name': 'T1', 'value': '20.5'}
+        handler.process({self.node: data})
+        self.assertEqual(handler.interval('analog'), timedelta(seconds=60))
+        self.assertEqual(handler.interval('digital'), timedelta(seconds=120))
+
+        # A command polls the outputs fast for a few times
+        handler.async_outputs_written([1])
+        self.assertEqual(handler.interval('digital'), timedelta(seconds=10))
+        handler.process({self.node: {'digital': data['digital']}})
+        self.assertEqual(handler.interval('digital'), timedelta(seconds=10))
+        handler.process({self.node: {'digital': data['digital']}})
+        # the switched output counted as a change
+        self.assertEqual(handler.interval('digital'), timedelta(seconds=90))
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_deadband(self, mock_load_platform):
+        """Test small changes are left out until the value gets old."""
+        config = CONFIG_SCHEMA({'blnet': {
+            'resource': 'http://192.168.1.2',
+            'deadband': {'analog': 0.5, 'power': '10%',
+                         'channels': {'analog 2': 0}, 'max_age': 600},
+        }})['blnet'][0]
+        handler = BLNETDataHandler(self.blnet, self.node, self.hass, config)
+        callback = Mock()
+
+        def process(analog1, analog2, power):
+            handler.process({self.node: {
+                'analog': {1: {'name': 'T1', 'value': analog1},
+                           2: {'name': 'T2', 'value': analog2}},
+                'power': {1: {'name': 'P1', 'value': power}},
+            }})
+            return {blnet_id: entry['value']
+                    for blnet_id, entry in handler.data.items()}
+
+        process('20.0', '30.0', 10.0)
+        handler.async_add_listener('blnet analog 1', callback)
+        values = process('20.4', '30.1', 10.9)
+        self.assertEqual(values, {'blnet analog 1': '20.0',
+                                  'blnet analog 2': '30.1',
+                                  'blnet power 1': 10.0})
+        callback.assert_not_called()
+        # drift adds up until it passes the deadband
+        values = process('20.6', '30.1', 11.5)
+        self.assertEqual(values['blnet analog 1'], '20.6')
+        self.assertEqual(values['blnet power 1'], 11.5)
+        callback.assert_called_once()
+
+        # an old value is refreshed even by a small change
+        handler.channels[(self.node, 'analog', 1)].applied -= timedelta(seconds=600)
+        self.assertEqual(process('20.7', '30.1', 11.5)['blnet analog 1'], '20.7')
+        # a renamed channel is applied at once
+        handler.process({self.node: {'analog': {
+            1: {'name': 'Renamed', 'value': '20.8'}}}})
+        self.assertEqual(handler.data['blnet analog 1']['value'], '20.8')
+
+
+class TestConfigSchema(unittest.TestCase):
+    """Test the configuration schema."""
+
+    def test_single_device(self):
+        """Test a single device block is still accepted."""
+        config = CONFIG_SCHEMA({'blnet': {'resource': 'http://192.168.1.2'}})
+        self.assertEqual(len(config['blnet']), 1)
+        self.assertEqual(config['blnet'][0]['scan_interval'], 360)
+
+    def test_several_devices(self):
+        """Test several devices need distinct names."""
+        config = CONFIG_SCHEMA({'blnet': [
+            {'name': 'A', 'resource': 'http://192.168.1.2'},
+            {'name': 'B', 'resource': 'http://192.168.1.3'},
+        ]})
+        self.assertEqual([device['name'] for device in config['blnet']],
+                         ['A', 'B'])
+        with self.assertRaises(vol.Invalid):
+            CONFIG_SCHEMA({'blnet': [
+                {'name': 'A', 'resource': 'http://192.168.1.2'},
+                {'resource': 'http://192.168.1.3'},
+            ]})
+
+    def test_nodes(self):
+        """Test a list of nodes is not empty and polls every node once."""
+        config = CONFIG_SCHEMA({'blnet': {'resource': 'http://192.168.1.2',
+                                          'can_node': [2, 1, 2]}})
+        self.assertEqual(config['blnet'][0]['can_node'], [2, 1])
+        with self.assertRaises(vol.Invalid):
+            CONFIG_SCHEMA({'blnet': {'resource': 'http://192.168.1.2',
+                                     'can_node': []}})
+
+    def test_deadband(self):
+        """Test absolute and relative deadbands are told apart."""
+        config = CONFIG_SCHEMA({'blnet': {
+            'resource': 'http://192.168.1.2',
+            'deadband': {'analog': '0.2', 'energy': ' 1.5 %'},
+        }})
+        deadband = config['blnet'][0]['deadband']
+        self.assertEqual(deadband['analog'], (0.2, False))
+        self.assertEqual(deadband['energy'], (0.015, True))
+        self.assertEqual(deadband['max_age'], 900)
+        with self.assertRaises(vol.Invalid):
+            CONFIG_SCHEMA({'blnet': {'resource': 'http://192.168.1.2',
+                                     'deadband': {'analog': '-1'}}})
+
+    def test_derived(self):
+        """Test derived channels need the number of sources they take."""
+        config = CONFIG_SCHEMA({'blnet': {
+            'resource': 'http://192.168.1.2',
+            'derived': {'name': 'Heat', 'type': 'integral',
+                        'sources': '2 power 1'},
+        }})
+        self.assertEqual(config['blnet'][0]['derived'][0]['sources'],
+                         ['2 power 1'])
+        for derived in ({'name': 'A', 'type': 'ratio', 'sources': ['power 1']},
+                        {'name': 'A', 'type': 'sum', 'sources': ['digital 1']},
+                        [{'name': 'A', 'type': 'sum', 'sources': ['power 1']},
+                         {'name': 'a', 'type': 'sum', 'sources': ['power 2']}]):
+            with self.assertRaises(vol.Invalid):
+                CONFIG_SCHEMA({'blnet': {'resource': 'http://192.168.1.2',
+                                         'derived': derived}})
+
 
 class TestBLNETConnector(unittest.TestCase):
     """Test the BLNETConnector class."""
@@ -116,22 +826,24 @@ class TestBLNETConnector(unittest.TestCase):
         self.assertTrue(connector.use_web)
         self.assertFalse(connector.use_ta)
 
-    @patch('pyblnet.BLNET')
-    def test_connect(self, mock_blnet):
+    @patch('custom_components.blnet.BLNETWebSession')
+    def test_connect(self, mock_session):
         """Test connect method."""
         connector = BLNETConnector(
             resource='http://example.com',
             password='test'
         )
-        connector.connect()
-        mock_blnet.assert_called_once_with(
-            'http://example.com',
-            password='test',
-            web_port=80,
-            ta_port=40000,
-            use_web=True,
-            use_ta=False
+        client = connector.connect()
+        mock_session.assert_called_once_with(
+            'http://example.com:80',
+            password='test'
         )
+        mock_session.return_value.probe.assert_called_once_with()
+        self.assertIs(client.session, mock_session.return_value)
+        self.assertIsNone(client.direct)
+
+        connector.close()
+        mock_session.return_value.close.assert_called_once_with()
 
 
 if __name__ == '__main__':
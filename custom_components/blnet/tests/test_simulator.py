@@ -0,0 +1,50 @@
+"""End-to-end tests against the simulated BL-NET."""
+import unittest
+from unittest.mock import Mock, patch
+
+from custom_components.blnet import BLNETConnector, BLNETDataHandler
+from custom_components.blnet.tests.simulator import BLNETSimulator, PASSWORD
+
+
+class TestSimulator(unittest.TestCase):
+    """Test a full data handler against the simulated BL-NET."""
+
+    def setUp(self):
+        """Start a simulated BL-NET with two nodes."""
+        self.sim = BLNETSimulator(nodes=2, analog=4, digital=3,
+                                  login_failures=1).start()
+        self.addCleanup(self.sim.stop)
+        web = self.sim.web_address
+        self.connector = BLNETConnector(
+            resource=web[:web.rindex(':')], password=PASSWORD,
+            web_port=int(web[web.rindex(':') + 1:]),
+            ta_port=self.sim.ta_port, use_ta=True, nodes=[1, 2])
+        self.addCleanup(self.connector.close)
+        self.config = {'use_web': True}
+
+    @patch('custom_components.blnet.async_load_platform', new_callable=Mock)
+    def test_update(self, mock_load_platform):
+        """Test all nodes are discovered and outputs are switched."""
+        handler = BLNETDataHandler(
+            self.connector.connect(), [1, 2], Mock(), self.config)
+
+        # The first login fails, the next update logs in again
+        with self.assertRaises(ConnectionError):
+            handler.update()
+        handler.update()
+
+        node = self.sim.nodes[2]
+        self.assertEqual(handler.data['blnet 2 analog 3']['value'],
+                         node.analog[3])
+        self.assertEqual(handler.data['blnet 2 analog 3']['friendly_name'],
+                         'Node 2 T2.3')
+        self.assertEqual(handler.data['blnet 1 speed 2']['value'], 5)
+        self.assertEqual(self.sim.logins, 1)
+
+        handler.set_outputs({2: 'EIN', 3: 'AUTO'}, 2)
+        self.assertEqual(node.digital[2], ['HAND', 'EIN'])
+        self.assertEqual(node.digital[3][0], 'AUTO')
+
+
+if __name__ == '__main__':
+    unittest.main()
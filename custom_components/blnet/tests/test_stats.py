@@ -0,0 +1,35 @@
+"""Tests for the timings and counters of updates."""
+import unittest
+
+from custom_components.blnet.stats import CycleStats, timer
+
+
+class TestCycleStats(unittest.TestCase):
+    """Test the CycleStats class."""
+
+    def test_summary(self):
+        """Test percentiles are taken over the last durations only."""
+        stats = CycleStats(window=20)
+        for duration in range(1, 31):
+            stats.add_duration('fetch', duration / 1000)
+
+        self.assertEqual(stats.summary('fetch'), {
+            'last': 30.0, 'p50': 20.0, 'p95': 29.0, 'max': 30.0, 'count': 20})
+        self.assertIsNone(stats.summary('login'))
+
+    def test_timer(self):
+        """Test failing stages are timed and disabled stats do nothing."""
+        stats = CycleStats()
+        with self.assertRaises(ValueError), stats.timer('parse analog'):
+            raise ValueError("invalid page")
+        with timer(None, 'parse analog'):
+            pass
+        stats.count('bytes', 512)
+
+        report = stats.as_dict()
+        self.assertEqual(list(report['stages']), ['parse analog'])
+        self.assertEqual(report['counters']['bytes'], 512)
+
+
+if __name__ == '__main__':
+    unittest.main()
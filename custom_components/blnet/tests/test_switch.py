@@ -0,0 +1,62 @@
+"""Tests for the BLNET switch component."""
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+from homeassistant.const import STATE_OFF, STATE_ON
+from homeassistant.exceptions import HomeAssistantError
+
+from custom_components.blnet.channels import Channel
+from custom_components.blnet.switch import BLNETModeSwitch, BLNETSwitch
+
+
+class TestBLNETSwitch(unittest.IsolatedAsyncioTestCase):
+    """Test switching the digital outputs."""
+
+    def setUp(self):
+        """Set up an output that is off in automatic mode."""
+        self.channel = Channel(1, 'digital', 1, 'blnet digital 1')
+        self.channel.friendly_name = 'P1'
+        self.channel.mode = 'AUTO'
+        self.channel.value = 'AUS'
+        self.communication = Mock()
+        self.communication.channel.return_value = self.channel
+
+    def make_switch(self, switch_class):
+        """Return a switch of the output with its state read."""
+        switch = switch_class(1, 'blnet digital 1', 'P1', self.communication)
+        switch.async_write_ha_state = Mock()
+        switch._update_from_data()
+        return switch
+
+    async def test_turn_on(self):
+        """Test the state is assumed once the command succeeded."""
+        self.communication.async_turn_on = AsyncMock(return_value=True)
+        switch = self.make_switch(BLNETSwitch)
+
+        await switch.async_turn_on()
+
+        self.communication.async_turn_on.assert_awaited_once_with(1, None)
+        self.assertEqual(switch.state, STATE_ON)
+        self.assertTrue(switch.assumed_state)
+
+    async def test_failed_write(self):
+        """Test a failed command keeps the state that was read."""
+        self.communication.async_turn_on = AsyncMock(return_value=False)
+        self.communication.async_turn_auto = AsyncMock(return_value=False)
+        self.channel.mode = 'HAND'
+        switch = self.make_switch(BLNETSwitch)
+        mode_switch = self.make_switch(BLNETModeSwitch)
+
+        with self.assertRaises(HomeAssistantError):
+            await switch.async_turn_on()
+        with self.assertRaises(HomeAssistantError):
+            await mode_switch.async_turn_on()
+
+        self.assertEqual(switch.state, STATE_OFF)
+        self.assertFalse(switch.assumed_state)
+        self.assertEqual(mode_switch.state, STATE_OFF)
+        switch.async_write_ha_state.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+"""Tests for the TA direct connection."""
+import socketserver
+import threading
+import unittest
+from unittest.mock import MagicMock, Mock
+
+from custom_components.blnet.client import BLNETClient
+from custom_components.blnet.ta_direct import (
+    BLNETDirectConnection, decode_frame,
+)
+
+# Current values of a UVR1611 as sent by the BL-NET
+FRAME = (
+    b'} \xb5"f"\x03"~!\x8e"\x16!\xe0 \xff \xf3 \xf8 \x00\x00=!\x01\x00\x00`'
+    b'\xe2!\x05\x00\x80\x00\x00\x00\x01,\x00\xa4(\x06\x00DhI\x82\x1d\x04Ce'
+    b'\xc0\x00'
+)
+
+
+def with_checksum(data):
+    """Append the checksum of the bootloader protocol."""
+    return data + bytes([sum(data) % 256])
+
+
+class FakeBootloader(socketserver.BaseRequestHandler):
+    """Answers like the bootloader of a BL-NET in CAN mode with one frame."""
+
+    waits = 0
+
+    def handle(self):
+        self.server.connections += 1
+        while True:
+            command = self.request.recv(1)
+            if not command:
+                return
+            if command == b'\x81':
+                self.request.sendall(b'\xdc')
+            elif command == b'\xaa':
+                header = with_checksum(b'\x80\x01\x00\x00\x00\x01\x00' + bytes(6))
+                # the header arrives in pieces
+                self.request.sendall(header[:4])
+                self.request.sendall(header[4:])
+            elif command == b'\xab':
+                self.request.recv(1)
+                if self.server.waits:
+                    self.server.waits -= 1
+                    self.request.sendall(with_checksum(b'\xba\x00'))
+                else:
+                    self.request.sendall(with_checksum(b'\x80' + FRAME))
+            elif command == b'\xad':
+                self.request.sendall(b'\xad')
+
+
+class TestDecode(unittest.TestCase):
+    """Test decoding the current values."""
+
+    def test_decode_frame(self):
+        """Test a frame is decoded like pyblnet does."""
+        values = decode_frame(FRAME)
+        self.assertEqual(values['analog'][1], 12.5)
+        self.assertEqual(values['analog'][14], 1)
+        self.assertEqual(values['analog'][16], 48.2)
+        self.assertEqual(values['digital'][1], 1)
+        self.assertEqual(values['digital'][3], 1)
+        self.assertEqual(values['digital'][2], 0)
+        self.assertEqual(values['speed'], {1: None, 2: 0, 3: 0, 4: 0})
+        # only the first heat meter is active
+        self.assertEqual(values['energy'], {1: 26692000.6, 2: None})
+        self.assertEqual(values['power'], {1: 266342.417, 2: None})
+
+
+class TestBLNETDirectConnection(unittest.TestCase):
+    """Test the BLNETDirectConnection class against a fake bootloader."""
+
+    def setUp(self):
+        """Start the fake bootloader."""
+        self.server = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', 0), FakeBootloader)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.waits = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.connection = BLNETDirectConnection(
+            '127.0.0.1', self.server.server_address[1])
+
+    def tearDown(self):
+        """Stop the fake bootloader."""
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_latest(self):
+        """Test the current values are read over one connection."""
+        self.connection.probe()
+        self.server.waits = 1
+        first = self.connection.get_latest()
+        second = self.connection.get_latest()
+
+        self.assertEqual(first[0], decode_frame(FRAME))
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reconnect(self):
+        """Test a lost connection is opened again."""
+        self.connection.get_latest()
+        self.connection._socket.close()
+        self.connection._socket = Mock()
+        self.connection._socket.sendall.side_effect = BrokenPipeError()
+
+        self.assertEqual(self.connection.get_latest()[0], decode_frame(FRAME))
+        self.assertEqual(self.server.connections, 2)
+
+    def test_unreachable(self):
+        """Test probing a closed port fails."""
+        connection = BLNETDirectConnection('127.0.0.1', 1)
+        with self.assertRaises(ConnectionError):
+            connection.probe()
+
+
+class TestClientDirect(unittest.TestCase):
+    """Test fetching through the direct connection."""
+
+    def setUp(self):
+        """Set up a client with fake web and direct access."""
+        self.session = MagicMock()
+        self.session.read_analog_values.return_value = [
+            {'id': '1', 'name': 'TKollektor', 'value': '12.4',
+             'unit_of_measurement': '°C'}]
+        self.session.read_digital_values.return_value = [
+            {'id': '1', 'name': 'Pumpe', 'mode': 'AUTO', 'value': 'AUS'}]
+        self.direct = Mock()
+        self.direct.get_latest.return_value = {0: decode_frame(FRAME)}
+        self.client = BLNETClient(self.session, self.direct)
+
+    def test_analog_names_are_cached(self):
+        """Test the analog page is only read for names."""
+        data = self.client.fetch(1)
+        self.assertEqual(data['analog'][1]['value'], 12.5)
+        self.assertEqual(data['digital'][1]['value'], 'EIN')
+        self.assertEqual(data['power'][1]['name'], 'Power 1')
+
+        data = self.client.fetch(1)
+        self.assertEqual(self.session.read_analog_values.call_count, 1)
+        self.assertEqual(self.session.read_digital_values.call_count, 2)
+        self.assertEqual(data['analog'][1],
+                         {'id': '1', 'name': 'TKollektor', 'value': 12.5,
+                          'unit_of_measurement': '°C'})
+
+    def test_fallback_to_web(self):
+        """Test the web interface is used while the direct port fails."""
+        self.direct.get_latest.side_effect = ConnectionError("refused")
+        data = self.client.fetch(1)
+        self.assertEqual(data['analog'][1]['value'], '12.4')
+        self.assertNotIn('speed', data)
+
+        # The direct connection is not tried again right away
+        self.client.fetch(1)
+        self.assertEqual(self.direct.get_latest.call_count, 1)
+
+        self.client._direct_failed -= 3600
+        self.direct.get_latest.side_effect = None
+        self.assertEqual(self.client.fetch(1)['analog'][1]['value'], 12.5)
+
+    def test_direct_only(self):
+        """Test all channels are named without the web interface."""
+        client = BLNETClient(None, self.direct)
+        data = client.fetch()
+        self.assertEqual(len(data['analog']), 16)
+        self.assertEqual(data['digital'][1],
+                         {'name': 'Digital 1', 'value': 'EIN'})
+
+        self.direct.get_latest.side_effect = ConnectionError("refused")
+        with self.assertRaises(ConnectionError):
+            client.fetch()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+"""Tests for the BLNET web session."""
+import unittest
+from unittest.mock import Mock
+
+from custom_components.blnet.client import BLNETClient
+from custom_components.blnet.web import (
+    BLNETWebSession, parse_analog_page, parse_digital_page,
+)
+
+ANALOG_PAGE = (
+    '<html><head><title>UVR1611 / Knoten 1</title></head><body>'
+    '<div class="c"><div class="ze cen bgb">EINGAENGE<br></div>'
+    '<div class="ze cen"><div class="c" style="width:21em;"> '
+    '&nbsp;1:&nbsp;TKollektor<br>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;5,3 &deg;C '
+    '&nbsp;&nbsp;PAR?<span class="pf"><button type="button">&lt;=</button></span><br>'
+    '&nbsp;5:&nbsp;Temp.Aussen<br>&nbsp;&nbsp;&nbsp;-&nbsp;72,3 &deg;C '
+    '&nbsp;&nbsp;PAR?<span class="pf"><button type="button">&lt;=</button></span><br>'
+    '</div></div></div></body></html>'
+)
+
+DIGITAL_PAGE = (
+    '<html><head><title>UVR1611 / Knoten 1</title></head><body>'
+    '<div class="c"><div class="ze cen bgb">AUSGAENGE<br></div>'
+    '<div class="ze cen"><div class="c" style="width:21em;"> '
+    '&nbsp;1:&nbsp;Pumpe-Solar<br>&nbsp;&nbsp;&nbsp;&nbsp;AUTO/AUS'
+    '<span id="A1200101"><button type="button">&#8249;&#8250;</button></span>'
+    '&nbsp;&nbsp;&nbsp;PAR?<br>'
+    '&nbsp;2:&nbsp;Pumpe-Hzkr<br>&nbsp;&nbsp;&nbsp;&nbsp;HAND/EIN'
+    '<span id="A1200201"><button type="button">&#8249;&#8250;</button></span>'
+    '&nbsp;&nbsp;&nbsp;PAR?<br>'
+    '</div></div></div></body></html>'
+)
+
+
+def make_response(text='', cookie=None, status_code=200):
+    """Create a fake response of the BL-NET web server."""
+    response = Mock()
+    response.text = text
+    response.status_code = status_code
+    response.headers = {'Set-Cookie': cookie} if cookie else {}
+    return response
+
+
+class TestParser(unittest.TestCase):
+    """Test parsing the pages of the web interface."""
+
+    def test_parse_analog_page(self):
+        """Test analog values are read with their units."""
+        self.assertEqual(parse_analog_page(ANALOG_PAGE), [
+            {'id': '1', 'name': 'TKollektor', 'value': 5.3,
+             'unit_of_measurement': '°C'},
+            {'id': '5', 'name': 'Temp.Aussen', 'value': -72.3,
+             'unit_of_measurement': '°C'},
+        ])
+
+    def test_parse_digital_page(self):
+        """Test digital values are read with their modes."""
+        self.assertEqual(parse_digital_page(DIGITAL_PAGE), [
+            {'id': '1', 'name': 'Pumpe-Solar', 'mode': 'AUTO', 'value': 'AUS'},
+            {'id': '2', 'name': 'Pumpe-Hzkr', 'mode': 'HAND', 'value': 'EIN'},
+        ])
+
+    def test_parse_access_denied(self):
+        """Test a page without values is not parsed."""
+        self.assertIsNone(parse_analog_page('<title>BL-Net Zugang verweigert</title>'))
+
+
+class TestBLNETWebSession(unittest.TestCase):
+    """Test the BLNETWebSession class."""
+
+    def setUp(self):
+        """Set up a session with a fake HTTP session."""
+        self.http = Mock()
+        self.http.post.return_value = make_response(cookie='TAID="AAAA"')
+        self.http.get.return_value = make_response(ANALOG_PAGE, cookie='TAID="AAAA"')
+        self.session = BLNETWebSession('192.168.1.2:80', password='0128')
+        self.session._session = self.http
+
+    def test_login_is_reused(self):
+        """Test several requests share a single login."""
+        self.session.read_analog_values()
+        self.session.read_analog_values()
+        self.session.set_node(2)
+        self.session.set_node(2)
+
+        self.assertEqual(self.http.post.call_count, 1)
+        self.assertEqual(self.http.get.call_count, 3)
+        headers = self.http.get.call_args.kwargs['headers']
+        self.assertEqual(headers, {'Cookie': 'TAID="AAAA"'})
+        self.assertEqual(self.http.get.call_args.args[0],
+                         'http://192.168.1.2:80/can.htm?blaB=2')
+
+    def test_login_after_auth_failure(self):
+        """Test an expired login is renewed once."""
+        self.session.read_analog_values()
+        self.http.post.return_value = make_response(cookie='TAID="BBBB"')
+        self.http.get.side_effect = [
+            make_response('<title>BL-Net Zugang verweigert</title>'),
+            make_response(ANALOG_PAGE, cookie='TAID="BBBB"'),
+        ]
+
+        values = self.session.read_analog_values()
+
+        self.assertEqual(len(values), 2)
+        self.assertEqual(self.http.post.call_count, 2)
+        self.assertEqual(self.session._cookie, 'TAID="BBBB"')
+
+    def test_login_after_expiry(self):
+        """Test a login is renewed once it is known to be expired."""
+        self.session.read_analog_values()
+        self.session._cookie_expires = 0
+        self.session.read_analog_values()
+        self.assertEqual(self.http.post.call_count, 2)
+
+    def test_node_after_login(self):
+        """Test the node is selected again before any page is requested
+        with a new login, for reads and writes."""
+        select = 'http://192.168.1.2:80/can.htm?blaB=20'
+        pages = {
+            'read': (self.session.read_analog_values,
+                     'http://192.168.1.2:80/580500.htm'),
+            'write': (lambda: self.session.set_digital_value(12, 'EIN'),
+                      'http://192.168.1.2:80/580600.htm?blw91A1200C=2'),
+        }
+        self.session.set_node(20)
+        for name, (action, page) in pages.items():
+            with self.subTest(name, expired='by time'):
+                self.session._cookie_expires = 0
+                self.http.get.reset_mock()
+                self.session.set_node(20)
+                action()
+                self.assertEqual(
+                    [call.args[0] for call in self.http.get.call_args_list],
+                    [select, page])
+
+            with self.subTest(name, expired='by the BL-NET'):
+                self.http.get.reset_mock()
+                self.http.get.side_effect = [
+                    make_response('<title>BL-Net Zugang verweigert</title>'),
+                    make_response(cookie='TAID="BBBB"'),
+                    make_response(ANALOG_PAGE, cookie='TAID="BBBB"'),
+                ]
+                self.session.set_node(20)
+                action()
+                self.http.get.side_effect = None
+                self.assertEqual(
+                    [call.args[0] for call in self.http.get.call_args_list],
+                    [page, select, page])
+                self.assertEqual(self.session.node, 20)
+
+    def test_denied_access(self):
+        """Test a persistent auth failure raises."""
+        self.http.get.return_value = make_response(status_code=403)
+        with self.assertRaises(ConnectionError):
+            self.session.read_analog_values()
+
+    def test_set_digital_value(self):
+        """Test switching a digital output."""
+        self.session.set_digital_value(12, 'AUTO')
+        self.assertEqual(self.http.get.call_args.args[0],
+                         'http://192.168.1.2:80/580600.htm?blw91A1200C=3')
+
+    def test_close(self):
+        """Test closing logs out and closes the connections."""
+        self.session.read_analog_values()
+        self.session.close()
+        self.assertEqual(self.http.get.call_args.args[0],
+                         'http://192.168.1.2:80/main.html?blL=1')
+        self.http.close.assert_called_once_with()
+        self.assertFalse(self.session.logged_in())
+
+
+class TestBLNETClient(unittest.TestCase):
+    """Test the BLNETClient class."""
+
+    def test_fetch(self):
+        """Test fetching both pages of a node in one session."""
+        session = BLNETWebSession('192.168.1.2')
+        session.set_node = Mock()
+        session.read_analog_values = Mock(return_value=parse_analog_page(ANALOG_PAGE))
+        session.read_digital_values = Mock(return_value=parse_digital_page(DIGITAL_PAGE))
+        client = BLNETClient(session)
+
+        data = client.fetch(3)
+
+        session.set_node.assert_called_once_with(3)
+        self.assertEqual(sorted(data['analog']), [1, 5])
+        # the same type as the values of the direct port
+        self.assertEqual(data['analog'][5]['value'], -72.3)
+        self.assertEqual(data['digital'][2]['mode'], 'HAND')
+        self.assertNotIn('speed', data)
+
+    def test_fetch_selected_pages(self):
+        """Test only the requested pages are read."""
+        session = BLNETWebSession('192.168.1.2')
+        session.set_node = Mock()
+        session.read_analog_values = Mock()
+        session.read_digital_values = Mock(return_value=parse_digital_page(DIGITAL_PAGE))
+        client = BLNETClient(session)
+
+        data = client.fetch(None, {'digital'})
+
+        session.read_analog_values.assert_not_called()
+        self.assertNotIn('analog', data)
+        self.assertEqual(len(data['digital']), 2)
+
+        client.fetch(None, set())
+        self.assertEqual(session.read_digital_values.call_count, 1)
+
+    def test_set_outputs(self):
+        """Test several outputs are set after selecting the node once."""
+        session = BLNETWebSession('192.168.1.2')
+        session.set_node = Mock()
+        session.set_digital_value = Mock(
+            side_effect=[None, ConnectionError("denied"), None])
+        client = BLNETClient(session)
+
+        results = client.set_outputs({1: 'EIN', 2: 'AUS', 3: 'AUTO'}, 2)
+
+        self.assertEqual(results, {1: True, 2: False, 3: True})
+        session.set_node.assert_called_once_with(2)
+        self.assertEqual(session.set_digital_value.call_count, 3)
+
+    def test_turn_without_web(self):
+        """Test switching is impossible without the web interface."""
+        with self.assertRaises(EnvironmentError):
+            BLNETClient().turn_on(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,283 @@
+"""
+Keep-alive session to the web interface of a BL-NET
+
+Reading and writing values uses the same pages as pyblnet, but all
+requests share one pooled connection and one login.
+"""
+import html
+import logging
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .stats import timer
+
+_LOGGER = logging.getLogger(__name__)
+
+# Pages of the web interface
+LOGIN_PAGE = '/main.html'
+LOGOUT_PAGE = '/main.html?blL=1'
+NODE_PAGE = '/can.htm?blaB={}'
+ANALOG_PAGE = '/580500.htm'
+DIGITAL_PAGE = '/580600.htm'
+SET_DIGITAL_PAGE = '/580600.htm?blw91A1200{}={}'
+
+ACCESS_DENIED = 'Zugang verweigert'
+# The BL-NET drops a login that has not been used for a few minutes
+DEFAULT_COOKIE_LIFETIME = 180
+DEFAULT_TIMEOUT = 5
+
+# Values accepted by the digital outputs
+DIGITAL_VALUES = {'AUS': '1', 'EIN': '2', 'AUTO': '3'}
+
+_BR = re.compile(r'<br\s*/?>', re.IGNORECASE)
+_TAG = re.compile(r'<[^>]*>')
+_ANALOG = re.compile(
+    r"(?P<id>\d+):&nbsp;(?P<name>.+)\n(&nbsp;){3,6}"
+    r"(?P<value>(-&nbsp;)?\d+,\d+) (?P<unit_of_measurement>.+?) &nbsp;&nbsp;PAR?"
+)
+_DIGITAL = re.compile(
+    r"(?P<id>\d+):&nbsp;(?P<name>.+)\n&nbsp;&nbsp;&nbsp;&nbsp;"
+    r"(?P<mode>(AUTO|HAND))/(?P<value>(AUS|EIN))"
+)
+
+
+def _page_content(text):
+    """Return the text of the value list of a page, None if missing."""
+    # the values are listed in the second container of class "c"
+    start = text.find('<div class="c"')
+    start = text.find('<div class="c"', start + 1) if start >= 0 else -1
+    if start < 0:
+        return None
+    return _TAG.sub('', _BR.sub('\n', text[start:]))
+
+
+def parse_analog_page(text):
+    """Parse the analog values page into a list of value dicts."""
+    content = _page_content(text)
+    if content is None:
+        return None
+    values = []
+    for match in _ANALOG.finditer(content):
+        values.append({
+            'id': match.group('id'),
+            'name': html.unescape(match.group('name').replace('&nbsp;', ' ')),
+            # numbers like the values of the direct port and the C.M.I.
+            'value': float(
+                match.group('value').replace('&nbsp;', '').replace(',', '.')),
+            'unit_of_measurement': html.unescape(
+                match.group('unit_of_measurement').replace('&nbsp;', ' ')),
+        })
+    return values
+
+
+def parse_digital_page(text):
+    """Parse the digital values page into a list of value dicts."""
+    content = _page_content(text)
+    if content is None:
+        return None
+    values = []
+    for match in _DIGITAL.finditer(content):
+        values.append({
+            'id': match.group('id'),
+            'name': html.unescape(match.group('name').replace('&nbsp;', ' ')),
+            'mode': match.group('mode'),
+            'value': match.group('value'),
+        })
+    return values
+
+
+class BLNETWebSession:
+    """Pooled keep-alive session to the web interface of a BL-NET."""
+
+    def __init__(self, address, password=None, timeout=DEFAULT_TIMEOUT,
+                 cookie_lifetime=DEFAULT_COOKIE_LIFETIME):
+        """Initialize the session, no request is sent yet."""
+        if not address.startswith(('http://', 'https://')):
+            address = 'http://' + address
+        self.address = address.rstrip('/')
+        self.password = password
+        self.timeout = timeout
+        self.cookie_lifetime = cookie_lifetime
+        # serializes requests, node selection and reads belong together
+        self.lock = threading.RLock()
+        self._session = None
+        self._cookie = None
+        self._cookie_expires = 0
+        # node selected in the current login, and the one the requests
+        # should refer to, which has to be selected again after a login
+        self._node = None
+        self._wanted_node = None
+        # CaptureWriter recording the pages read, if any
+        self.capture = None
+        # CycleStats timing the requests, if any
+        self.stats = None
+
+    def _get_session(self):
+        """Return the pooled HTTP session, creating it on first use."""
+        if self._session is None:
+            session = requests.Session()
+            # The embedded web server only handles very few connections
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    def _get(self, path):
+        """Send a GET request with the current login cookie."""
+        headers = {'Cookie': self._cookie} if self._cookie else {}
+        return self._count(self._get_session().get(
+            self.address + path, headers=headers, timeout=self.timeout
+        ))
+
+    def _count(self, response):
+        """Count a request and the size of its response."""
+        if self.stats is not None:
+            self.stats.count('requests')
+            self.stats.count('bytes', len(response.content))
+        return response
+
+    def _is_authenticated(self, response):
+        """Return whether a response was served to a logged in client."""
+        if response.status_code == 403 or ACCESS_DENIED in response.text:
+            return False
+        # The BL-NET renews the cookie of every authenticated request
+        return self.password is None or 'Set-Cookie' in response.headers
+
+    def probe(self):
+        """Check that a BL-NET answers under the address."""
+        with self.lock:
+            try:
+                response = self._get('/')
+            except requests.exceptions.RequestException as ex:
+                raise ValueError(f"No BL-Net reached at {self.address}") from ex
+            if 'BL-Net'.lower() not in response.text.lower():
+                raise ValueError(f"No BL-Net found at {self.address}")
+
+    def logged_in(self):
+        """Return whether the cached login is assumed to be still valid."""
+        if self.password is None:
+            return True
+        return self._cookie is not None and time.monotonic() < self._cookie_expires
+
+    def log_in(self):
+        """Log in as expert and cache the login cookie."""
+        with self.lock:
+            self._cookie = None
+            self._node = None
+            if self.password is None:
+                return
+            _LOGGER.debug(f"Logging in to BL-NET at {self.address}")
+            with timer(self.stats, 'login'):
+                response = self._count(self._get_session().post(
+                    self.address + LOGIN_PAGE,
+                    data={'blu': 1, 'blp': self.password, 'bll': 'Login'},
+                    headers={
+                        'Content-Type': 'application/x-www-form-urlencoded'},
+                    timeout=self.timeout,
+                ))
+            cookie = response.headers.get('Set-Cookie')
+            if cookie is None:
+                raise ConnectionError(f"Could not log in to {self.address}")
+            self._cookie = cookie
+            self._cookie_expires = time.monotonic() + self.cookie_lifetime
+
+    def log_out(self):
+        """Log out to free the login slot of the BL-NET."""
+        with self.lock:
+            if self._cookie is None:
+                return
+            try:
+                self._get(LOGOUT_PAGE)
+            except requests.exceptions.RequestException as ex:
+                _LOGGER.debug(f"Could not log out of BL-NET: {ex}")
+            self._cookie = None
+            self._node = None
+
+    def request(self, path):
+        """Request a page, logging in again only if the login is gone."""
+        with self.lock:
+            if not self.logged_in():
+                self._log_in_again(path)
+            response = self._get(path)
+            if not self._is_authenticated(response):
+                _LOGGER.debug("Login to BL-NET expired, logging in again")
+                self._log_in_again(path)
+                response = self._get(path)
+                if not self._is_authenticated(response):
+                    raise ConnectionError(f"Access to {path} was denied")
+            self._cookie_expires = time.monotonic() + self.cookie_lifetime
+            return response
+
+    def _log_in_again(self, path):
+        """Log in and select the wanted node again, a new login starts
+        without a selected node."""
+        self.log_in()
+        if self._wanted_node is None:
+            return
+        node_page = NODE_PAGE.format(self._wanted_node)
+        if path == node_page:
+            return
+        with timer(self.stats, 'select node'):
+            response = self._get(node_page)
+        if not self._is_authenticated(response):
+            raise ConnectionError(f"Access to {node_page} was denied")
+        self._node = self._wanted_node
+
+    @property
+    def node(self):
+        """Return the CAN node selected in the current login, if known."""
+        return self._node
+
+    def set_node(self, node):
+        """Select the CAN node that following requests refer to."""
+        with self.lock:
+            if node is None:
+                return
+            # a request that logs in again selects it before it is sent
+            self._wanted_node = node
+            if node == self._node:
+                return
+            with timer(self.stats, 'select node'):
+                self.request(NODE_PAGE.format(node))
+            self._node = node
+
+    def _read_page(self, path, kind):
+        """Request a page of values and record it if capturing."""
+        with timer(self.stats, f'fetch {kind}'):
+            text = self.request(path).text
+        if self.capture is not None:
+            self.capture.write(kind, text.encode(), self._node)
+        return text
+
+    def read_analog_values(self):
+        """Read all analog values of the current node."""
+        text = self._read_page(ANALOG_PAGE, 'analog')
+        with timer(self.stats, 'parse analog'):
+            return parse_analog_page(text)
+
+    def read_digital_values(self):
+        """Read all digital values of the current node."""
+        text = self._read_page(DIGITAL_PAGE, 'digital')
+        with timer(self.stats, 'parse digital'):
+            return parse_digital_page(text)
+
+    def set_digital_value(self, digital_id, value):
+        """Set a digital output of the current node to EIN, AUS or AUTO."""
+        digital_id = int(digital_id)
+        if not 1 <= digital_id <= 15:
+            raise ValueError(f"Device id must be between 1 and 15, was {digital_id}")
+        self.request(SET_DIGITAL_PAGE.format(
+            format(digital_id, 'X'), DIGITAL_VALUES[value]))
+
+    def close(self):
+        """Log out and close all pooled connections."""
+        with self.lock:
+            self.log_out()
+            if self._session is not None:
+                self._session.close()
+                self._session = None